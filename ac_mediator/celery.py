@@ -38,4 +38,7 @@ def setup_periodic_tasks(sender, **kwargs):
         crontab(hour=6, minute=0),  # Every day at 6 am
         run_django_management_command.s('renew_access_tokens'),
         name='Renew expired tokens')
-
+    sender.add_periodic_task(
+        crontab(minute=0),  # Every hour
+        run_django_management_command.s('clean_old_responses'),
+        name='Clean old responses')
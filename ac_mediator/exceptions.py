@@ -113,3 +113,27 @@ class ACAPIUnsupportedFormat(ACAPIException):
     status_code = status.HTTP_400_BAD_REQUEST
     default_detail = 'Unsupported response format.'
     default_code = 'bad_request'
+
+
+class ACAPIServiceTimeout(ACAPIException):
+    status_code = status.HTTP_504_GATEWAY_TIMEOUT
+    default_detail = 'Service did not respond in time.'
+    default_code = 'service_timeout'
+
+
+class ACAPIServiceBusy(ACAPIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many requests are being made to the service, try again later.'
+    default_code = 'service_busy'
+
+
+class ACAPIServiceUnavailable(ACAPIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Service is currently unavailable, try again later.'
+    default_code = 'service_unavailable'
+
+
+class ACAPIServiceResponseTooLarge(ACAPIException):
+    status_code = status.HTTP_502_BAD_GATEWAY
+    default_detail = 'Response of the service is too large.'
+    default_code = 'service_response_too_large'
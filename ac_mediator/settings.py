@@ -171,6 +171,20 @@ DOCS_ACCESS = 'public'
 # Redis
 REDIS_HOST = 'redis'  # Host where redis is running (we use docker alias here)
 REDIS_PORT = 6379
+REDIS_DB = 0
+# Each process keeps a pool of connections to redis which are shared by web server threads, dispatch threads, etc.
+# Requests waiting for responses (long-polling /collect, /stream or waiting until a response is finished) and requests
+# queued by the concurrency limiter hold a connection while waiting (for up to REDIS_SOCKET_TIMEOUT seconds), therefore
+# REDIS_MAX_CONNECTIONS should be at least the number of threads of a process which can be waiting at the same time
+# (web server threads + REQUEST_DISPATCH_THREAD_POOL_SIZE + SERVICE_EVENT_LOOP_EXECUTOR_SIZE). Once
+# REDIS_MAX_CONNECTIONS are in use, getting a connection waits for one to be returned to the pool for up to
+# REDIS_CONNECTION_POOL_TIMEOUT seconds before raising an error.
+REDIS_MAX_CONNECTIONS = 100
+REDIS_CONNECTION_POOL_TIMEOUT = 5
+# Socket timeouts (in seconds) for redis connections. REDIS_SOCKET_TIMEOUT must be longer than MAX_REQUEST_TIMEOUT
+# as blocking commands are used to wait for responses to be finished.
+REDIS_SOCKET_CONNECT_TIMEOUT = 2
+REDIS_SOCKET_TIMEOUT = 90
 
 # Celery
 CELERY_BROKER_URL = "redis://redis"
@@ -183,9 +197,109 @@ CELERY_TIMEZONE = 'Europe/Madrid'
 # changes to the code
 USE_CELERY_IN_DEBUG_MODE = False
 
+# Backend used to dispatch requests to 3rd party services (see api.request_distributor). Use 'celery_fanout' to perform
+# all the requests of an incoming request in a single Celery task, 'celery' to perform each request in an individual
+# Celery task or 'threads' to perform them concurrently in a pool of threads inside the web server process. The thread
+# pool avoids the broker round trip and worker pickup and is suited for low latency deployments with few services.
+# When using Celery in DEBUG mode, USE_CELERY_IN_DEBUG_MODE still applies.
+REQUEST_DISPATCH_BACKEND = 'celery_fanout'
+REQUEST_DISPATCH_THREAD_POOL_SIZE = 10  # Maximum number of concurrent requests per web server process
+
+# Maximum time (in seconds) given to 3rd party services to respond to a request. After that time, services that have
+# not responded are marked as timed out in the aggregated response, which is then set to finished. Requests with
+# wait_until_complete block at most this time. Clients can ask for a different time using the 'timeout' query
+# parameter (up to MAX_REQUEST_TIMEOUT).
+DEFAULT_REQUEST_TIMEOUT = 30
+MAX_REQUEST_TIMEOUT = 60
+
+# Default timeouts (in seconds) for connecting to and reading from 3rd party services. These can be set for each
+# individual service using the 'connect_timeout' and 'read_timeout' options in services_conf.cfg.
+DEFAULT_SERVICE_CONNECT_TIMEOUT = 5
+DEFAULT_SERVICE_READ_TIMEOUT = 20
+
+# Requests to 3rd party services are performed in a single event loop per process (see
+# services.acservice.utils.ServiceEventLoop) which keeps a pool of HTTP connections shared by all requests. Blocking
+# operations of these requests (e.g. waiting in the queue of the concurrency limiter) run in a pool of
+# SERVICE_EVENT_LOOP_EXECUTOR_SIZE threads.
+SERVICE_HTTP_MAX_CONNECTIONS = 200  # Maximum number of open connections to 3rd party services per process
+SERVICE_EVENT_LOOP_EXECUTOR_SIZE = 20
+
+# Hedging of requests to 3rd party services. For services with 'hedge_requests=yes' in services_conf.cfg, GET requests
+# that have not been answered within the SERVICE_REQUEST_HEDGING_PERCENTILE of the latencies observed for the service
+# are sent a second time and the first response received is used. The number of extra requests is limited to
+# SERVICE_REQUEST_HEDGING_BUDGET times the number of requests (can be set per service with 'hedge_budget').
+SERVICE_LATENCY_WINDOW_SIZE = 200  # Number of most recent request latencies considered for each service
+SERVICE_REQUEST_HEDGING_MIN_SAMPLES = 20  # Requests are not hedged until this number of latencies has been observed
+SERVICE_REQUEST_HEDGING_PERCENTILE = 95
+SERVICE_REQUEST_HEDGING_BUDGET = 0.05
+
+# Limit of concurrent requests made to each 3rd party service, shared by all processes (see services.concurrency). The
+# limit adapts to the responses of the service: it is increased additively after successful requests and multiplied by
+# SERVICE_CONCURRENCY_DECREASE_FACTOR after failed requests or requests slower than
+# SERVICE_CONCURRENCY_LATENCY_THRESHOLD seconds. Requests exceeding the limit wait in a queue (in order of arrival)
+# until a slot is released or until the request deadline (they fail immediately if, given the median latency of the
+# service, they would not be answered before the deadline).
+SERVICE_CONCURRENCY_LIMIT_ENABLED = True
+SERVICE_CONCURRENCY_INITIAL_LIMIT = 10
+SERVICE_CONCURRENCY_MIN_LIMIT = 1
+SERVICE_CONCURRENCY_MAX_LIMIT = 100
+SERVICE_CONCURRENCY_DECREASE_FACTOR = 0.5
+SERVICE_CONCURRENCY_LATENCY_THRESHOLD = 5
+SERVICE_CONCURRENCY_QUEUE_RETRY_INTERVAL = 1  # Seconds between checks for free slots (e.g. expired leases) in the queue
+SERVICE_CONCURRENCY_LEASE_MARGIN = 10  # Seconds after the request deadline at which slots are released if not before
+
+# Circuit breaker for requests made to 3rd party services (see services.circuit_breaker). After
+# SERVICE_CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive failed requests (timeouts, 5xx errors...) no more requests are
+# made to the service during SERVICE_CIRCUIT_BREAKER_RESET_TIMEOUT seconds. After that, a single request is made to
+# check if the service has recovered.
+SERVICE_CIRCUIT_BREAKER_ENABLED = True
+SERVICE_CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+SERVICE_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+# Identical requests (e.g. text searches with the same parameters) received within this number of seconds share the
+# same aggregated response instead of being sent again to 3rd party services. Only used for requests whose results do
+# not depend on the end user. Set to 0 to disable.
+REQUEST_COALESCING_WINDOW = 10
+
+# Parsed filter strings and filter strings translated by each 3rd party service are kept in LRU caches of this number
+# of items (in each process) so that popular filters are not parsed and translated again. Hit rates of the caches are
+# logged every FILTER_CACHE_STATS_LOG_INTERVAL lookups.
+FILTER_CACHE_SIZE = 1000
+FILTER_CACHE_STATS_LOG_INTERVAL = 10000
+
 # Shared respones backend and async responses
-DELETE_RESPONSES_AFTER_CONSUMED = False
-RESPONSE_EXPIRY_TIME = 3600*24  # Response objects are deleted after 24 hours
+DELETE_RESPONSES_AFTER_CONSUMED = False  # Delete finished responses once collected (except coalesced responses)
+RESPONSE_EXPIRY_TIME = 3600*24  # Response objects are deleted at most 24 hours after being created
+RESPONSE_CLEANUP_BATCH_SIZE = 1000  # Number of old responses deleted at once by the clean_old_responses command
+
+# Responses are kept in the store for different times depending on their status. Responses being processed are kept
+# until their deadline plus RESPONSE_FINISHED_EXPIRY_TIME seconds, and finished responses RESPONSE_FINISHED_EXPIRY_TIME
+# seconds after finishing. Finished responses with contents are kept for at least RESPONSE_COLLECTED_EXPIRY_TIME
+# seconds after each time they are collected, so only responses still used by clients are kept longer (up to
+# RESPONSE_EXPIRY_TIME).
+RESPONSE_FINISHED_EXPIRY_TIME = 60*5
+RESPONSE_COLLECTED_EXPIRY_TIME = 3600
+
+# Contents returned by a single service larger than this number of bytes (serialized) are truncated (removing results
+# from the end of the results list) and a warning is added. Contents without results which are larger are replaced by
+# an error. Set to None to store contents of any size.
+RESPONSE_MAX_SERVICE_CONTENTS_SIZE = 2 * 1024 ** 2
+
+# Contents, warnings and errors of each service are compressed with zlib before being added to the response store if
+# their serialized size is larger than RESPONSE_COMPRESSION_THRESHOLD bytes (set to None to disable compression).
+# RESPONSE_COMPRESSION_LEVEL goes from 1 (fastest) to 9 (smallest). Use the benchmark_response_compression command to
+# compare levels and the response_compression_stats command to check the compression ratio of stored responses.
+RESPONSE_COMPRESSION_THRESHOLD = 1024
+RESPONSE_COMPRESSION_LEVEL = 1
+
+# Backend used to store aggregated responses (see api.response_aggregator). Use 'redis' to share responses between all
+# web server processes and Celery workers, or 'memory' to store them in the memory of the web server process. The
+# 'memory' backend avoids the round trips to Redis but can only be used with a single web server process and with the
+# 'threads' dispatch backend or without Celery in DEBUG mode (ImproperlyConfigured is raised if combined with a Celery
+# dispatch backend). In-memory responses are evicted (least recently used first) when their total size exceeds
+# RESPONSE_STORE_MEMORY_MAX_SIZE bytes.
+RESPONSE_STORE_BACKEND = 'redis'
+RESPONSE_STORE_MEMORY_MAX_SIZE = 256 * 1024 ** 2
 
 RAVEN_CONFIG = {
     'dsn': os.getenv('SENTRY_DSN', None),
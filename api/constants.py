@@ -8,4 +8,8 @@ QUERY_PARAM_OFFSET = 'offset'
 QUERY_PARAM_INCLUDE = 'include'
 QUERY_PARAM_EXCLUDE = 'exclude'
 QUERY_PARAM_WAIT_UNTIL_COMPLETE = 'wuc'
+QUERY_PARAM_TIMEOUT = 'timeout'
 QUERY_PARAM_FORMAT = 'format'
+QUERY_PARAM_WAIT = 'wait'
+QUERY_PARAM_RECEIVED = 'received'
+QUERY_PARAM_SINCE = 'since'
@@ -0,0 +1,141 @@
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from api.response_aggregator import BaseStoreBackend
+from services.acservice.constants import *
+import datetime
+import random
+import json
+import time
+
+
+WORDS = ['ambient', 'bird', 'city', 'dog', 'door', 'drum', 'electronic', 'field-recording', 'guitar', 'kick', 'loop',
+         'metal', 'nature', 'noise', 'piano', 'rain', 'river', 'snare', 'street', 'synth', 'traffic', 'voice', 'water',
+         'wind', 'wood', 'recorded', 'with', 'a', 'the', 'in', 'of', 'and', 'at', 'night', 'morning', 'close', 'far']
+LICENSES = [
+    ('BY', 'http://creativecommons.org/licenses/by/3.0/'),
+    ('CC0', 'http://creativecommons.org/publicdomain/zero/1.0/'),
+    ('BY-NC', 'http://creativecommons.org/licenses/by-nc/3.0/'),
+]
+NOTES = ['A', 'A#', 'B', 'C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#']
+
+
+def text(rand, n_words):
+    return ' '.join(rand.choice(WORDS) for _ in range(n_words))
+
+
+def common_fields(rand, service_name, domain, resource_id):
+    license, license_deed_url = rand.choice(LICENSES)
+    return {
+        FIELD_ID: '{0}:{1}'.format(service_name, resource_id),
+        FIELD_URL: 'https://{0}/resource/{1}/'.format(domain, resource_id),
+        FIELD_NAME: text(rand, rand.randint(2, 6)),
+        FIELD_AUTHOR_NAME: 'user{0}'.format(rand.randint(1, 100000)),
+        FIELD_LICENSE: license,
+        FIELD_LICENSE_DEED_URL: license_deed_url,
+        FIELD_TIMESTAMP: (datetime.datetime(2017, 1, 1) + datetime.timedelta(minutes=rand.randint(0, 10 ** 6)))
+        .strftime(AUDIOCOMMONS_STRING_TIME_FORMAT),
+        FIELD_IMAGE: 'https://{0}/images/{1}.png'.format(domain, resource_id),
+        FIELD_PREVIEW: 'https://{0}/previews/{1}.mp3'.format(domain, resource_id),
+    }
+
+
+def freesound_result(rand, resource_id):
+    result = common_fields(rand, 'Freesound', 'freesound.org', resource_id)
+    result.update({
+        FIELD_AUTHOR_URL: 'https://freesound.org/people/{0}/'.format(result[FIELD_AUTHOR_NAME]),
+        FIELD_TAGS: [rand.choice(WORDS) for _ in range(rand.randint(3, 15))],
+        FIELD_DESCRIPTION: text(rand, rand.randint(10, 80)),
+        FIELD_DURATION: round(rand.uniform(0.1, 300), 3),
+        FIELD_FILESIZE: rand.randint(10 ** 4, 10 ** 8),
+        FIELD_CHANNELS: rand.choice([1, 2]),
+        FIELD_BITRATE: rand.choice([0, 128, 320]),
+        FIELD_BITDEPTH: rand.choice([16, 24]),
+        FIELD_SAMPLERATE: rand.choice([44100, 48000]),
+        FIELD_FORMAT: rand.choice(['wav', 'mp3', 'flac']),
+        FIELD_COLLECTION_URL: 'https://freesound.org/apiv2/packs/{0}/'.format(rand.randint(1, 10 ** 5)),
+        FIELD_TEMPO: rand.randint(60, 180),
+        FIELD_TEMPO_CONFIDENCE: rand.random(),
+        FIELD_NOTE: rand.choice(NOTES) + str(rand.randint(1, 7)),
+        FIELD_NOTE_MIDI: rand.randint(20, 100),
+        FIELD_NOTE_CONFIDENCE: rand.random(),
+        FIELD_TONALITY: rand.choice(NOTES) + rand.choice([' major', ' minor']),
+        FIELD_TONALITY_CONFIDENCE: rand.random(),
+        FIELD_LOUDNESS: rand.uniform(-60, 0),
+        FIELD_LOOP: rand.choice([True, False]),
+        FIELD_SINGLE_EVENT: rand.choice([True, False]),
+    })
+    for field in [FIELD_BRIGHTNESS, FIELD_ROUGHNESS, FIELD_HARDNESS, FIELD_DEPTH, FIELD_SHARPNESS, FIELD_WARMTH,
+                  FIELD_BOOMING]:
+        result[field] = rand.uniform(0, 100)
+    return result
+
+
+def jamendo_result(rand, resource_id):
+    result = common_fields(rand, 'Jamendo', 'jamendo.com', resource_id)
+    result.update({
+        FIELD_TAGS: [rand.choice(WORDS) for _ in range(rand.randint(1, 6))],
+        FIELD_DURATION: rand.randint(60, 600),
+        FIELD_FORMAT: 'mp3',
+        FIELD_WAVEFORM_PEAKS: [rand.randint(-100, 100) for _ in range(rand.randint(500, 1000))],
+    })
+    return result
+
+
+def europeana_result(rand, resource_id):
+    result = common_fields(rand, 'Europeana', 'europeana.eu', resource_id)
+    result.update({
+        FIELD_DESCRIPTION: text(rand, rand.randint(10, 80)),
+        FIELD_COLLECTION_NAME: text(rand, 3),
+        FIELD_COLLECTION_URL: 'https://www.europeana.eu/portal/collections/{0}'.format(rand.randint(1, 1000)),
+    })
+    return result
+
+
+def search_response(rand, result_generator, size):
+    return {
+        NUM_RESULTS_PROP: rand.randint(size, 10 ** 5),
+        NEXT_PAGE_PROP: 'https://m.audiocommons.org/api/v1/search/text/?q=dog&page=2',
+        PREV_PAGE_PROP: None,
+        RESULTS_LIST: [result_generator(rand, rand.randint(1, 10 ** 6)) for _ in range(size)],
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the compression of service responses in the response store using different compression ' \
+           'levels and realistic text search responses (fields=*) from Freesound, Jamendo and Europeana.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=150, help='Number of results per service response')
+        parser.add_argument('--iterations', type=int, default=20, help='Number of times to encode/decode each '
+                                                                       'response')
+
+    def handle(self, *args, **options):
+        """
+        For each compression level (and without compression), this command reports the total stored size of the
+        responses, the time needed to serialize and compress them (done by the Celery workers when aggregating
+        responses) and the time needed to decompress and deserialize them (done when collecting responses).
+        """
+        rand = random.Random(0)
+        responses = [search_response(rand, generator, options['size'])
+                     for generator in [freesound_result, jamendo_result, europeana_result]]
+        serialized_size = sum(len(json.dumps(response).encode('utf-8')) for response in responses)
+        self.stdout.write('Serialized size of responses: {0:.1f} KB'.format(serialized_size / 1024))
+        self.stdout.write('{0:<8} {1:>12} {2:>8} {3:>12} {4:>12}'.format(
+            'Level', 'Stored KB', 'Ratio', 'Encode ms', 'Decode ms'))
+
+        for level in [None, 1, 3, 6, 9]:
+            with override_settings(RESPONSE_COMPRESSION_THRESHOLD=None if level is None else 1024,
+                                   RESPONSE_COMPRESSION_LEVEL=level):
+                start = time.time()
+                for _ in range(options['iterations']):
+                    encoded = [BaseStoreBackend.encode_value(response) for response in responses]
+                encode_time = (time.time() - start) / options['iterations']
+                start = time.time()
+                for _ in range(options['iterations']):
+                    for data in encoded:
+                        BaseStoreBackend.decode_value(data)
+                decode_time = (time.time() - start) / options['iterations']
+            stored_size = sum(len(data) for data in encoded)
+            self.stdout.write('{0:<8} {1:>12.1f} {2:>8.2f} {3:>12.2f} {4:>12.2f}'.format(
+                'none' if level is None else level, stored_size / 1024, serialized_size / stored_size,
+                encode_time * 1000, decode_time * 1000))
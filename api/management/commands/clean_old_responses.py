@@ -1,7 +1,6 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from api.response_aggregator import get_response_aggregator
-import datetime
 import logging
 
 
@@ -9,10 +8,11 @@ logger = logging.getLogger('management')
 
 
 class Command(BaseCommand):
-    help = 'Clean response objects in the store which are older than `N` days.'
+    help = 'Clean response objects in the store which are older than settings.RESPONSE_EXPIRY_TIME.'
 
     def add_arguments(self, parser):
-        pass
+        parser.add_argument('--batch-size', type=int, default=settings.RESPONSE_CLEANUP_BATCH_SIZE,
+                            help='Number of responses deleted in each batch')
 
     def handle(self, *args, **options):
         """
@@ -22,30 +22,14 @@ class Command(BaseCommand):
         consumed by clients using the /collect endpoint of the Audio Commons API. 
         
         To avoid collapsing our store with unneeded response objects, this commands deletes response objects 
-        which are older than a particular number of days. It should be run periodically.
+        which are older than settings.RESPONSE_EXPIRY_TIME. Old responses are found using the index of responses
+        of the store (without scanning all keys) and deleted in batches, and the ids of responses which already
+        expired are removed from the index. It is run periodically by Celery beat.
         
         More info: https://github.com/AudioCommons/ac-mediator/issues/8
         """
 
-        n_deleted_responses = 0
-        n_responses = 0
-        response_aggregator = get_response_aggregator()
-        store = response_aggregator.store
-
-        for key in store.get_all_response_keys():
-            response = store.get_response(key)
-            if response:
-                try:
-                    timestamp = datetime.datetime.strptime(response['meta']['sent_timestamp'], '%Y-%m-%d %H:%M:%S.%f')
-                    n_responses += 1
-                    if (datetime.datetime.now() - timestamp).total_seconds() > settings.RESPONSE_EXPIRY_TIME:
-                        store.delete_response(key)
-                        n_deleted_responses += 1
-
-                except KeyError:
-                    # If object has no timestamp information, continue with the next response
-                    # This could be because the object does not really correspond to an API response
-                    pass
-
+        store = get_response_aggregator().store
+        n_deleted_responses = store.delete_old_responses(batch_size=options['batch_size'])
         logger.info('Removed {0} responses from store (currently has {1} responses)'
-                    .format(n_deleted_responses, n_responses - n_deleted_responses))
+                    .format(n_deleted_responses, store.count_responses()))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from api.response_aggregator import get_response_aggregator
+
+
+class Command(BaseCommand):
+    help = 'Show the compression ratio of the service responses added to the response store.'
+
+    def handle(self, *args, **options):
+        """
+        Contents, warnings and errors of each service are compressed before being added to the response store
+        (see settings.RESPONSE_COMPRESSION_THRESHOLD). This command shows the total serialized and stored sizes
+        of all service responses added to the store and the resulting compression ratio.
+        """
+        stats = get_response_aggregator().store.get_compression_stats()
+        self.stdout.write('Service responses added: {0}'.format(stats['n_values']))
+        self.stdout.write('Serialized size: {0:.2f} MB'.format(stats['serialized_bytes'] / 1024 ** 2))
+        self.stdout.write('Stored size: {0:.2f} MB'.format(stats['stored_bytes'] / 1024 ** 2))
+        if stats['ratio'] is not None:
+            self.stdout.write('Compression ratio: {0:.2f}'.format(stats['ratio']))
@@ -1,20 +1,95 @@
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
 from ac_mediator.exceptions import *
 from services.acservice.constants import *
 from services.mgmt import get_available_services, get_service_by_id
-from api.response_aggregator import get_response_aggregator
+from services.concurrency import get_concurrency_limiter
+from services.circuit_breaker import get_circuit_breaker
+from services.acservice.utils import run_sync, run_async, is_service_failure
+from api.response_aggregator import get_response_aggregator, RESPONSE_STATUS_PROCESSING, RESPONSE_STATUS_FINISHED, \
+    STORE_BACKEND_MEMORY
 from celery import shared_task
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import hashlib
+import logging
+import asyncio
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
 
 response_aggregator = get_response_aggregator()
+concurrency_limiter = get_concurrency_limiter()
+circuit_breaker = get_circuit_breaker()
+
+DISPATCH_BACKEND_CELERY = 'celery'
+DISPATCH_BACKEND_CELERY_FANOUT = 'celery_fanout'
+DISPATCH_BACKEND_THREADS = 'threads'
+DISPATCH_BACKEND_SYNCHRONOUS = 'sync'
+
+
+async def request_service_async(request, service, deadline=None):
+    """
+    Call the asynchronous version of the requested service method (e.g. for a request with method 'text_search',
+    `ACServiceTextSearchMixin.text_search_async` is used) and return its response. If the service does not
+    respond before the deadline, ACAPIServiceTimeout is raised.
+    :param request: incoming request object
+    :param service: service object to which the request should be made
+    :param deadline: time (in seconds since the epoch) at which the request should be abandoned
+    :return: service response
+    """
+    if deadline is not None and deadline <= time.time():
+        # Deadline passed before the request could be made (e.g. the task was queued for too long)
+        raise ACAPIServiceTimeout
+    service_request = getattr(service, '{0}_async'.format(request['method']))(
+        request['context'], **request['kwargs'])
+    if deadline is not None:
+        service_request = asyncio.wait_for(service_request, timeout=deadline - time.time())
+    try:
+        return await service_request
+    except asyncio.TimeoutError:
+        raise ACAPIServiceTimeout
 
 
-@shared_task
-def perform_request_and_aggregate(request, response_id, service_id):
-    service = get_service_by_id(service_id)
+async def perform_request_and_aggregate_async(request, response_id, service, deadline=None):
+    """
+    Perform a request to a 3rd party service and aggregate its response (or error) in the response aggregator.
+    If enabled, the number of concurrent requests made to each service is limited (see services.concurrency).
+    Requests wait for a free slot until the deadline, after which a ACAPIServiceBusy error is aggregated (the error
+    is aggregated without waiting if, given the median latency of the service, the request can't be answered
+    before the deadline).
+    If the circuit breaker of the service is open (see services.circuit_breaker), a ACAPIServiceUnavailable
+    error is aggregated immediately.
+    :param request: incoming request object
+    :param response_id: id of the response where to aggregate the service response
+    :param service: service object to which the request should be made
+    :param deadline: time (in seconds since the epoch) at which the request should be abandoned
+    """
     try:
         print('Requesting response from {0} ({1})'.format(service.name, response_id))
-        service.clear_response_warnings()
-        service_response = getattr(service, request['method'])(request['context'], **request['kwargs'])
+        if settings.SERVICE_CIRCUIT_BREAKER_ENABLED and circuit_breaker.is_open(service.id):
+            raise ACAPIServiceUnavailable
+        lease_id = None
+        if settings.SERVICE_CONCURRENCY_LIMIT_ENABLED:
+            expected_latency = None
+            if service.latency_tracker is not None:
+                expected_latency = service.latency_tracker.get_percentile(50)
+            lease_id = await concurrency_limiter.acquire(service.id, deadline, expected_latency=expected_latency)
+        success = False
+        start_time = time.monotonic()
+        try:
+            service.clear_response_warnings()
+            service_response = await request_service_async(request, service, deadline)
+            success = time.monotonic() - start_time <= settings.SERVICE_CONCURRENCY_LATENCY_THRESHOLD
+        except Exception as e:
+            success = not is_service_failure(e)
+            raise
+        finally:
+            if lease_id is not None:
+                await concurrency_limiter.release_async(service.id, lease_id, success)
         warnings = service.collect_response_warnings()
         response_aggregator.aggregate_response(response_id, service.name, service_response, warnings=warnings)
     except (ACException, ACAPIException) as e:
@@ -22,10 +97,159 @@ def perform_request_and_aggregate(request, response_id, service_id):
         response_aggregator.aggregate_response(response_id, service.name, e)
 
 
+# NOTE: task results are not stored as completion of requests is tracked in the response aggregator. Tasks do not wait
+# for the requests to finish: these are performed in the event loop of the worker process (see
+# services.acservice.utils.ServiceEventLoop) so that a worker process (e.g. of Celery's prefork pool) can have the
+# requests of many tasks in flight at the same time.
+
+@shared_task(ignore_result=True)
+def perform_request_and_aggregate(request, response_id, service_id, deadline=None):
+    run_async(perform_request_and_aggregate_async(request, response_id, get_service_by_id(service_id), deadline))
+
+
+async def perform_requests_and_aggregate_async(request, response_id, services, deadline=None):
+    results = await asyncio.gather(*[
+        perform_request_and_aggregate_async(request, response_id, service, deadline) for service in services
+    ], return_exceptions=True)
+    for service, result in zip(services, results):
+        if isinstance(result, Exception):
+            # Log unexpected errors here so that these don't prevent other requests from being aggregated
+            logger.error('Unhandled exception requesting response from service {0} ({1})'.format(
+                service.id, response_id), exc_info=result)
+
+
+@shared_task(ignore_result=True)
+def perform_requests_and_aggregate(request, response_id, service_ids, deadline=None):
+    services = [get_service_by_id(service_id) for service_id in service_ids]
+    run_async(perform_requests_and_aggregate_async(request, response_id, services, deadline))
+
+
+def perform_request_and_aggregate_in_thread(request, response_id, service_id, deadline=None):
+    try:
+        run_sync(perform_request_and_aggregate_async(request, response_id, get_service_by_id(service_id), deadline))
+    except Exception:
+        logger.exception('Unhandled exception requesting response from service {0} ({1})'.format(
+            service_id, response_id))
+    finally:
+        # Threads of the pool do not go through Django's request/response cycle, so we need to close the
+        # database connections that might have been opened in this thread ourselves
+        connections.close_all()
+
+
+class CeleryDispatchBackend(object):
+    """
+    Dispatch backend that sends each request to a 3rd party service as an individual Celery task.
+    """
+
+    def dispatch(self, request, response_id, services, deadline=None):
+        for service in services:
+            # Requests are performed asynchronously in Celery workers
+            perform_request_and_aggregate.delay(request, response_id, service.id, deadline)
+
+
+class CeleryFanOutDispatchBackend(object):
+    """
+    Dispatch backend that sends a single Celery task for all the requests to 3rd party services. The task performs
+    the requests concurrently in the event loop of the worker process. Compared to CeleryDispatchBackend, this needs a single broker
+    publish per incoming request instead of one per service.
+    """
+
+    def dispatch(self, request, response_id, services, deadline=None):
+        perform_requests_and_aggregate.delay(request, response_id, [service.id for service in services], deadline)
+
+
+class ThreadPoolDispatchBackend(object):
+    """
+    Dispatch backend that performs requests to 3rd party services concurrently using a bounded pool of threads
+    inside the current (web server) process. This avoids broker round trips and waiting for workers to pick
+    up tasks so that the latency of an aggregated response is close to that of the slowest service.
+    """
+
+    executor = None
+    executor_pid = None
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = settings.REQUEST_DISPATCH_THREAD_POOL_SIZE
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        # The executor is created lazily and re-created if the process has been forked after its creation (e.g.
+        # by uwsgi), as threads of the parent process do not exist in the child process
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    def dispatch(self, request, response_id, services, deadline=None):
+        executor = self.get_executor()
+        for service in services:
+            executor.submit(perform_request_and_aggregate_in_thread, request, response_id, service.id, deadline)
+
+
+class SynchronousDispatchBackend(object):
+    """
+    Dispatch backend that performs requests to 3rd party services sequentially in the current process.
+    Requests have been completed once `dispatch` returns.
+    """
+
+    def dispatch(self, request, response_id, services, deadline=None):
+        for service in services:
+            run_sync(perform_request_and_aggregate_async(request, response_id, service, deadline))
+
+
+def get_dispatch_backend_class():
+    backend_name = settings.REQUEST_DISPATCH_BACKEND
+    if backend_name in [DISPATCH_BACKEND_CELERY, DISPATCH_BACKEND_CELERY_FANOUT] and settings.DEBUG \
+            and not settings.USE_CELERY_IN_DEBUG_MODE:
+        # When in debug mode AND not settings.USE_CELERY_IN_DEBUG_MODE, requests are performed synchronously
+        # in the web server
+        backend_name = DISPATCH_BACKEND_SYNCHRONOUS
+    if backend_name in [DISPATCH_BACKEND_CELERY, DISPATCH_BACKEND_CELERY_FANOUT] \
+            and settings.RESPONSE_STORE_BACKEND == STORE_BACKEND_MEMORY:
+        # Celery workers would aggregate the responses in their own memory, where the web server can't collect them
+        raise ImproperlyConfigured('The \'{0}\' response store backend can not be used with the \'{1}\' dispatch '
+                                   'backend'.format(STORE_BACKEND_MEMORY, backend_name))
+    return {
+        DISPATCH_BACKEND_CELERY: CeleryDispatchBackend,
+        DISPATCH_BACKEND_CELERY_FANOUT: CeleryFanOutDispatchBackend,
+        DISPATCH_BACKEND_THREADS: ThreadPoolDispatchBackend,
+        DISPATCH_BACKEND_SYNCHRONOUS: SynchronousDispatchBackend,
+    }[backend_name]
+
+
+def get_request_coalescing_key(request, services, timeout):
+    """
+    Return a key that identifies requests which produce the same aggregated response, i.e. requests for the
+    same component and method, with the same arguments, response format and timeout, and sent to the same services.
+    User information from the request context is not part of the key.
+    :param request: incoming request object
+    :param services: services to which the request is sent
+    :param timeout: maximum number of seconds given to services to respond
+    :return: key string
+    """
+    canonical_request = json.dumps({
+        'component': request['component'],
+        'method': request['method'],
+        'kwargs': request['kwargs'],
+        'format': request['context']['format'],
+        'services': sorted([service.id for service in services]),
+        'timeout': timeout,
+    }, sort_keys=True)
+    return hashlib.sha1(canonical_request.encode('utf-8')).hexdigest()
+
+
 class RequestDistributor(object):
 
-    @staticmethod
-    def process_request(request, wait_until_complete=False, include=None, exclude=None, acid_domain=None):
+    def __init__(self, dispatch_backend=None):
+        if dispatch_backend is None:
+            dispatch_backend = get_dispatch_backend_class()
+        self.dispatch_backend = dispatch_backend()
+
+    def process_request(self, request, wait_until_complete=False, timeout=None, include=None, exclude=None,
+                        acid_domain=None, coalesce=False):
         """
         Process incoming request, and propagate it to corresponding services.
         Requests to 3rd party services are made asynchronously. We send requests to all 3rd
@@ -35,75 +259,92 @@ class RequestDistributor(object):
         return a response right after all requests have been sent. This response will mainly
         include a response_id parameter that can be later used to pull the actual responses
         from the 3rd party services (see ResponseAggregator.collect_response).
-        If wait_until_complete is set to False, then this method will wait untill a response is
-        received for all requests and only then will return an aggregated response including the
-        contents of all 3rd party services individual responses.
+        If wait_until_complete is set to True, then this method will wait untill a response is
+        received for all requests (or until `timeout` seconds have passed) and only then will return
+        an aggregated response including the contents of all 3rd party services individual responses.
+        In both modes, services that have not responded after `timeout` seconds are marked as timed out
+        and the aggregated response is set to finished (see ResponseAggregator.finalize_expired_response).
+        If coalesce is set to True, identical requests received within settings.REQUEST_COALESCING_WINDOW
+        seconds share the same aggregated response instead of sending new requests to the services. This
+        should only be used for requests whose results do not depend on the end user (i.e. requests made to
+        3rd party services using API key authentication). Coalesced responses are not deleted when collected
+        (see settings.DELETE_RESPONSES_AFTER_CONSUMED) as other clients might still be collecting them.
 
         :param request: incoming request object
         :param wait_until_complete: whether to return immediately after all requests are sent or wait untill all responses are received
+        :param timeout: maximum number of seconds given to services to respond (defaults to settings.DEFAULT_REQUEST_TIMEOUT)
         :param include: list of service names to include when getting available services
         :param include: list of service names to exclude when getting available services
         :param acid_domain: domain of Audio Commons Unique Identifiers to be considered for matching available services
+        :param coalesce: whether to reuse the aggregated response of an identical request made recently
         :return: dictionary with response (as returned by ResponseAggregator.collect_response)
         """
 
-        # Get available services for the given component (e.g. services that do `text search')
-        services = get_available_services(component=request['component'], include=include, exclude=exclude)
-
-        # Filter by ACID domain (e.g. select only services that support the requested ACID domain)
-        if acid_domain is not None:
-            services = [
-                service for service in services if
-                acid_domain in service.get_service_description()[request['component']].get(
-                    ACID_DOMAINS_DESCRIPTION_KEYWORD, list())
-            ]
+        # Get available services for the given component (e.g. services that do `text search') and, if given,
+        # ACID domain (e.g. select only services that support the requested ACID domain)
+        services = get_available_services(
+            component=request['component'], include=include, exclude=exclude, acid_domain=acid_domain)
 
         if not services:
             # If no services have been found for the requested component or combination of component
             # and acid domain, we raise an exception
             raise ACAPINoServiceAvailable
 
-        # Create object to store responses from services
-        response_id = response_aggregator.create_response(len(services))
-        if not services:
-            # No services will be queries, response can be set to finished
-            response_aggregator.set_response_to_finished(response_id)
-        else:
-            response_aggregator.set_response_to_processing(response_id)
-
-        if not settings.DEBUG or settings.USE_CELERY_IN_DEBUG_MODE:
-            # Iterate over services, perform requests and aggregate responses
-            async_response_objects = list()
-            for service in services:
-                # Requests are performed asynchronously in Celery workers
-                async_response_objects.append(
-                    perform_request_and_aggregate.delay(request, response_id, service.id)
-                )
-
-            # Wait until all responses are received (only if wait_until_complete == True)
-            if wait_until_complete:
-                # We wait until we get a response for all the requests we sent
-                # We do that by continuously iterating over all async_response_objetcs in a while
-                # loop and only exit when all of them have been flagged as ready
-                # TODO: we should add some control over timeouts, etc as this operation is blocking
-                while True:
-                    if all([item.ready() for item in async_response_objects]):
-                        break
-        else:
-            # When in debug mode AND not settings.USE_CELERY_IN_DEBUG_MODE
-            # wait_until_complete is ignored as web server does not do the requests asynchronously
-            async_response_objects = list()
-            for service in services:
-                # Requests are performed synchronously in the web server
-                async_response_objects.append(
-                    perform_request_and_aggregate(request, response_id, service.id)
-                )
+        # Set the deadline after which services that have not responded are considered to have timed out
+        if timeout is None:
+            timeout = settings.DEFAULT_REQUEST_TIMEOUT
+        deadline = time.time() + timeout
+
+        # Create the response and send requests to the services (if coalescing, the response of an identical
+        # request is reused instead)
+        coalescing_key = None
+        if coalesce and settings.REQUEST_COALESCING_WINDOW:
+            coalescing_key = get_request_coalescing_key(request, services, timeout)
+        response_id = self.create_response_and_dispatch(request, services, deadline, coalescing_key)
+
+        # Wait until all responses are received (only if wait_until_complete == True)
+        if wait_until_complete:
+            # We block until the response aggregator notifies that a response has been received for all
+            # the requests we sent, or until the deadline passes. In the latter case the response returned
+            # below will include the responses aggregated so far and timeout errors for the other services.
+            # If requests were performed synchronously the response is already finished and this returns
+            # immediately.
+            response_aggregator.wait_until_finished(response_id, max(0, deadline - time.time()))
 
         # Return object including responses received so far (if wait_until_complete == False the
         # response returned here will almost only contain the response_id field which can be later
         # used to retrieve further responses.
         return response_aggregator.collect_response(response_id, format=request['context']['format'])
 
+    def create_response_and_dispatch(self, request, services, deadline, coalescing_key=None):
+        """
+        Create the aggregated response for a request and send requests to the services.
+        :param request: incoming request object
+        :param services: services to which the request should be sent
+        :param deadline: time (in seconds since the epoch) after which services are considered to have timed out
+        :param coalescing_key: if provided, reuse the response of an identical request associated to this key (if
+        any) or associate the new response to it (see get_request_coalescing_key)
+        :return: id of the aggregated response
+        """
+
+        # Create object to store responses from services. The response is directly created in processing status
+        # (or finished if no services will be queried)
+        status = RESPONSE_STATUS_PROCESSING if services else RESPONSE_STATUS_FINISHED
+        expected_services = [service.name for service in services]
+        if coalescing_key is not None:
+            response_id, created = response_aggregator.create_coalesced_response(
+                coalescing_key, len(services), expected_services=expected_services, deadline=deadline, status=status)
+            if not created:
+                # An identical request has been processed recently, use its response instead
+                return response_id
+        else:
+            response_id = response_aggregator.create_response(
+                len(services), expected_services=expected_services, deadline=deadline, status=status)
+
+        # Send requests to the services using the configured dispatch backend (see settings.REQUEST_DISPATCH_BACKEND)
+        self.dispatch_backend.dispatch(request, response_id, services, deadline=deadline)
+        return response_id
+
 
 request_distributor = RequestDistributor()
 
@@ -1,10 +1,19 @@
 import uuid
 import redis
 import json
+import math
+import time
+import zlib
+import queue
 import datetime
+import threading
+from collections import OrderedDict, defaultdict
 from ac_mediator.exceptions import *
 from django.conf import settings
 from django.urls import reverse
+from utils.redis_client import get_redis_client
+from services.acservice.constants import RESULTS_LIST
+from rest_framework.utils.encoders import JSONEncoder
 
 
 RESPONSE_STATUS_FINISHED = 'FI'
@@ -12,50 +21,1015 @@ RESPONSE_STATUS_PROCESSING = 'PR'
 RESPONSE_STATUS_NEW = 'NEW'
 
 
-class RedisStoreBackend(object):
+# NOTE: responses are stored in the 'response:<response id>' key (see RedisStoreBackend.get_response_key).
+# Scripts that update a response publish a message in the 'response:<response id>:updates' channel so that clients
+# waiting for the response to change are woken up (see RedisStoreBackend.subscribe_response_updates). Messages are
+# 'service:<service name>' when the response of a service is added and 'status:<status>' when the status changes.
+# These scripts also increase the version of the response, and store the version at which the response of each
+# service is added in the 'version:<service name>' field (see ResponseAggregator.collect_response).
+
+# Add the contents (or error) and warnings of a service to a response and increase the number of received responses.
+# Responses from services that have already been added (e.g. after being marked as timed out) are ignored.
+# The serialized and stored (compressed) sizes of the added data are added to the compression stats (KEYS[2]).
+# When the response is finished, its expiry time is set to ARGV[8] seconds.
+# Returns -1 if the response does not exist, 0 if ignored, 1 if added and 2 if added and the response is finished.
+AGGREGATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if redis.call('HEXISTS', KEYS[1], 'contents:' .. ARGV[1]) == 1 or
+        redis.call('HEXISTS', KEYS[1], 'errors:' .. ARGV[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[2] .. ':' .. ARGV[1], ARGV[3])
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[1], 'warnings:' .. ARGV[1], ARGV[4])
+end
+redis.call('HSET', KEYS[1], 'version:' .. ARGV[1], redis.call('HINCRBY', KEYS[1], 'version', 1))
+redis.call('HINCRBY', KEYS[2], 'n_values', 1)
+redis.call('HINCRBY', KEYS[2], 'serialized_bytes', ARGV[6])
+redis.call('HINCRBY', KEYS[2], 'stored_bytes', ARGV[7])
+local n_received_responses = redis.call('HINCRBY', KEYS[1], 'n_received_responses', 1)
+redis.call('PUBLISH', KEYS[1] .. ':updates', 'service:' .. ARGV[1])
+if n_received_responses >= tonumber(redis.call('HGET', KEYS[1], 'n_expected_responses')) then
+    redis.call('HSET', KEYS[1], 'status', ARGV[5])
+    redis.call('EXPIRE', KEYS[1], ARGV[8])
+    redis.call('PUBLISH', KEYS[1] .. ':updates', 'status:' .. ARGV[5])
+    return 2
+end
+return 1
+"""
+
+# If the deadline of the response has passed and it is not finished, add the given error for all expected services
+# that have not responded and set the response to finished (with an expiry time of finished_expiry seconds).
+# Returns -1 if the response does not exist, 0 if it was
+# not finalized and 2 if it was finalized.
+FINALIZE_EXPIRED_FUNCTION = """
+local function finalize_expired(key, now, error, finished_status, finished_expiry)
+    if redis.call('EXISTS', key) == 0 then
+        return -1
+    end
+    if redis.call('HGET', key, 'status') == finished_status then
+        return 0
+    end
+    local meta = cjson.decode(redis.call('HGET', key, 'meta'))
+    if type(meta['deadline']) ~= 'number' or meta['deadline'] > tonumber(now) then
+        return 0
+    end
+    local version = redis.call('HINCRBY', key, 'version', 1)
+    for _, service_name in ipairs(meta['expected_services']) do
+        if redis.call('HEXISTS', key, 'contents:' .. service_name) == 0 and
+                redis.call('HEXISTS', key, 'errors:' .. service_name) == 0 then
+            redis.call('HSET', key, 'errors:' .. service_name, error)
+            redis.call('HSET', key, 'version:' .. service_name, version)
+        end
+    end
+    redis.call('HSET', key, 'n_received_responses', redis.call('HGET', key, 'n_expected_responses'))
+    redis.call('HSET', key, 'status', finished_status)
+    redis.call('EXPIRE', key, finished_expiry)
+    redis.call('PUBLISH', key .. ':updates', 'status:' .. finished_status)
+    return 2
+end
+"""
+
+FINALIZE_EXPIRED_SCRIPT = FINALIZE_EXPIRED_FUNCTION + """
+return finalize_expired(KEYS[1], ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+"""
+
+# Finalize the response if its deadline has passed (see FINALIZE_EXPIRED_FUNCTION) and get all its fields. If the
+# response is finished and ARGV[4] is '1', delete it (together with its list of finished notifications and its entry
+# in the index of responses KEYS[2], where it is stored as ARGV[5]) unless it is shared by coalesced requests.
+# Otherwise, if the response is finished and has some contents, make sure it does not expire in less than ARGV[7]
+# seconds as clients are still collecting it. Returns the result of finalize_expired and the
+# fields of the response.
+COLLECT_SCRIPT = FINALIZE_EXPIRED_FUNCTION + """
+local finalized = finalize_expired(KEYS[1], ARGV[1], ARGV[2], ARGV[3], ARGV[6])
+local fields = redis.call('HGETALL', KEYS[1])
+if redis.call('HGET', KEYS[1], 'status') == ARGV[3] then
+    if ARGV[4] == '1' and redis.call('HEXISTS', KEYS[1], 'coalesced') == 0 then
+        redis.call('DEL', KEYS[1], KEYS[1] .. ':finished')
+        redis.call('ZREM', KEYS[2], ARGV[5])
+    elseif redis.call('TTL', KEYS[1]) < tonumber(ARGV[7]) then
+        for i = 1, #fields, 2 do
+            if string.sub(fields[i], 1, 9) == 'contents:' then
+                redis.call('EXPIRE', KEYS[1], ARGV[7])
+                break
+            end
+        end
+    end
+end
+return {finalized, fields}
+"""
+
+# Create a response hash (KEYS[1]) with the given fields (ARGV[5]...) and expiry time (ARGV[1]), and add its id
+# (ARGV[4]) to the index of responses (KEYS[2]) with its creation time (ARGV[3]) as score. If a coalescing key is
+# given (KEYS[3]) and it points to an existing response, nothing is created and the key of that response is returned.
+# Otherwise the coalescing key is set to point to the new response for ARGV[2] seconds.
+CREATE_SCRIPT = """
+if #KEYS > 2 then
+    local existing_response_key = redis.call('GET', KEYS[3])
+    if existing_response_key and redis.call('EXISTS', existing_response_key) == 1 then
+        return existing_response_key
+    end
+    redis.call('SET', KEYS[3], KEYS[1], 'EX', ARGV[2])
+end
+redis.call('HMSET', KEYS[1], unpack(ARGV, 5))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+return false
+"""
+
+# Set the status of a response (if it exists) and, if given, its expiry time (ARGV[2])
+SET_STATUS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'status', ARGV[1])
+    if ARGV[2] ~= '' then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    redis.call('HINCRBY', KEYS[1], 'version', 1)
+    redis.call('PUBLISH', KEYS[1] .. ':updates', 'status:' .. ARGV[1])
+end
+"""
+
+RESPONSE_SECTIONS = ['contents', 'warnings', 'errors']
+
+# Prefix of the keys of responses in redis (see RedisStoreBackend)
+RESPONSE_KEY_PREFIX = 'response:'
+
+# Values are stored as compact JSON so that they can be spliced as they are in collected responses (see
+# ResponseAggregator.serialize_response)
+JSON_SEPARATORS = (',', ':')
+
+# Prefix of compressed values in the response store (uncompressed values are stored as plain json)
+COMPRESSED_VALUE_PREFIX = b'zlib:'
+
+
+def serialize_error(exception):
+    return {
+        'status_code': exception.status,
+        'type': exception.__class__.__name__,
+        'detail': exception.msg,
+    }
+
+
+class BaseStoreBackend(object):
     """
-    Redis-bases backend for storing current (ongoing) responses. See ResponseAggregator for more info.
+    Base class for the backends used to store current (ongoing) responses. See ResponseAggregator for more info.
+    Store backends implement the following methods (see RedisStoreBackend for their documentation): new_response,
+    get_response, set_response_status, add_service_response, finalize_expired_response, collect_response,
+    delete_response, get_all_response_ids, count_responses, delete_old_responses, subscribe_response_updates,
+    get_service_response, get_compression_stats, notify_response_finished and wait_response_finished.
+    The contents, warnings and errors of each service are stored serialized (see BaseStoreBackend.encode_value).
     """
 
-    r = None
+    @staticmethod
+    def compress_value(data):
+        """
+        Compress serialized data with zlib if it is larger than settings.RESPONSE_COMPRESSION_THRESHOLD bytes.
+        Compressed data is prefixed with COMPRESSED_VALUE_PREFIX so that it can be told apart from uncompressed data.
+        :param data: serialized value (bytes)
+        :return: data to store (bytes)
+        """
+        if settings.RESPONSE_COMPRESSION_THRESHOLD is not None and len(data) > settings.RESPONSE_COMPRESSION_THRESHOLD:
+            return COMPRESSED_VALUE_PREFIX + zlib.compress(data, settings.RESPONSE_COMPRESSION_LEVEL)
+        return data
+
+    @staticmethod
+    def get_initial_expiry_time(status, deadline):
+        """
+        Get the number of seconds a new response is kept in the store. Responses being processed are kept until
+        their deadline (or settings.MAX_REQUEST_TIMEOUT if they have none) plus
+        settings.RESPONSE_FINISHED_EXPIRY_TIME, as once their deadline passes they are finalized. Finished
+        responses are kept settings.RESPONSE_FINISHED_EXPIRY_TIME seconds (and longer if they are collected, see
+        settings.RESPONSE_COLLECTED_EXPIRY_TIME).
+        :param status: initial status of the response
+        :param deadline: deadline of the response (or None)
+        :return: expiry time in seconds
+        """
+        if status == RESPONSE_STATUS_FINISHED:
+            return settings.RESPONSE_FINISHED_EXPIRY_TIME
+        time_to_deadline = settings.MAX_REQUEST_TIMEOUT if deadline is None else max(0, deadline - time.time())
+        return int(math.ceil(time_to_deadline)) + settings.RESPONSE_FINISHED_EXPIRY_TIME
+
+    @staticmethod
+    def truncate_contents(contents, max_size):
+        """
+        Remove results from the end of the results list of the contents returned by a service so that its
+        serialized size does not exceed `max_size` bytes.
+        :param contents: contents returned by a service
+        :param max_size: maximum serialized size (in bytes)
+        :return: truncated contents (or None if contents have no results list and can't be truncated)
+        """
+        if not isinstance(contents, dict) or not isinstance(contents.get(RESULTS_LIST, None), list):
+            return None
+        truncated_contents = contents.copy()
+        truncated_contents[RESULTS_LIST] = list()
+        size = len(json.dumps(truncated_contents, separators=JSON_SEPARATORS).encode('utf-8'))
+        for result in contents[RESULTS_LIST]:
+            # NOTE: 1 is added for the ',' separator between results
+            size += len(json.dumps(result, separators=JSON_SEPARATORS).encode('utf-8')) + 1
+            if size > max_size:
+                break
+            truncated_contents[RESULTS_LIST].append(result)
+        return truncated_contents
+
+    @staticmethod
+    def serialize_service_response(section, value, warnings=None):
+        """
+        Serialize (and compress, see BaseStoreBackend.compress_value) the contents (or error) and warnings returned
+        by a service. Contents larger than settings.RESPONSE_MAX_SERVICE_CONTENTS_SIZE are truncated (see
+        BaseStoreBackend.truncate_contents) and a warning is added. Contents that can't be truncated are replaced
+        by an error.
+        :param section: 'contents' or 'errors'
+        :param value: contents or error returned by the service
+        :param warnings: list of warnings returned by the service
+        :return: tuple with the section where the response should be added, the data of the contents (or error),
+        the data of the warnings (empty if no warnings) and the total serialized size of the response
+        """
+        data = json.dumps(value, separators=JSON_SEPARATORS).encode('utf-8')
+        max_size = settings.RESPONSE_MAX_SERVICE_CONTENTS_SIZE
+        if section == 'contents' and max_size is not None and len(data) > max_size:
+            truncated_value = BaseStoreBackend.truncate_contents(value, max_size)
+            if truncated_value is not None:
+                warnings = (warnings or list()) + ['Response is too large, only the first {0} of {1} results have '
+                                                   'been included.'.format(len(truncated_value[RESULTS_LIST]),
+                                                                          len(value[RESULTS_LIST]))]
+                data = json.dumps(truncated_value, separators=JSON_SEPARATORS).encode('utf-8')
+            else:
+                section = 'errors'
+                data = json.dumps(serialize_error(ACAPIServiceResponseTooLarge()),
+                                  separators=JSON_SEPARATORS).encode('utf-8')
+        warnings_data = json.dumps(warnings, separators=JSON_SEPARATORS).encode('utf-8') if warnings else b''
+        serialized_size = len(data) + len(warnings_data)
+        return section, BaseStoreBackend.compress_value(data), BaseStoreBackend.compress_value(warnings_data), \
+            serialized_size
+
+    @staticmethod
+    def encode_value(value):
+        """
+        Serialize (and compress if needed, see BaseStoreBackend.compress_value) a value to be stored in a response.
+        :param value: value to serialize
+        :return: data to store (bytes)
+        """
+        return BaseStoreBackend.compress_value(json.dumps(value, separators=JSON_SEPARATORS).encode('utf-8'))
+
+    @staticmethod
+    def decompress_value(data):
+        """
+        Decompress a value serialized with BaseStoreBackend.encode_value without deserializing it.
+        :param data: serialized value (bytes)
+        :return: JSON encoded value (bytes)
+        """
+        if data.startswith(COMPRESSED_VALUE_PREFIX):
+            return zlib.decompress(data[len(COMPRESSED_VALUE_PREFIX):])
+        return data
+
+    @staticmethod
+    def decode_value(data):
+        """
+        Deserialize a value serialized with BaseStoreBackend.encode_value (or stored before compression was used).
+        :param data: serialized value (bytes)
+        :return: deserialized value
+        """
+        return json.loads(BaseStoreBackend.decompress_value(data).decode('utf-8'))
+
+    def wait_response_changed(self, response_id, is_changed, timeout):
+        """
+        Block until the response is updated (a service response is aggregated, its status changes...) or until
+        `timeout` seconds have passed. The response is not polled, the
+        waiting process is woken up by the updates of the response (see subscribe_response_updates).
+        :param response_id: id of the response to wait for
+        :param is_changed: function called once subscribed to the updates of the response which should return
+        True if the response has already changed (so there is no need to wait)
+        :param timeout: maximum number of seconds to wait
+        :return: True if the response changed, False if timeout expired
+        """
+        subscription = self.subscribe_response_updates(response_id)
+        try:
+            # Check for changes only after subscribing so that updates made in between are not missed
+            if is_changed():
+                return True
+            return subscription.get_update(timeout) is not None
+        finally:
+            subscription.close()
+
+
+class RedisResponseSubscription(object):
+    """
+    Subscription to the updates of a response (see RedisStoreBackend.subscribe_response_updates).
+    """
+
+    def __init__(self, r, channel):
+        self.pubsub = r.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get_update(self, timeout):
+        """
+        Block until an update is published or until `timeout` seconds have passed.
+        :param timeout: maximum number of seconds to wait
+        :return: published message (or None if timeout expired)
+        """
+        end_time = time.time() + timeout
+        while time.time() < end_time:
+            message = self.pubsub.get_message(timeout=end_time - time.time())
+            if message is not None:
+                return message['data'].decode('utf-8')
+        return None
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisStoreBackend(BaseStoreBackend):
+    """
+    Redis-bases backend for storing current (ongoing) responses. See ResponseAggregator for more info.
+    Each response is stored in a hash with the following fields:
+     * status, n_expected_responses and n_received_responses: updated atomically as responses are received
+     * version: increased every time the response is updated
+     * meta: json encoded dictionary with the rest of the meta information of the response
+     * contents:<service name>, warnings:<service name> and errors:<service name>: json encoded contents,
+       warnings and errors returned by each service. Values larger than settings.RESPONSE_COMPRESSION_THRESHOLD
+       are compressed (see BaseStoreBackend.encode_value)
+     * version:<service name>: version of the response at which the response of each service was added
+     * coalesced: only present in responses shared by coalesced requests (see RedisStoreBackend.new_response)
+    In this way, each service response is written (and serialized) only once and concurrent updates from
+    different services don't interfere with each other.
+    Response hashes are stored under the 'response:' prefix and the ids of all responses are kept in a sorted set
+    (ordered by creation time) so that old responses can be cleaned without scanning the whole keyspace (see
+    RedisStoreBackend.delete_old_responses).
+    Operations which need several commands (creating a response, collecting and deleting it...) are run as Lua
+    scripts so that they are atomic and only need one round-trip to redis.
+    """
 
     def __init__(self):
-        self.r = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0)
+        self.aggregate_script = self.r.register_script(AGGREGATE_SCRIPT)
+        self.finalize_expired_script = self.r.register_script(FINALIZE_EXPIRED_SCRIPT)
+        self.collect_script = self.r.register_script(COLLECT_SCRIPT)
+        self.create_script = self.r.register_script(CREATE_SCRIPT)
+        self.set_status_script = self.r.register_script(SET_STATUS_SCRIPT)
+
+    @property
+    def r(self):
+        # The client is shared by the whole process and re-created after forks (see utils.redis_client)
+        return get_redis_client()
+
+    @staticmethod
+    def get_response_key(response_id):
+        # NOTE: the keys of other data associated to the response (e.g. updates channel) are derived from this key
+        return '{0}{1}'.format(RESPONSE_KEY_PREFIX, response_id)
+
+    @staticmethod
+    def get_response_index_key():
+        return 'response_store:index'
+
+    @staticmethod
+    def get_coalescing_key(request_key):
+        return 'coalesce:{0}'.format(request_key)
 
-    def new_response(self, init_response_contents):
+    @staticmethod
+    def get_compression_stats_key():
+        return 'response_store:compression'
+
+    def new_response(self, init_response_contents, coalescing_key=None):
+        """
+        Create a new response in the store.
+        :param init_response_contents: response dictionary with the initial contents of the response
+        :param coalescing_key: if provided, and an existing response is associated to this key, the existing
+        response is used instead of creating a new one. Otherwise the new response is associated to the key for
+        settings.REQUEST_COALESCING_WINDOW seconds.
+        :return: tuple with the id of the response and whether it was created
+        """
         response_id = uuid.uuid4()
-        self.r.set(response_id, json.dumps(init_response_contents), ex=settings.RESPONSE_EXPIRY_TIME)
-        return response_id
+        meta = init_response_contents['meta'].copy()
+        fields = {
+            'status': meta.pop('status'),
+            'n_expected_responses': meta.pop('n_expected_responses'),
+            'n_received_responses': meta.pop('n_received_responses'),
+            'version': 0,
+            'meta': json.dumps(meta),
+        }
+        for section in RESPONSE_SECTIONS:
+            for service_name, value in init_response_contents[section].items():
+                fields['{0}:{1}'.format(section, service_name)] = self.encode_value(value)
+        keys = [self.get_response_key(response_id), self.get_response_index_key()]
+        if coalescing_key is not None:
+            keys.append(self.get_coalescing_key(coalescing_key))
+            fields['coalesced'] = 1  # Coalesced responses are not deleted when collected (see COLLECT_SCRIPT)
+        args = [self.get_initial_expiry_time(fields['status'], meta.get('deadline', None)),
+                settings.REQUEST_COALESCING_WINDOW, time.time(), response_id]
+        for field, value in fields.items():
+            args += [field, value]
+        existing_response_key = self.create_script(keys=keys, args=args, client=self.r)
+        if existing_response_key is not None:
+            return existing_response_key.decode('utf-8')[len(RESPONSE_KEY_PREFIX):], False
+        return response_id, True
+
+    @staticmethod
+    def load_response(fields, since=None, decode=True):
+        """
+        Build a response dictionary from the fields of a response hash (see RedisStoreBackend).
+        :param fields: dictionary with the fields of the hash (as returned by HGETALL)
+        :param since: if provided, only include the responses of services added after this version
+        :param decode: if False, the contents, warnings and errors of services are returned JSON encoded (bytes)
+        :return: response dictionary (or None if fields do not correspond to a response)
+        """
+        if not fields:
+            return None
+        try:
+            fields = {key.decode('utf-8'): value for key, value in fields.items()}
+            response = {
+                'meta': json.loads(fields['meta'].decode('utf-8')),
+                'contents': dict(),
+                'warnings': dict(),
+                'errors': dict(),
+            }
+            response['meta'].update({
+                'status': fields['status'].decode('utf-8'),
+                'n_expected_responses': int(fields['n_expected_responses']),
+                'n_received_responses': int(fields['n_received_responses']),
+                'version': int(fields.get('version', 0)),
+            })
+            for key, value in fields.items():
+                section, _, service_name = key.partition(':')
+                if section in RESPONSE_SECTIONS and service_name:
+                    if since is not None and int(fields.get('version:' + service_name, 0)) <= since:
+                        # Response of the service already seen by the client, skip it (without decoding it)
+                        continue
+                    response[section][service_name] = BaseStoreBackend.decode_value(value) if decode \
+                        else BaseStoreBackend.decompress_value(value)
+        except (KeyError, ValueError, zlib.error):
+            # Can happen if we're trying to get a response from a key whose contents are not from an API response (or
+            # whose compressed values are corrupted)
+            return None
+        return response
 
     def get_response(self, response_id):
         try:
-            response = self.r.get(response_id)
+            fields = self.r.hgetall(self.get_response_key(response_id))
         except redis.exceptions.ResponseError:
             # Can happen if we're trying to get a response from a key whose contents are not from an API response
             return None
-        if response is None:
-            return None
+        return self.load_response(fields)
+
+    def set_response_status(self, response_id, status):
+        expiry_time = settings.RESPONSE_FINISHED_EXPIRY_TIME if status == RESPONSE_STATUS_FINISHED else ''
+        self.set_status_script(keys=[self.get_response_key(response_id)], args=[status, expiry_time], client=self.r)
+
+    def add_service_response(self, response_id, service_name, section, value, warnings=None):
+        """
+        Add the contents (or error) returned by a service to a response.
+        :param response_id: id of the response
+        :param service_name: name of the service
+        :param section: 'contents' or 'errors'
+        :param value: contents or error to add
+        :param warnings: list of warnings returned by the service
+        :return: True if the response has been finished (all expected responses received), False otherwise
+        """
+        section, data, warnings_data, serialized_size = self.serialize_service_response(section, value, warnings)
+        result = self.aggregate_script(
+            keys=[self.get_response_key(response_id), self.get_compression_stats_key()],
+            args=[service_name, section, data, warnings_data, RESPONSE_STATUS_FINISHED,
+                  serialized_size, len(data) + len(warnings_data), settings.RESPONSE_FINISHED_EXPIRY_TIME],
+            client=self.r)
+        return result == 2
+
+    def finalize_expired_response(self, response_id, error):
+        """
+        If the deadline of the response has passed and it is not finished, add `error` for the services that have
+        not responded and set the response to finished.
+        :param response_id: id of the response
+        :param error: error to add for the services that have not responded
+        :return: True if the response has been finalized, False otherwise
+        """
+        result = self.finalize_expired_script(
+            keys=[self.get_response_key(response_id)],
+            args=[time.time(), self.encode_value(error), RESPONSE_STATUS_FINISHED,
+                  settings.RESPONSE_FINISHED_EXPIRY_TIME],
+            client=self.r)
+        return result == 2
+
+    def collect_response(self, response_id, error, delete_if_finished=False, since=None, decode=True):
+        """
+        Get a response, finalizing it first if its deadline has passed (see `finalize_expired_response`), and delete
+        it if it is finished and `delete_if_finished` is set. Finished responses with contents which are collected
+        are kept for at least settings.RESPONSE_COLLECTED_EXPIRY_TIME more seconds.
+        :param response_id: id of the response
+        :param error: error to add for the services that have not responded if the response is finalized
+        :param delete_if_finished: whether to delete the response if it is finished (responses shared by coalesced
+        requests are never deleted as other clients might still be collecting them)
+        :param since: if provided, only include the responses of services added after this version
+        :param decode: if False, the contents, warnings and errors of services are returned JSON encoded (bytes)
+        :return: tuple with the response dictionary (or None if it does not exist) and whether it was finalized
+        """
         try:
-            return json.loads(response.decode("utf-8"))
-        except json.decoder.JSONDecodeError:
+            finalized, fields = self.collect_script(
+                keys=[self.get_response_key(response_id), self.get_response_index_key()],
+                args=[time.time(), self.encode_value(error), RESPONSE_STATUS_FINISHED,
+                      1 if delete_if_finished else 0, response_id, settings.RESPONSE_FINISHED_EXPIRY_TIME,
+                      settings.RESPONSE_COLLECTED_EXPIRY_TIME],
+                client=self.r)
+        except redis.exceptions.ResponseError:
             # Can happen if we're trying to get a response from a key whose contents are not from an API response
+            return None, False
+        return self.load_response(dict(zip(fields[::2], fields[1::2])), since=since, decode=decode), finalized == 2
+
+    def delete_response(self, response_id):
+        pipe = self.r.pipeline()
+        pipe.delete(self.get_response_key(response_id), self.get_response_finished_key(response_id))
+        pipe.zrem(self.get_response_index_key(), response_id)
+        pipe.execute()
+
+    def get_all_response_ids(self):
+        """
+        Iterate over the ids of all responses in the index of responses. The index is read incrementally (ZSCAN)
+        so that redis is not blocked, and it can include responses which have already expired.
+        :return: iterator of response ids
+        """
+        for response_id, _ in self.r.zscan_iter(self.get_response_index_key()):
+            yield response_id.decode('utf-8')
+
+    def count_responses(self):
+        return self.r.zcard(self.get_response_index_key())
+
+    def delete_old_responses(self, batch_size):
+        """
+        Delete the responses created more than settings.RESPONSE_EXPIRY_TIME seconds ago and remove them from
+        the index of responses. Responses are taken from the index in batches of `batch_size` (oldest first) and
+        each batch is deleted in a single round-trip, so redis is never blocked for long regardless of the
+        number of stored keys. Response hashes expire by themselves (most of them long before
+        settings.RESPONSE_EXPIRY_TIME, see settings.RESPONSE_FINISHED_EXPIRY_TIME), so the whole index is then
+        scanned in batches to also remove the ids of responses which no longer exist.
+        :param batch_size: number of responses deleted (or checked) in each batch
+        :return: number of deleted responses (including the ids of expired responses removed from the index)
+        """
+        max_creation_time = time.time() - settings.RESPONSE_EXPIRY_TIME
+        n_deleted_responses = 0
+        while True:
+            response_ids = self.r.zrangebyscore(
+                self.get_response_index_key(), '-inf', max_creation_time, start=0, num=batch_size)
+            if not response_ids:
+                break
+            pipe = self.r.pipeline()
+            for response_id in response_ids:
+                response_id = response_id.decode('utf-8')
+                pipe.delete(self.get_response_key(response_id), self.get_response_finished_key(response_id))
+            pipe.zrem(self.get_response_index_key(), *response_ids)
+            pipe.execute()
+            n_deleted_responses += len(response_ids)
+
+        response_ids = []
+        for response_id, _ in self.r.zscan_iter(self.get_response_index_key(), count=batch_size):
+            response_ids.append(response_id)
+            if len(response_ids) == batch_size:
+                n_deleted_responses += self.remove_expired_responses_from_index(response_ids)
+                response_ids = []
+        if response_ids:
+            n_deleted_responses += self.remove_expired_responses_from_index(response_ids)
+        return n_deleted_responses
+
+    def remove_expired_responses_from_index(self, response_ids):
+        """
+        Remove from the index of responses the ids of the given responses which no longer exist (e.g. because they
+        expired), also deleting their lists of finished notifications.
+        :param response_ids: ids of the responses to check (as stored in the index)
+        :return: number of ids removed from the index
+        """
+        pipe = self.r.pipeline()
+        for response_id in response_ids:
+            pipe.exists(self.get_response_key(response_id.decode('utf-8')))
+        expired_response_ids = [response_id for response_id, exists in zip(response_ids, pipe.execute())
+                                if not exists]
+        if expired_response_ids:
+            pipe = self.r.pipeline()
+            pipe.delete(*[self.get_response_finished_key(response_id.decode('utf-8'))
+                          for response_id in expired_response_ids])
+            pipe.zrem(self.get_response_index_key(), *expired_response_ids)
+            pipe.execute()
+        return len(expired_response_ids)
+
+    @staticmethod
+    def get_response_updates_channel(response_id):
+        # NOTE: the same channel name is used in the Lua scripts which update responses
+        return '{0}:updates'.format(RedisStoreBackend.get_response_key(response_id))
+
+    def subscribe_response_updates(self, response_id):
+        """
+        Subscribe to the updates of a response (see the NOTE about the 'response:<response id>:updates' channel).
+        The returned subscription must be closed once no longer needed.
+        :param response_id: id of the response
+        :return: RedisResponseSubscription object
+        """
+        return RedisResponseSubscription(self.r, self.get_response_updates_channel(response_id))
+
+    def get_compression_stats(self):
+        """
+        Get statistics about the compression of the service responses added to the store (see
+        BaseStoreBackend.compress_value).
+        :return: dictionary with the number of values added ('n_values'), their total serialized size
+        ('serialized_bytes'), their total stored size ('stored_bytes') and the compression ratio ('ratio')
+        """
+        stats = {key.decode('utf-8'): int(value)
+                 for key, value in self.r.hgetall(self.get_compression_stats_key()).items()}
+        for key in ['n_values', 'serialized_bytes', 'stored_bytes']:
+            stats.setdefault(key, 0)
+        stats['ratio'] = stats['serialized_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] else None
+        return stats
+
+    def get_service_response(self, response_id, service_name):
+        """
+        Get the contents (or error) and warnings returned by a single service without loading the whole response.
+        :param response_id: id of the response
+        :param service_name: name of the service
+        :return: dictionary with 'contents' or 'errors' key and optionally 'warnings' key (or None if the response
+        of the service has not been received)
+        """
+        values = self.r.hmget(self.get_response_key(response_id),
+                              ['{0}:{1}'.format(section, service_name) for section in RESPONSE_SECTIONS])
+        service_response = {section: self.decode_value(value)
+                             for section, value in zip(RESPONSE_SECTIONS, values) if value is not None}
+        if 'contents' not in service_response and 'errors' not in service_response:
+            return None
+        return service_response
+
+    @staticmethod
+    def get_response_finished_key(response_id):
+        return '{0}:finished'.format(RedisStoreBackend.get_response_key(response_id))
+
+    def notify_response_finished(self, response_id):
+        """
+        Push a token to a list associated to the response so that processes blocked in
+        `wait_response_finished` are woken up. The list is kept for as long as finished responses are kept
+        so that clients that start waiting after the response has finished return immediately.
+        """
+        key = self.get_response_finished_key(response_id)
+        pipe = self.r.pipeline()
+        pipe.rpush(key, RESPONSE_STATUS_FINISHED)
+        pipe.expire(key, settings.RESPONSE_FINISHED_EXPIRY_TIME)
+        pipe.execute()
+
+    def wait_response_finished(self, response_id, timeout):
+        """
+        Block until the response is notified as finished (see `notify_response_finished`) or until
+        `timeout` seconds have passed.
+        :param response_id: id of the response to wait for
+        :param timeout: maximum number of seconds to wait
+        :return: True if the response finished, False if timeout expired
+        """
+        key = self.get_response_finished_key(response_id)
+        # BLPOP only accepts whole seconds and a timeout of 0 means blocking forever
+        timeout = max(1, int(math.ceil(timeout)))
+        if self.r.blpop(key, timeout=timeout) is None:
+            return False
+        # Push the token back (with an expiry time) so other clients waiting for the same response are also notified
+        self.notify_response_finished(response_id)
+        return True
+
+
+class InMemoryResponseSubscription(object):
+    """
+    Subscription to the updates of a response (see InMemoryStoreBackend.subscribe_response_updates).
+    """
+
+    def __init__(self, store, response_id):
+        self.store = store
+        self.response_id = response_id
+        self.updates = queue.Queue()
+
+    def get_update(self, timeout):
+        """
+        Block until an update is published or until `timeout` seconds have passed.
+        :param timeout: maximum number of seconds to wait
+        :return: published message (or None if timeout expired)
+        """
+        try:
+            return self.updates.get(timeout=max(0, timeout))
+        except queue.Empty:
             return None
 
-    def set_response(self, response_id, response_contents):
-        self.r.set(response_id, json.dumps(response_contents), ex=settings.RESPONSE_EXPIRY_TIME)
+    def close(self):
+        self.store.unsubscribe_response_updates(self)
+
+
+class InMemoryStoreBackend(BaseStoreBackend):
+    """
+    Backend which stores responses in the memory of the current process. Responses are not shared with other
+    processes, therefore this backend can only be used when requests to services are performed in the web server
+    process (i.e. with the 'threads' dispatch backend or when requests are performed synchronously) and with a
+    single web server process. Responses expire as in RedisStoreBackend (but never later than
+    settings.RESPONSE_EXPIRY_TIME seconds after being created) and the least recently
+    used responses are evicted when the size of the stored data exceeds settings.RESPONSE_STORE_MEMORY_MAX_SIZE
+    bytes. Counters of hits, misses, expirations and evictions are returned by InMemoryStoreBackend.get_stats.
+    Responses are stored with the same layout used in RedisStoreBackend (and contents, warnings and errors of
+    services are stored serialized) so that stored responses can not be modified by the code using them.
+    """
+
+    # Expired responses are removed when accessed and, at most every PURGE_INTERVAL seconds, when adding responses
+    PURGE_INTERVAL = 60
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.finished_condition = threading.Condition(self.lock)
+        self.responses = OrderedDict()  # Sorted from least recently used to most recently used
+        self.coalescing_keys = dict()
+        self.subscriptions = defaultdict(list)
+        self.size = 0
+        self.next_purge_time = 0
+        self.stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0}
+        self.compression_stats = {'n_values': 0, 'serialized_bytes': 0, 'stored_bytes': 0}
+
+    def get_entry(self, response_id, count_access=False):
+        # NOTE: must be called with self.lock acquired
+        key = str(response_id)
+        entry = self.responses.get(key, None)
+        if entry is not None and entry['expires_at'] <= time.time():
+            self.remove_entry(key)
+            self.stats['expirations'] += 1
+            entry = None
+        if count_access:
+            self.stats['hits' if entry is not None else 'misses'] += 1
+        if entry is not None:
+            self.responses.move_to_end(key)
+        return entry
+
+    def remove_entry(self, key):
+        # NOTE: must be called with self.lock acquired
+        entry = self.responses.pop(key)
+        self.size -= entry['size']
+
+    def add_entry_size(self, entry, size):
+        # NOTE: must be called with self.lock acquired
+        entry['size'] += size
+        self.size += size
+        while self.size > settings.RESPONSE_STORE_MEMORY_MAX_SIZE and self.responses:
+            self.remove_entry(next(iter(self.responses)))
+            self.stats['evictions'] += 1
+
+    @staticmethod
+    def set_entry_expiry_time(entry, expiry_time):
+        entry['expires_at'] = min(time.time() + expiry_time, entry['created_at'] + settings.RESPONSE_EXPIRY_TIME)
+
+    def purge_expired(self, force=False):
+        # NOTE: must be called with self.lock acquired
+        now = time.time()
+        if now < self.next_purge_time and not force:
+            return 0
+        self.next_purge_time = now + self.PURGE_INTERVAL
+        expired_keys = [key for key, entry in self.responses.items() if entry['expires_at'] <= now]
+        for key in expired_keys:
+            self.remove_entry(key)
+        self.stats['expirations'] += len(expired_keys)
+        for key in [key for key, (_, expires_at) in self.coalescing_keys.items() if expires_at <= now]:
+            del self.coalescing_keys[key]
+        return len(expired_keys)
+
+    def publish_update(self, key, message):
+        # NOTE: must be called with self.lock acquired
+        for subscription in self.subscriptions.get(key, list()):
+            subscription.updates.put(message)
+
+    @staticmethod
+    def copy_entry(entry):
+        return dict(entry, values=entry['values'].copy(), versions=entry['versions'].copy())
+
+    def build_response(self, entry, since=None, decode=True):
+        """
+        Build a response dictionary from a stored entry (see RedisStoreBackend.load_response).
+        :param entry: stored entry (or a copy of it)
+        :param since: if provided, only include the responses of services added after this version
+        :param decode: if False, the contents, warnings and errors of services are returned JSON encoded (bytes)
+        :return: response dictionary
+        """
+        response = {
+            'meta': json.loads(entry['meta'].decode('utf-8')),
+            'contents': dict(),
+            'warnings': dict(),
+            'errors': dict(),
+        }
+        response['meta'].update({
+            'status': entry['status'],
+            'n_expected_responses': entry['n_expected_responses'],
+            'n_received_responses': entry['n_received_responses'],
+            'version': entry['version'],
+        })
+        for field, data in entry['values'].items():
+            section, _, service_name = field.partition(':')
+            if since is not None and entry['versions'].get(service_name, 0) <= since:
+                continue
+            response[section][service_name] = self.decode_value(data) if decode else self.decompress_value(data)
+        return response
+
+    def new_response(self, init_response_contents, coalescing_key=None):
+        meta = init_response_contents['meta'].copy()
+        entry = {
+            'created_at': time.time(),
+            'status': meta.pop('status'),
+            'n_expected_responses': meta.pop('n_expected_responses'),
+            'n_received_responses': meta.pop('n_received_responses'),
+            'version': 0,
+            'deadline': meta.get('deadline', None),
+            'expected_services': meta.get('expected_services', list()),
+            'coalesced': coalescing_key is not None,
+            'meta': json.dumps(meta).encode('utf-8'),
+            'values': dict(),
+            'versions': dict(),
+            'size': 0,
+        }
+        self.set_entry_expiry_time(entry, self.get_initial_expiry_time(entry['status'], entry['deadline']))
+        for section in RESPONSE_SECTIONS:
+            for service_name, value in init_response_contents[section].items():
+                entry['values']['{0}:{1}'.format(section, service_name)] = self.encode_value(value)
+        size = len(entry['meta']) + sum(len(data) for data in entry['values'].values())
+        with self.lock:
+            self.purge_expired()
+            if coalescing_key is not None:
+                existing_response_id, expires_at = self.coalescing_keys.get(coalescing_key, (None, 0))
+                if expires_at > time.time() and self.get_entry(existing_response_id) is not None:
+                    return existing_response_id, False
+            response_id = uuid.uuid4()
+            self.responses[str(response_id)] = entry
+            if coalescing_key is not None:
+                self.coalescing_keys[coalescing_key] = \
+                    (str(response_id), time.time() + settings.REQUEST_COALESCING_WINDOW)
+            self.add_entry_size(entry, size)
+        return response_id, True
+
+    def get_response(self, response_id):
+        with self.lock:
+            entry = self.get_entry(response_id, count_access=True)
+            if entry is None:
+                return None
+            entry = self.copy_entry(entry)
+        return self.build_response(entry)
+
+    def set_response_status(self, response_id, status):
+        with self.lock:
+            entry = self.get_entry(response_id)
+            if entry is not None:
+                entry['status'] = status
+                entry['version'] += 1
+                if status == RESPONSE_STATUS_FINISHED:
+                    self.set_entry_expiry_time(entry, settings.RESPONSE_FINISHED_EXPIRY_TIME)
+                self.publish_update(str(response_id), 'status:' + status)
+
+    def add_service_response(self, response_id, service_name, section, value, warnings=None):
+        section, data, warnings_data, serialized_size = self.serialize_service_response(section, value, warnings)
+        with self.lock:
+            entry = self.get_entry(response_id)
+            if entry is None:
+                return False
+            if 'contents:' + service_name in entry['values'] or 'errors:' + service_name in entry['values']:
+                return False
+            entry['values']['{0}:{1}'.format(section, service_name)] = data
+            if warnings_data:
+                entry['values']['warnings:' + service_name] = warnings_data
+            entry['version'] += 1
+            entry['versions'][service_name] = entry['version']
+            entry['n_received_responses'] += 1
+            self.compression_stats['n_values'] += 1
+            self.compression_stats['serialized_bytes'] += serialized_size
+            self.compression_stats['stored_bytes'] += len(data) + len(warnings_data)
+            self.publish_update(str(response_id), 'service:' + service_name)
+            finished = entry['n_received_responses'] >= entry['n_expected_responses']
+            if finished:
+                entry['status'] = RESPONSE_STATUS_FINISHED
+                self.set_entry_expiry_time(entry, settings.RESPONSE_FINISHED_EXPIRY_TIME)
+                self.publish_update(str(response_id), 'status:' + RESPONSE_STATUS_FINISHED)
+            self.add_entry_size(entry, len(data) + len(warnings_data))
+        return finished
+
+    def finalize_expired_entry(self, key, entry, error_data):
+        # NOTE: must be called with self.lock acquired
+        if entry['status'] == RESPONSE_STATUS_FINISHED or entry['deadline'] is None \
+                or entry['deadline'] > time.time():
+            return False
+        entry['version'] += 1
+        size = 0
+        for service_name in entry['expected_services']:
+            if 'contents:' + service_name not in entry['values'] and 'errors:' + service_name not in entry['values']:
+                entry['values']['errors:' + service_name] = error_data
+                entry['versions'][service_name] = entry['version']
+                size += len(error_data)
+        entry['n_received_responses'] = entry['n_expected_responses']
+        entry['status'] = RESPONSE_STATUS_FINISHED
+        self.set_entry_expiry_time(entry, settings.RESPONSE_FINISHED_EXPIRY_TIME)
+        self.publish_update(key, 'status:' + RESPONSE_STATUS_FINISHED)
+        self.add_entry_size(entry, size)
+        return True
+
+    def finalize_expired_response(self, response_id, error):
+        error_data = self.encode_value(error)
+        with self.lock:
+            entry = self.get_entry(response_id)
+            if entry is None:
+                return False
+            return self.finalize_expired_entry(str(response_id), entry, error_data)
+
+    def collect_response(self, response_id, error, delete_if_finished=False, since=None, decode=True):
+        error_data = self.encode_value(error)
+        with self.lock:
+            entry = self.get_entry(response_id, count_access=True)
+            if entry is None:
+                return None, False
+            finalized = self.finalize_expired_entry(str(response_id), entry, error_data)
+            if entry['status'] == RESPONSE_STATUS_FINISHED and str(response_id) in self.responses:
+                if delete_if_finished and not entry['coalesced']:
+                    self.remove_entry(str(response_id))
+                elif entry['expires_at'] < time.time() + settings.RESPONSE_COLLECTED_EXPIRY_TIME and \
+                        any(field.startswith('contents:') for field in entry['values']):
+                    self.set_entry_expiry_time(entry, settings.RESPONSE_COLLECTED_EXPIRY_TIME)
+            entry = self.copy_entry(entry)
+        return self.build_response(entry, since=since, decode=decode), finalized
 
     def delete_response(self, response_id):
-        self.r.delete(response_id)
+        with self.lock:
+            if str(response_id) in self.responses:
+                self.remove_entry(str(response_id))
+
+    def get_all_response_ids(self):
+        with self.lock:
+            return list(self.responses.keys())
+
+    def count_responses(self):
+        with self.lock:
+            return len(self.responses)
 
-    def get_all_response_keys(self):
-        return self.r.keys('*')
+    def delete_old_responses(self, batch_size):
+        # NOTE: all expired responses are deleted at once as this does not block other processes
+        with self.lock:
+            return self.purge_expired(force=True)
+
+    def subscribe_response_updates(self, response_id):
+        subscription = InMemoryResponseSubscription(self, str(response_id))
+        with self.lock:
+            self.subscriptions[subscription.response_id].append(subscription)
+        return subscription
+
+    def unsubscribe_response_updates(self, subscription):
+        with self.lock:
+            self.subscriptions[subscription.response_id].remove(subscription)
+            if not self.subscriptions[subscription.response_id]:
+                del self.subscriptions[subscription.response_id]
+
+    def get_compression_stats(self):
+        with self.lock:
+            stats = self.compression_stats.copy()
+        stats['ratio'] = stats['serialized_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] else None
+        return stats
+
+    def get_stats(self):
+        """
+        Get statistics about the usage of the store.
+        :return: dictionary with the number of hits, misses, expirations and evictions, and the number of stored
+        responses ('n_responses') and their size ('size')
+        """
+        with self.lock:
+            return dict(self.stats, n_responses=len(self.responses), size=self.size)
+
+    def get_service_response(self, response_id, service_name):
+        with self.lock:
+            entry = self.get_entry(response_id, count_access=True)
+            if entry is None:
+                return None
+            values = [entry['values'].get('{0}:{1}'.format(section, service_name), None)
+                      for section in RESPONSE_SECTIONS]
+        service_response = {section: self.decode_value(value)
+                            for section, value in zip(RESPONSE_SECTIONS, values) if value is not None}
+        if 'contents' not in service_response and 'errors' not in service_response:
+            return None
+        return service_response
+
+    def notify_response_finished(self, response_id):
+        with self.lock:
+            self.finished_condition.notify_all()
+
+    def wait_response_finished(self, response_id, timeout):
+        def is_finished():
+            entry = self.get_entry(response_id)
+            # NOTE: responses that do not exist (e.g. evicted) will never finish, so there is no need to wait
+            return entry is None or entry['status'] == RESPONSE_STATUS_FINISHED
+
+        with self.lock:
+            return self.finished_condition.wait_for(is_finished, timeout)
+
+
+STORE_BACKEND_REDIS = 'redis'
+STORE_BACKEND_MEMORY = 'memory'
+
+
+def get_store_backend_class():
+    return {
+        STORE_BACKEND_REDIS: RedisStoreBackend,
+        STORE_BACKEND_MEMORY: InMemoryStoreBackend,
+    }[settings.RESPONSE_STORE_BACKEND]
 
 
 class ResponseAggregator(object):
     """
     The response aggregator is in charge of maintaining a pool of request responses and keep on aggregating
-    responses from different services at the moment these are received. It uses a redis-based store
-    (RedisStoreBackend) to share response data within all ac_mediator processes and celery workers.
+    responses from different services at the moment these are received. By default it uses a redis-based store
+    (RedisStoreBackend) to share response data within all ac_mediator processes and celery workers, but responses
+    can also be stored in the memory of the web server process (InMemoryStoreBackend, see
+    settings.RESPONSE_STORE_BACKEND).
     The ReponseAggregator implement a ResponseAggregator.collect_response method which is given
     a 'response_id' object and will return the current responses that have been aggregated for the
     given response_id at the time of calling the method. This is used for the /api/collect endpoint
@@ -63,56 +1037,262 @@ class ResponseAggregator(object):
     only makes sense when wait_until_complete=False in the RequestDistributor)
     """
 
-    def __init__(self, store_backend=RedisStoreBackend):
+    def __init__(self, store_backend=None):
+        if store_backend is None:
+            store_backend = get_store_backend_class()
         self.store = store_backend()
 
-    def create_response(self, n_expected_responses):
-        response_id = self.store.new_response({
+    @staticmethod
+    def init_response_contents(n_expected_responses, expected_services, deadline, status):
+        return {
             'meta': {
                 'response_id': None,  # Will be filled in self.collect_response
-                'status': RESPONSE_STATUS_NEW,
+                'status': status,
                 'n_expected_responses': n_expected_responses,
                 'n_received_responses': 0,
+                'expected_services': expected_services or list(),
+                'deadline': deadline,
                 'sent_timestamp': str(datetime.datetime.now())
             },
             'contents': dict(),
             'warnings': dict(),
             'errors': dict(),
-        })
+        }
+
+    def create_response(self, n_expected_responses, expected_services=None, deadline=None,
+                        status=RESPONSE_STATUS_NEW):
+        """
+        Create a new response object in the store.
+        :param n_expected_responses: number of services from which responses are expected
+        :param expected_services: names of the services from which responses are expected
+        :param deadline: time (in seconds since the epoch) after which services that have not responded are
+        considered to have timed out (see ResponseAggregator.finalize_expired_response)
+        :param status: initial status of the response
+        :return: id of the created response
+        """
+        response_id, _ = self.store.new_response(
+            self.init_response_contents(n_expected_responses, expected_services, deadline, status))
+        if status == RESPONSE_STATUS_FINISHED:
+            self.store.notify_response_finished(response_id)
         return response_id
 
+    def create_coalesced_response(self, request_key, n_expected_responses, expected_services=None, deadline=None,
+                                  status=RESPONSE_STATUS_NEW):
+        """
+        Create a new response object in the store unless the response of an identical request created in the
+        last settings.REQUEST_COALESCING_WINDOW seconds still exists, in which case that response is reused.
+        :param request_key: key identifying the request (see api.request_distributor.get_request_coalescing_key)
+        :param n_expected_responses: number of services from which responses are expected
+        :param expected_services: names of the services from which responses are expected
+        :param deadline: time (in seconds since the epoch) after which services that have not responded are
+        considered to have timed out (see ResponseAggregator.finalize_expired_response)
+        :param status: initial status of the response
+        :return: tuple with the id of the response and whether it was created
+        """
+        response_id, created = self.store.new_response(
+            self.init_response_contents(n_expected_responses, expected_services, deadline, status),
+            coalescing_key=request_key)
+        if created and status == RESPONSE_STATUS_FINISHED:
+            self.store.notify_response_finished(response_id)
+        return response_id, created
+
     def set_response_to_processing(self, response_id):
-        response = self.store.get_response(response_id)
-        response['meta']['status'] = RESPONSE_STATUS_PROCESSING
-        self.store.set_response(response_id, response)
+        self.store.set_response_status(response_id, RESPONSE_STATUS_PROCESSING)
 
     def set_response_to_finished(self, response_id):
-        response = self.store.get_response(response_id)
-        response['meta']['status'] = RESPONSE_STATUS_FINISHED
-        self.store.set_response(response_id, response)
+        self.store.set_response_status(response_id, RESPONSE_STATUS_FINISHED)
+        self.store.notify_response_finished(response_id)
+
+    @staticmethod
+    def serialize_error(exception):
+        return serialize_error(exception)
 
     def aggregate_response(self, response_id, service_name, response_contents, warnings=None):
-        response = self.store.get_response(response_id)
-        response['meta']['n_received_responses'] += 1
+        # NOTE: if a response for this service has already been aggregated (e.g. the service responded after the
+        # response deadline passed and it was marked as timed out), the store ignores this one
         if isinstance(response_contents, ACException) or isinstance(response_contents, ACAPIException):
             # If response content is error, add to errors dict
-            response['errors'][service_name] = {
-                'status_code': response_contents.status,
-                'type': response_contents.__class__.__name__,
-                'detail': response_contents.msg,
-            }
+            finished = self.store.add_service_response(
+                response_id, service_name, 'errors', self.serialize_error(response_contents))
         else:
-            # If response content is ok, add to contents dict
-            response['contents'][service_name] = response_contents
-            # If response content has warnings, add them to the warnings dict
-            if warnings:
-                response['warnings'][service_name] = warnings
-        if response['meta']['n_received_responses'] == response['meta']['n_expected_responses']:
-            response['meta']['status'] = RESPONSE_STATUS_FINISHED
-        self.store.set_response(response_id, response)
-
-    def collect_response(self, response_id, format='json'):
-        response = self.store.get_response(response_id)
+            # If response content is ok, add to contents dict (and warnings, if any, to the warnings dict)
+            finished = self.store.add_service_response(
+                response_id, service_name, 'contents', response_contents, warnings=warnings)
+        if finished:
+            self.store.notify_response_finished(response_id)
+
+    @staticmethod
+    def response_deadline_passed(response):
+        deadline = response['meta'].get('deadline', None)
+        return deadline is not None and deadline <= time.time()
+
+    def finalize_expired_response(self, response_id):
+        """
+        If the deadline of the response has passed and it is not finished, add timeout errors for the services
+        that have not responded yet and set the response to finished. Responses from these services received
+        afterwards are ignored (see ResponseAggregator.aggregate_response).
+        This is called when collecting responses so that responses are finalized even if the workers performing
+        the requests never report back.
+        :param response_id: id of the response to finalize
+        :return: updated response dictionary (or None if the response does not exist)
+        """
+        if self.store.finalize_expired_response(response_id, self.serialize_error(ACAPIServiceTimeout())):
+            self.store.notify_response_finished(response_id)
+        return self.store.get_response(response_id)
+
+    def delete_response(self, response_id):
+        self.store.delete_response(response_id)
+
+    def wait_until_finished(self, response_id, timeout):
+        """
+        Block until responses from all services have been aggregated for the given response_id or
+        until `timeout` seconds have passed. This does not poll the store, the waiting process is woken
+        up by the notification sent when the response is set to finished.
+        :param response_id: id of the response to wait for
+        :param timeout: maximum number of seconds to wait
+        :return: True if all responses were received, False if timeout expired
+        """
+        return self.store.wait_response_finished(response_id, timeout)
+
+    def wait_until_changed(self, response_id, timeout, n_received_responses=None, version=None):
+        """
+        Block until the given response changes or until `timeout` seconds have passed. This is used for
+        long-polling the /collect endpoint. The response is considered to have changed if a new service response
+        is aggregated or its status changes while waiting, or if it already has a different number of received
+        responses than `n_received_responses` or a different version than `version` (i.e. the number of received
+        responses or version of the last response seen by the client). Finished and non existing responses do not
+        change so this returns immediately for them.
+        :param response_id: id of the response to wait for
+        :param timeout: maximum number of seconds to wait
+        :param n_received_responses: number of received responses in the last version of the response seen by the
+        client (if not provided, only changes made while waiting are taken into account)
+        :param version: last version of the response seen by the client
+        :return: True if the response changed (or will not change anymore), False if timeout expired
+        """
+        def is_changed():
+            response = self.store.get_response(response_id)
+            if response is None or response['meta']['status'] == RESPONSE_STATUS_FINISHED \
+                    or self.response_deadline_passed(response):
+                return True
+            if version is not None and response['meta']['version'] != version:
+                return True
+            return n_received_responses is not None and \
+                response['meta']['n_received_responses'] != n_received_responses
+
+        return self.store.wait_response_changed(response_id, is_changed, timeout)
+
+    @staticmethod
+    def get_service_responses(response, exclude):
+        """
+        Get the contents (or errors) and warnings returned by each service in a response dictionary.
+        :param response: response dictionary
+        :param exclude: names of the services to skip
+        :return: list of (service name, service response) tuples (see RedisStoreBackend.get_service_response)
+        """
+        service_responses = list()
+        for service_name in list(response['contents'].keys()) + list(response['errors'].keys()):
+            if service_name in exclude:
+                continue
+            if service_name in response['contents']:
+                service_response = {'contents': response['contents'][service_name]}
+            else:
+                service_response = {'errors': response['errors'][service_name]}
+            if service_name in response['warnings']:
+                service_response['warnings'] = response['warnings'][service_name]
+            service_responses.append((service_name, service_response))
+        return service_responses
+
+    @staticmethod
+    def check_response_format(format):
+        """
+        Raise ACAPIUnsupportedFormat if responses can not be returned in the given format.
+        :param format: format of the response
+        """
+        if format not in [settings.JSON_FORMAT_KEY, settings.JSON_LD_FORMAT_KEY]:
+            raise ACAPIUnsupportedFormat()
+
+    def stream_response(self, response_id, format='json'):
+        """
+        Return a generator which yields the events of a response as they happen: a 'status' event with the meta
+        information of the response, a 'service' event with the contents (or errors) and warnings of each service as
+        soon as these are aggregated, and a final 'status' event once the response is finished. If the deadline of the
+        response passes before it is finished, it is finalized (see ResponseAggregator.finalize_expired_response).
+        This is used for the /stream endpoint. The format is checked when this method is called (and not when the
+        stream finishes) so that unsupported formats are reported before any event is sent.
+        :param response_id: id of the response to stream
+        :param format: format of the response (see ResponseAggregator.collect_response)
+        :return: generator of (event name, data) tuples (nothing is yielded if the response does not exist)
+        """
+        self.check_response_format(format)
+        return self.generate_response_events(response_id, format)
+
+    def generate_response_events(self, response_id, format):
+        """
+        Generator which yields the events of a response (see ResponseAggregator.stream_response).
+        :param response_id: id of the response to stream
+        :param format: format of the response (see ResponseAggregator.collect_response)
+        :return: generator of (event name, data) tuples
+        """
+        subscription = self.store.subscribe_response_updates(response_id)
+        sent_services = set()
+        try:
+            # Get the response only after subscribing so that updates made in between are not missed
+            response = self.store.get_response(response_id)
+            if response is None:
+                return
+            status = response['meta']['status']
+            if status != RESPONSE_STATUS_FINISHED:
+                response['meta']['response_id'] = response_id
+                yield 'status', response['meta']
+                for service_name, service_response in self.get_service_responses(response, sent_services):
+                    sent_services.add(service_name)
+                    yield 'service', dict(service=service_name, **service_response)
+            deadline = response['meta'].get('deadline', None) or time.time() + settings.MAX_REQUEST_TIMEOUT
+            while status != RESPONSE_STATUS_FINISHED and time.time() < deadline:
+                update = subscription.get_update(deadline - time.time())
+                if update is None:
+                    break
+                update_type, _, value = update.partition(':')
+                if update_type == 'status':
+                    status = value
+                elif update_type == 'service' and value not in sent_services:
+                    service_response = self.store.get_service_response(response_id, value)
+                    if service_response is not None:
+                        sent_services.add(value)
+                        yield 'service', dict(service=value, **service_response)
+        finally:
+            subscription.close()
+
+        # Collect the final response (finalizing it if the deadline passed) and send the responses of the services
+        # not sent yet (e.g. timeout errors) and the final status
+        response = self.collect_response(response_id, format=format)
+        if response is None:
+            return
+        for service_name, service_response in self.get_service_responses(response, sent_services):
+            yield 'service', dict(service=service_name, **service_response)
+        yield 'status', response['meta']
+
+    def collect_response(self, response_id, format='json', since=None, serialized=False):
+        """
+        Return the current contents of the response. The returned meta information includes the version of the
+        response, which is increased every time the response is updated. If `since` is provided, only the
+        contents, warnings and errors of the services added after that version are returned so that clients that
+        repeatedly collect a response only get what is new.
+        :param response_id: id of the response to collect
+        :param format: format of the response
+        :param since: version of the response last collected by the client
+        :param serialized: if True, the contents, warnings and errors of services are returned as stored in the
+        store (JSON encoded bytes) instead of being decoded. The response can then be serialized without
+        re-encoding them using ResponseAggregator.serialize_response
+        :return: response dictionary (or None if the response does not exist)
+        """
+        # Responses whose deadline has passed are finalized, and finished responses are deleted if
+        # settings.DELETE_RESPONSES_AFTER_CONSUMED, in the same (atomic) operation used to get the response
+        response, finalized = self.store.collect_response(
+            response_id, self.serialize_error(ACAPIServiceTimeout()),
+            delete_if_finished=settings.DELETE_RESPONSES_AFTER_CONSUMED, since=since, decode=not serialized)
+        if finalized:
+            self.store.notify_response_finished(response_id)
         to_return = None
         if response is None:
             return to_return
@@ -126,13 +1306,29 @@ class ResponseAggregator(object):
                 settings.BASE_URL + '{0}?rid={1}'.format(reverse('api-collect'),
                                                          response_id)  # Add collect url for convenience
             to_return['meta']['current_timestamp'] = str(datetime.datetime.now())
-            if response['meta']['status'] == RESPONSE_STATUS_FINISHED and settings.DELETE_RESPONSES_AFTER_CONSUMED:
-                self.store.delete_response(response_id)  # If response has been all loaded, delete it from pool
         else:
             raise ACAPIUnsupportedFormat()
 
         return to_return
 
+    @staticmethod
+    def serialize_response(response):
+        """
+        Serialize a response collected with ResponseAggregator.collect_response(..., serialized=True) as JSON.
+        Only the meta information is encoded, the already encoded contents, warnings and errors of each service
+        are spliced into the output as they are. This avoids decoding and encoding again large responses.
+        :param response: response dictionary with JSON encoded service contents, warnings and errors
+        :return: JSON encoded response (bytes)
+        """
+        parts = [b'{"meta":', json.dumps(response['meta'], cls=JSONEncoder, separators=JSON_SEPARATORS).encode('utf-8')]
+        for section in RESPONSE_SECTIONS:
+            parts.append(',"{0}":{{'.format(section).encode('utf-8'))
+            parts.append(b','.join(json.dumps(service_name).encode('utf-8') + b':' + data
+                                   for service_name, data in response[section].items()))
+            parts.append(b'}')
+        parts.append(b'}')
+        return b''.join(parts)
+
 
 response_aggregator = ResponseAggregator()
 
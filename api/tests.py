@@ -4,8 +4,13 @@ from accounts.models import Account
 from django.core.urlresolvers import reverse
 from services import management
 from django.conf import settings
+from unittest import mock
 import oauth2_provider
 import datetime
+import asyncio
+import json
+import time
+import uuid
 
 
 class OAuth2TestCase(TestCase):
@@ -430,3 +435,612 @@ class DownloadEndpointsTestCase(TestCase):
             'acid2': 'DownloadService:123',
         }, HTTP_AUTHORIZATION='Bearer {0}'.format(access_token))
         self.assertEqual(resp.status_code, 400)
+
+
+class TextSearchEndpointTestCase(TestCase):
+
+    def setUp(self):
+        user = Account.objects.create_user('dev', password='devpass')
+        client = ApiClient.objects.create(
+            name='TestClient',
+            user=user,
+            agree_tos=True,
+            client_type=ApiClient.CLIENT_PUBLIC,
+            authorization_grant_type=ApiClient.GRANT_PASSWORD,
+            redirect_uris='http://example.com',
+        )
+        access_token = oauth2_provider.models.AccessToken.objects.create(
+            token='a_fake_token',
+            application=client,
+            user=user,
+            expires=datetime.datetime.today() + datetime.timedelta(hours=1)
+        )
+        self.auth_header = 'Bearer {0}'.format(access_token)
+
+    def test_filter_is_parsed_before_dispatch(self):
+        with mock.patch('api.views.request_distributor.process_request', return_value={}) as process_request:
+
+            # Services get the parsed filter
+            resp = self.client.get(reverse('api-text-search'), {
+                'q': 'dogs', 'f': 'ac:format:wav AND ac:duration:[1,5]'}, HTTP_AUTHORIZATION=self.auth_header)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(process_request.call_args[0][0]['kwargs']['f'],
+                             [['ac:format', ':', 'wav'], 'and', ['ac:duration', ':', [1, 5]]])
+
+            # Invalid filters are rejected without sending requests to the services
+            resp = self.client.get(reverse('api-text-search'), {
+                'q': 'dogs', 'f': 'ac:format:wav AND'}, HTTP_AUTHORIZATION=self.auth_header)
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(process_request.call_count, 1)
+
+            # Filters nested too deeply are also rejected as bad requests
+            for f in ['(' * 250 + 'ac:format:wav' + ')' * 250, 'NOT ' * 250 + 'ac:format:wav']:
+                resp = self.client.get(reverse('api-text-search'), {'q': 'dogs', 'f': f},
+                                       HTTP_AUTHORIZATION=self.auth_header)
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn('nested', resp.json()['detail'])
+            self.assertEqual(process_request.call_count, 1)
+
+    def test_timeout_parameter(self):
+        with mock.patch('api.views.request_distributor.process_request', return_value={}) as process_request:
+
+            # Timeouts are capped to settings.MAX_REQUEST_TIMEOUT
+            resp = self.client.get(reverse('api-text-search'), {
+                'q': 'dogs', 'timeout': settings.MAX_REQUEST_TIMEOUT * 2}, HTTP_AUTHORIZATION=self.auth_header)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(process_request.call_args[1]['timeout'], settings.MAX_REQUEST_TIMEOUT)
+
+            # Timeouts which are not positive finite numbers are rejected
+            for timeout in ['abc', '0', '-1', 'nan', 'NaN', 'inf', '-inf', 'Infinity']:
+                resp = self.client.get(reverse('api-text-search'), {'q': 'dogs', 'timeout': timeout},
+                                       HTTP_AUTHORIZATION=self.auth_header)
+                self.assertEqual(resp.status_code, 400)
+            self.assertEqual(process_request.call_count, 1)
+
+
+class CollectEndpointTestCase(TestCase):
+
+    def setUp(self):
+        from api.response_aggregator import ResponseAggregator
+        self.aggregator = ResponseAggregator()
+
+        # Create user, client and access token
+        user = Account.objects.create_user('dev', password='devpass')
+        client = ApiClient.objects.create(
+            name='TestClient',
+            user=user,
+            agree_tos=True,
+            client_type=ApiClient.CLIENT_PUBLIC,
+            authorization_grant_type=ApiClient.GRANT_PASSWORD,
+            redirect_uris='http://example.com',
+        )
+        access_token = oauth2_provider.models.AccessToken.objects.create(
+            token='a_fake_token',
+            application=client,
+            user=user,
+            expires=datetime.datetime.today() + datetime.timedelta(hours=1)
+        )
+        self.auth_header = 'Bearer {0}'.format(access_token)
+
+    def collect(self, response_id, **params):
+        extra = dict()
+        if 'if_none_match' in params:
+            extra['HTTP_IF_NONE_MATCH'] = params.pop('if_none_match')
+        params['rid'] = str(response_id)
+        return self.client.get(reverse('api-collect'), params, HTTP_AUTHORIZATION=self.auth_header, **extra)
+
+    def test_collect_since_version(self):
+        response_id = self.aggregator.create_response(2, status='PR')
+        self.aggregator.aggregate_response(response_id, 'Service1', {'results': [1]})
+
+        # Collecting returns the version of the response and an ETag
+        resp = self.collect(response_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/json')
+        self.assertEqual(resp.json()['meta']['response_id'], str(response_id))
+        version = resp.json()['meta']['version']
+        self.assertEqual(resp['ETag'], '"{0}-{1}"'.format(response_id, version))
+        self.assertIn('Service1', resp.json()['contents'])
+
+        # Nothing changed since last collected version
+        self.assertEqual(self.collect(response_id, since=version).status_code, 304)
+        self.assertEqual(self.collect(response_id, if_none_match=resp['ETag']).status_code, 304)
+        self.assertEqual(self.collect(response_id, since=version, wait=0.5).status_code, 304)
+
+        # The ETag of another response with the same version does not match
+        other_response_id = self.aggregator.create_response(2, status='PR')
+        self.aggregator.aggregate_response(other_response_id, 'Service1', {'results': [1]})
+        self.assertEqual(self.collect(other_response_id).json()['meta']['version'], version)
+        self.assertEqual(self.collect(other_response_id, if_none_match=resp['ETag']).status_code, 200)
+
+        # Only results received after the last collected version are returned
+        self.aggregator.aggregate_response(response_id, 'Service2', {'results': [2]})
+        resp = self.collect(response_id, since=version, wait=10)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(resp.json()['contents'].keys()), ['Service2'])
+        self.assertEqual(resp.json()['meta']['status'], 'FI')
+        self.assertGreater(resp.json()['meta']['version'], version)
+
+        # If-None-Match with an old ETag returns the complete response
+        resp = self.collect(response_id, if_none_match='"{0}-{1}"'.format(response_id, version))
+        self.assertEqual(sorted(resp.json()['contents'].keys()), ['Service1', 'Service2'])
+
+        # Invalid parameters
+        self.assertEqual(self.collect(response_id, since='abc').status_code, 400)
+
+
+class ResponseAggregatorTestCase(TestCase):
+
+    def setUp(self):
+        from api.response_aggregator import ResponseAggregator
+        self.aggregator = ResponseAggregator()
+
+    def get_stored_value(self, response_id, field):
+        store = self.aggregator.store
+        return store.r.hget(store.get_response_key(response_id), field)
+
+    def get_expiry_time(self, response_id):
+        store = self.aggregator.store
+        return store.r.ttl(store.get_response_key(response_id))
+
+    def get_stored_keys(self, response_id):
+        store = self.aggregator.store
+        return store.r.keys('{0}*'.format(store.get_response_key(response_id)))
+
+    def test_wait_until_finished(self):
+
+        # Waiting for a response which does not finish returns False once the timeout expires
+        response_id = self.aggregator.create_response(2)
+        self.aggregator.set_response_to_processing(response_id)
+        self.aggregator.aggregate_response(response_id, 'Service1', {'results': []})
+        self.assertEquals(self.aggregator.wait_until_finished(response_id, timeout=1), False)
+
+        # Once all responses are aggregated, waiting returns True immediately (and keeps doing so for other waiters)
+        self.aggregator.aggregate_response(response_id, 'Service2', {'results': []})
+        self.assertEquals(self.aggregator.wait_until_finished(response_id, timeout=1), True)
+        self.assertEquals(self.aggregator.wait_until_finished(response_id, timeout=1), True)
+        self.assertEquals(self.aggregator.collect_response(response_id)['meta']['n_received_responses'], 2)
+
+    def test_finalize_expired_response(self):
+
+        # Before the deadline, collecting a response does not finalize it
+        response_id = self.aggregator.create_response(
+            2, expected_services=['Service1', 'Service2'], deadline=time.time() + 1)
+        self.aggregator.set_response_to_processing(response_id)
+        self.aggregator.aggregate_response(response_id, 'Service1', {'results': []})
+        self.assertEquals(self.aggregator.collect_response(response_id)['meta']['status'], 'PR')
+
+        # After the deadline, services which did not respond are marked as timed out and response is finished
+        time.sleep(1)
+        response = self.aggregator.collect_response(response_id)
+        self.assertEquals(response['meta']['status'], 'FI')
+        self.assertEquals(response['meta']['n_received_responses'], 2)
+        self.assertIn('Service1', response['contents'])
+        self.assertEquals(response['errors']['Service2']['status_code'], 504)
+        self.assertEquals(self.aggregator.wait_until_finished(response_id, timeout=1), True)
+
+        # Responses received after the response has been finalized are ignored
+        self.aggregator.aggregate_response(response_id, 'Service2', {'results': []})
+        response = self.aggregator.collect_response(response_id)
+        self.assertNotIn('Service2', response['contents'])
+        self.assertEquals(response['meta']['n_received_responses'], 2)
+
+    @override_settings(DELETE_RESPONSES_AFTER_CONSUMED=True)
+    def test_collect_and_delete_response(self):
+
+        # Responses can be created directly in processing status and are not deleted until finished
+        response_id = self.aggregator.create_response(1, status='PR')
+        self.assertEquals(self.aggregator.collect_response(response_id)['meta']['status'], 'PR')
+        self.aggregator.aggregate_response(response_id, 'Service1', {'results': []})
+
+        # Finished response is deleted once collected (together with all data associated to it)
+        self.assertEquals(self.aggregator.wait_until_finished(response_id, timeout=1), True)
+        self.assertEquals(self.aggregator.collect_response(response_id)['meta']['status'], 'FI')
+        self.assertEquals(self.get_stored_keys(response_id), [])
+        self.assertEquals(self.aggregator.collect_response(response_id), None)
+
+    def test_wait_until_changed(self):
+        import threading
+
+        # Waiting for a response which does not change returns False once the timeout expires
+        response_id = self.aggregator.create_response(2, status='PR')
+        self.assertEquals(self.aggregator.wait_until_changed(response_id, 0.5), False)
+
+        # Waiting returns True as soon as a service response is aggregated
+        threading.Timer(0.5, self.aggregator.aggregate_response,
+                        args=(response_id, 'Service1', {'results': []})).start()
+        start_time = time.time()
+        self.assertEquals(self.aggregator.wait_until_changed(response_id, 10), True)
+        self.assertLess(time.time() - start_time, 5)
+
+        # If the client has not seen the last version of the response, waiting returns True immediately
+        self.assertEquals(self.aggregator.wait_until_changed(response_id, 10, n_received_responses=0), True)
+        self.assertEquals(self.aggregator.wait_until_changed(response_id, 0.5, n_received_responses=1), False)
+
+        # Finished responses do not change so waiting returns immediately
+        self.aggregator.aggregate_response(response_id, 'Service2', {'results': []})
+        self.assertEquals(self.aggregator.wait_until_changed(response_id, 10, n_received_responses=2), True)
+
+    def test_stream_response(self):
+        import threading
+        from ac_mediator.exceptions import ACAPIUnsupportedFormat
+
+        # Service responses are streamed as these are aggregated and the stream ends once the response is finished
+        response_id = self.aggregator.create_response(3, expected_services=['Service1', 'Service2', 'Service3'],
+                                                      deadline=time.time() + 2, status='PR')
+        self.aggregator.aggregate_response(response_id, 'Service1', {'results': [1]}, ['Warning'])
+        threading.Timer(0.5, self.aggregator.aggregate_response,
+                        args=(response_id, 'Service2', {'results': [2]})).start()
+        events = list(self.aggregator.stream_response(response_id))
+        self.assertEquals([event for event, _ in events], ['status', 'service', 'service', 'service', 'status'])
+        self.assertEquals(events[0][1]['status'], 'PR')
+        self.assertEquals(events[1][1], {'service': 'Service1', 'contents': {'results': [1]}, 'warnings': ['Warning']})
+        self.assertEquals(events[2][1], {'service': 'Service2', 'contents': {'results': [2]}})
+
+        # Service which did not respond before the deadline is sent as timed out
+        self.assertEquals(events[3][1]['service'], 'Service3')
+        self.assertEquals(events[3][1]['errors']['status_code'], 504)
+        self.assertEquals(events[4][1]['status'], 'FI')
+
+        # Streaming finished responses sends all service responses and the final status straight away
+        events = list(self.aggregator.stream_response(response_id))
+        self.assertEquals([event for event, _ in events], ['service', 'service', 'service', 'status'])
+
+        # Streaming a response which does not exist yields nothing
+        self.assertEquals(list(self.aggregator.stream_response(uuid.uuid4())), [])
+
+        # Unsupported formats are reported when the stream is requested and not once it finishes
+        with self.assertRaises(ACAPIUnsupportedFormat):
+            self.aggregator.stream_response(response_id, format='xml')
+
+    @override_settings(RESPONSE_COMPRESSION_THRESHOLD=100)
+    def test_response_compression(self):
+        store = self.aggregator.store
+        stats = store.get_compression_stats()
+
+        # Large service responses are compressed, small ones are not
+        response_id = self.aggregator.create_response(2, status='PR')
+        large_contents = {'results': [{'ac:name': 'dog barking {0}'.format(i)} for i in range(100)]}
+        self.aggregator.aggregate_response(response_id, 'Service1', large_contents)
+        self.aggregator.aggregate_response(response_id, 'Service2', {'results': []})
+        self.assertTrue(self.get_stored_value(response_id, 'contents:Service1').startswith(b'zlib:'))
+        self.assertEquals(self.get_stored_value(response_id, 'contents:Service2'), b'{"results":[]}')
+        response = self.aggregator.collect_response(response_id)
+        self.assertEquals(response['contents'], {'Service1': large_contents, 'Service2': {'results': []}})
+
+        # Compression stats are updated
+        new_stats = store.get_compression_stats()
+        self.assertEquals(new_stats['n_values'], stats['n_values'] + 2)
+        self.assertGreater(new_stats['serialized_bytes'] - stats['serialized_bytes'],
+                           new_stats['stored_bytes'] - stats['stored_bytes'])
+
+    @override_settings(RESPONSE_COMPRESSION_THRESHOLD=100)
+    def test_corrupted_compressed_value(self):
+        store = self.aggregator.store
+        response_id = self.aggregator.create_response(1, status='PR')
+        large_contents = {'results': [{'ac:name': 'dog barking {0}'.format(i)} for i in range(100)]}
+        self.aggregator.aggregate_response(response_id, 'Service1', large_contents)
+        value = self.get_stored_value(response_id, 'contents:Service1')
+        self.assertTrue(value.startswith(b'zlib:'))
+
+        # Responses with truncated compressed values are handled like any other invalid response
+        store.r.hset(store.get_response_key(response_id), 'contents:Service1', value[:len(value) // 2])
+        self.assertEquals(self.aggregator.collect_response(response_id), None)
+        self.assertEquals(self.aggregator.collect_response(response_id, serialized=True), None)
+
+    def test_delete_old_responses(self):
+        store = self.aggregator.store
+        with override_settings(RESPONSE_EXPIRY_TIME=1):
+            old_response_id = self.aggregator.create_response(1, status='PR')
+            time.sleep(1.1)
+            response_id = self.aggregator.create_response(1, status='PR')
+
+            # Old responses are deleted (in batches) and removed from the index, recent ones are kept
+            self.assertGreaterEqual(store.delete_old_responses(batch_size=2), 1)
+        response_ids = list(store.get_all_response_ids())
+        self.assertNotIn(str(old_response_id), response_ids)
+        self.assertIn(str(response_id), response_ids)
+        self.assertEquals(self.aggregator.collect_response(old_response_id), None)
+        self.assertEquals(self.aggregator.collect_response(response_id)['meta']['status'], 'PR')
+
+    @override_settings(RESPONSE_FINISHED_EXPIRY_TIME=1)
+    def test_delete_expired_responses_from_index(self):
+        store = self.aggregator.store
+        response_ids = [self.aggregator.create_response(1, status='PR') for _ in range(3)]
+        for response_id in response_ids[:2]:
+            self.aggregator.aggregate_response(response_id, 'Service1', {'results': []})
+            self.aggregator.wait_until_finished(response_id, timeout=1)
+        time.sleep(1.5)
+
+        # Responses which already expired are removed from the index even if these are not old
+        self.assertGreaterEqual(store.delete_old_responses(batch_size=2), 2)
+        stored_response_ids = list(store.get_all_response_ids())
+        for response_id in response_ids[:2]:
+            self.assertNotIn(str(response_id), stored_response_ids)
+            self.assertEquals(self.get_stored_keys(response_id), [])
+        self.assertIn(str(response_ids[2]), stored_response_ids)
+
+    @override_settings(RESPONSE_FINISHED_EXPIRY_TIME=100, RESPONSE_COLLECTED_EXPIRY_TIME=1000)
+    def test_response_expiry_tiers(self):
+        from ac_mediator.exceptions import ACAPIServiceTimeout
+
+        # Responses being processed are kept until their deadline plus the expiry time of finished responses
+        response_id = self.aggregator.create_response(1, expected_services=['Service1'], deadline=time.time() + 10,
+                                                      status='PR')
+        self.assertTrue(100 < self.get_expiry_time(response_id) <= 111)
+
+        # Finished responses are kept for a shorter time, and for longer once they are collected
+        self.aggregator.aggregate_response(response_id, 'Service1', {'results': []})
+        self.assertTrue(self.get_expiry_time(response_id) <= 100)
+        self.aggregator.collect_response(response_id)
+        self.assertTrue(100 < self.get_expiry_time(response_id) <= 1000)
+
+        # Collecting finished responses which only have errors does not extend their expiry time
+        response_id = self.aggregator.create_response(1, status='PR')
+        self.aggregator.aggregate_response(response_id, 'Service1', ACAPIServiceTimeout())
+        self.aggregator.collect_response(response_id)
+        self.assertTrue(self.get_expiry_time(response_id) <= 100)
+
+    def test_response_size_limit(self):
+        response_id = self.aggregator.create_response(3, status='PR')
+        contents = {'num_results': 100, 'results': [{'ac:name': 'dog barking {0}'.format(i)} for i in range(100)]}
+        with override_settings(RESPONSE_MAX_SERVICE_CONTENTS_SIZE=len(json.dumps(contents, separators=(',', ':'))) - 1):
+            # Contents which are too large are truncated and a warning is added
+            self.aggregator.aggregate_response(response_id, 'Service1', contents, ['Warning'])
+            self.aggregator.aggregate_response(response_id, 'Service2', {'num_results': 0, 'results': []})
+            # Contents which can't be truncated are replaced by an error
+            self.aggregator.aggregate_response(response_id, 'Service3', {'data': 'x' * len(json.dumps(contents))})
+        response = self.aggregator.collect_response(response_id)
+        self.assertEquals(response['contents']['Service1']['num_results'], 100)
+        self.assertEquals(response['contents']['Service1']['results'], contents['results'][:99])
+        self.assertEquals(response['warnings']['Service1'][0], 'Warning')
+        self.assertIn('first 99 of 100 results', response['warnings']['Service1'][1])
+        self.assertEquals(response['contents']['Service2'], {'num_results': 0, 'results': []})
+        self.assertEquals(response['errors']['Service3']['status_code'], 502)
+
+    @override_settings(RESPONSE_COMPRESSION_THRESHOLD=100)
+    def test_serialize_response(self):
+        from ac_mediator.exceptions import ACAPIServiceTimeout
+
+        # Responses collected without decoding service contents serialize to the same JSON as decoded responses
+        response_id = self.aggregator.create_response(3, status='PR')
+        large_contents = {'results': [{'ac:name': 'perro ladrando {0} ñ'.format(i)} for i in range(100)]}
+        self.aggregator.aggregate_response(response_id, 'Service1', large_contents, ['Warning'])
+        self.aggregator.aggregate_response(response_id, 'Service2', {'results': []})
+        self.aggregator.aggregate_response(response_id, 'Service3', ACAPIServiceTimeout())
+        response = self.aggregator.collect_response(response_id)
+        serialized_response = self.aggregator.collect_response(response_id, serialized=True)
+        self.assertIsInstance(serialized_response['contents']['Service1'], bytes)
+        decoded_response = json.loads(self.aggregator.serialize_response(serialized_response).decode('utf-8'))
+        for response in [response, decoded_response]:
+            del response['meta']['current_timestamp']
+            response['meta']['response_id'] = str(response['meta']['response_id'])
+        self.assertEquals(decoded_response, response)
+
+        # Sections without service responses are serialized as empty dictionaries
+        response_id = self.aggregator.create_response(1, status='PR')
+        decoded_response = json.loads(self.aggregator.serialize_response(
+            self.aggregator.collect_response(response_id, serialized=True)).decode('utf-8'))
+        self.assertEquals([decoded_response[section] for section in ['contents', 'warnings', 'errors']], [{}] * 3)
+
+    def test_concurrent_aggregation(self):
+
+        # Responses aggregated concurrently from different threads are all stored
+        from concurrent.futures import ThreadPoolExecutor
+        n_services = 20
+        response_id = self.aggregator.create_response(n_services)
+        self.aggregator.set_response_to_processing(response_id)
+        with ThreadPoolExecutor(max_workers=n_services) as executor:
+            for i in range(0, n_services):
+                executor.submit(self.aggregator.aggregate_response, response_id, 'Service{0}'.format(i),
+                                {'results': [i]}, ['Warning{0}'.format(i)] if i % 2 else None)
+        response = self.aggregator.collect_response(response_id)
+        self.assertEquals(response['meta']['status'], 'FI')
+        self.assertEquals(response['meta']['n_received_responses'], n_services)
+        self.assertEquals(len(response['contents']), n_services)
+        self.assertEquals(response['contents']['Service3'], {'results': [3]})
+        self.assertEquals(response['warnings'], {'Service{0}'.format(i): ['Warning{0}'.format(i)]
+                                                 for i in range(1, n_services, 2)})
+
+
+class InMemoryResponseAggregatorTestCase(ResponseAggregatorTestCase):
+
+    def setUp(self):
+        from api.response_aggregator import ResponseAggregator, InMemoryStoreBackend
+        self.aggregator = ResponseAggregator(store_backend=InMemoryStoreBackend)
+
+    def get_stored_value(self, response_id, field):
+        return self.aggregator.store.responses[str(response_id)]['values'][field]
+
+    def get_expiry_time(self, response_id):
+        return self.aggregator.store.responses[str(response_id)]['expires_at'] - time.time()
+
+    def test_corrupted_compressed_value(self):
+        self.skipTest('Values of in-memory responses are not stored outside of the process')
+
+    def get_stored_keys(self, response_id):
+        return [key for key in self.aggregator.store.responses if key == str(response_id)]
+
+    def test_response_expiry(self):
+        store = self.aggregator.store
+
+        # Responses can be retrieved before they expire
+        with override_settings(RESPONSE_EXPIRY_TIME=0.5):
+            response_id = self.aggregator.create_response(1, status='PR')
+        self.assertEquals(self.aggregator.collect_response(response_id)['meta']['status'], 'PR')
+        self.assertEquals(store.get_stats()['hits'], 1)
+
+        # Expired responses are removed once accessed
+        time.sleep(0.5)
+        self.assertEquals(self.aggregator.collect_response(response_id), None)
+        self.assertEquals(self.aggregator.aggregate_response(response_id, 'Service1', {'results': []}), None)
+        stats = store.get_stats()
+        self.assertEquals((stats['misses'], stats['expirations'], stats['n_responses'], stats['size']), (1, 1, 0, 0))
+
+    def test_response_eviction(self):
+        store = self.aggregator.store
+        contents = {'results': ['dog barking'] * 10}
+        response_ids = [self.aggregator.create_response(1, status='PR') for _ in range(3)]
+        self.aggregator.aggregate_response(response_ids[0], 'Service1', contents)
+        self.assertEquals(store.get_stats()['n_responses'], 3)
+
+        # When the size limit is exceeded the least recently used responses are evicted
+        self.aggregator.collect_response(response_ids[0])
+        max_size = store.get_stats()['size'] + len(json.dumps(contents, separators=(',', ':'))) - 1
+        with override_settings(RESPONSE_STORE_MEMORY_MAX_SIZE=max_size):
+            self.aggregator.aggregate_response(response_ids[2], 'Service1', contents)
+        self.assertEquals(self.aggregator.collect_response(response_ids[1]), None)
+        self.assertEquals(self.aggregator.collect_response(response_ids[0])['contents']['Service1'], contents)
+        self.assertEquals(self.aggregator.collect_response(response_ids[2])['contents']['Service1'], contents)
+        self.assertEquals(store.get_stats()['evictions'], 1)
+
+
+class RequestDistributorTestCase(TestCase):
+
+    def setUp(self):
+
+        # Create fake services which return their name as response contents
+        from services.acservice.base import BaseACService
+        from services.acservice.licensing import ACLicensingMixin
+
+        class FakeService(BaseACService, ACLicensingMixin):
+            LICENSING_ACID_DOMAINS = ['FakeService']
+
+            def get_licensing_url(self, context, acid, *args, **kwargs):
+                return 'http://test.url/for/{0}/{1}'.format(self.name, acid)
+
+        self.services = list()
+        for count in range(0, 3):
+            service = type('FakeService{0}'.format(count), (FakeService, ), {'NAME': 'FakeService{0}'.format(count)})()
+            service.configure({'service_id': 'fakeservice{0}'.format(count), 'enabled': 'yes'})
+            self.services.append(service)
+        self.request = {
+            'context': {'format': settings.JSON_FORMAT_KEY, 'user_account_id': None, 'dev_account_id': None},
+            'component': 'licensing',
+            'method': 'license',
+            'kwargs': {'acid': 'FakeService:123'},
+        }
+
+    def get_service_by_id(self, service_id):
+        return [service for service in self.services if service.id == service_id][0]
+
+    def test_dispatch_backends(self):
+        from api.request_distributor import RequestDistributor, ThreadPoolDispatchBackend, \
+            SynchronousDispatchBackend, CeleryFanOutDispatchBackend, perform_requests_and_aggregate
+        with mock.patch('api.request_distributor.get_available_services', return_value=self.services), \
+                mock.patch('api.request_distributor.get_service_by_id', side_effect=self.get_service_by_id), \
+                mock.patch.object(perform_requests_and_aggregate, 'delay', side_effect=perform_requests_and_aggregate):
+            # NOTE: Celery tasks are run in the current process instead of being sent to the workers
+            for dispatch_backend in [SynchronousDispatchBackend, ThreadPoolDispatchBackend,
+                                     CeleryFanOutDispatchBackend]:
+                distributor = RequestDistributor(dispatch_backend=dispatch_backend)
+                response = distributor.process_request(self.request, wait_until_complete=True, timeout=5)
+                self.assertEquals(response['meta']['status'], 'FI')
+                self.assertEquals(response['meta']['n_received_responses'], len(self.services))
+                for service in self.services:
+                    self.assertEquals(response['contents'][service.name]['license_url'],
+                                      'http://test.url/for/{0}/FakeService:123'.format(service.name))
+
+    def test_memory_store_backend_requires_non_celery_dispatch_backend(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from api.request_distributor import get_dispatch_backend_class, ThreadPoolDispatchBackend, \
+            SynchronousDispatchBackend, CeleryFanOutDispatchBackend
+        with override_settings(RESPONSE_STORE_BACKEND='memory', DEBUG=False):
+            for backend_name in ['celery', 'celery_fanout']:
+                with override_settings(REQUEST_DISPATCH_BACKEND=backend_name):
+                    with self.assertRaises(ImproperlyConfigured):
+                        get_dispatch_backend_class()
+            with override_settings(REQUEST_DISPATCH_BACKEND='threads'):
+                self.assertEquals(get_dispatch_backend_class(), ThreadPoolDispatchBackend)
+
+            # Celery is not used in DEBUG mode unless settings.USE_CELERY_IN_DEBUG_MODE
+            with override_settings(REQUEST_DISPATCH_BACKEND='celery_fanout', DEBUG=True,
+                                   USE_CELERY_IN_DEBUG_MODE=False):
+                self.assertEquals(get_dispatch_backend_class(), SynchronousDispatchBackend)
+        with override_settings(RESPONSE_STORE_BACKEND='redis', REQUEST_DISPATCH_BACKEND='celery_fanout', DEBUG=False):
+            self.assertEquals(get_dispatch_backend_class(), CeleryFanOutDispatchBackend)
+
+    def test_request_deadline(self):
+        from api.request_distributor import RequestDistributor, SynchronousDispatchBackend
+
+        # Make the last service hang so it does not respond before the deadline
+        async def get_licensing_url_async(context, acid, *args, **kwargs):
+            await asyncio.sleep(10)
+        self.services[-1].get_licensing_url_async = get_licensing_url_async
+
+        with mock.patch('api.request_distributor.get_available_services', return_value=self.services), \
+                mock.patch('api.request_distributor.get_service_by_id', side_effect=self.get_service_by_id):
+            distributor = RequestDistributor(dispatch_backend=SynchronousDispatchBackend)
+            response = distributor.process_request(self.request, wait_until_complete=True, timeout=0.5)
+            self.assertEquals(response['meta']['status'], 'FI')
+            self.assertEquals(response['meta']['n_received_responses'], len(self.services))
+            for service in self.services[:-1]:
+                self.assertIn(service.name, response['contents'])
+            self.assertEquals(response['errors'][self.services[-1].name]['status_code'], 504)
+
+    def test_request_coalescing(self):
+        from api.request_distributor import RequestDistributor, SynchronousDispatchBackend
+        distributor = RequestDistributor(dispatch_backend=SynchronousDispatchBackend)
+        with mock.patch('api.request_distributor.get_available_services', return_value=self.services), \
+                mock.patch('api.request_distributor.get_service_by_id', side_effect=self.get_service_by_id), \
+                mock.patch.object(distributor.dispatch_backend, 'dispatch',
+                                  wraps=distributor.dispatch_backend.dispatch) as dispatch:
+
+            # Identical requests share the same response and are only dispatched once
+            self.request['kwargs']['acid'] = 'FakeService:{0}'.format(uuid.uuid4())  # Not coalesced with other runs
+            response = distributor.process_request(self.request, coalesce=True)
+            self.request['context']['user_account_id'] = 1234  # Requests from other users are also coalesced
+            self.assertEquals(str(distributor.process_request(self.request, coalesce=True)['meta']['response_id']),
+                              str(response['meta']['response_id']))
+            self.assertEquals(dispatch.call_count, 1)
+
+            # Different requests or requests without coalescing get a new response
+            self.assertNotEquals(str(distributor.process_request(self.request)['meta']['response_id']),
+                                 str(response['meta']['response_id']))
+            self.request['kwargs']['acid'] = 'FakeService:{0}'.format(uuid.uuid4())
+            self.assertNotEquals(str(distributor.process_request(self.request, coalesce=True)['meta']['response_id']),
+                                 str(response['meta']['response_id']))
+            self.assertEquals(dispatch.call_count, 3)
+
+            # Requests with a different timeout are not coalesced
+            response = distributor.process_request(self.request, coalesce=True, timeout=1)
+            self.assertNotEquals(str(distributor.process_request(self.request, coalesce=True, timeout=2)['meta']
+                                     ['response_id']), str(response['meta']['response_id']))
+            self.assertEquals(dispatch.call_count, 5)
+
+    @override_settings(DELETE_RESPONSES_AFTER_CONSUMED=True)
+    def test_coalesced_response_not_deleted_when_collected(self):
+        from api.request_distributor import RequestDistributor, SynchronousDispatchBackend, response_aggregator
+        distributor = RequestDistributor(dispatch_backend=SynchronousDispatchBackend)
+        with mock.patch('api.request_distributor.get_available_services', return_value=self.services), \
+                mock.patch('api.request_distributor.get_service_by_id', side_effect=self.get_service_by_id):
+            self.request['kwargs']['acid'] = 'FakeService:{0}'.format(uuid.uuid4())  # Not coalesced with other runs
+
+            # The response is finished (requests are synchronous) and collected, but other clients can still get it
+            response_id = distributor.process_request(self.request, coalesce=True)['meta']['response_id']
+            response = distributor.process_request(self.request, coalesce=True)
+            self.assertEquals(str(response['meta']['response_id']), str(response_id))
+            self.assertEquals(response['meta']['n_received_responses'], len(self.services))
+            self.assertIsNotNone(response_aggregator.collect_response(response_id))
+
+            # Responses of requests which are not coalesced are deleted
+            response_id = distributor.process_request(self.request)['meta']['response_id']
+            self.assertIsNone(response_aggregator.collect_response(response_id))
+
+    def test_circuit_breaker_fast_fail(self):
+        from api.request_distributor import RequestDistributor, SynchronousDispatchBackend, circuit_breaker
+
+        # Open the circuit breaker of one of the services
+        for count in range(0, settings.SERVICE_CIRCUIT_BREAKER_FAILURE_THRESHOLD):
+            circuit_breaker.record_failure(self.services[0].id)
+        try:
+            with mock.patch('api.request_distributor.get_available_services', return_value=self.services), \
+                    mock.patch('api.request_distributor.get_service_by_id', side_effect=self.get_service_by_id):
+                distributor = RequestDistributor(dispatch_backend=SynchronousDispatchBackend)
+                response = distributor.process_request(self.request, wait_until_complete=True, timeout=5)
+                self.assertEquals(response['meta']['status'], 'FI')
+                self.assertEquals(response['errors'][self.services[0].name]['status_code'], 503)
+                for service in self.services[1:]:
+                    self.assertIn(service.name, response['contents'])
+        finally:
+            circuit_breaker.r.delete(circuit_breaker.get_breaker_key(self.services[0].id))
@@ -4,6 +4,7 @@ from api import views
 urlpatterns = [
     url(r'^v1/services/$', views.services, name='api-services'),
     url(r'^v1/collect/$', views.collect_response, name='api-collect'),
+    url(r'^v1/stream/$', views.stream_response, name='api-stream'),
     url(r'^v1/search/text/$', views.text_search, name='api-text-search'),
     url(r'^v1/license/$', views.licensing, name='api-licensing'),
     url(r'^v1/download/$', views.download, name='api-download'),
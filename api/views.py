@@ -1,17 +1,25 @@
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
+from rest_framework.utils.encoders import JSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
 from ac_mediator.exceptions import *
 from api.request_distributor import get_request_distributor
 from api.response_aggregator import get_response_aggregator
 from services.mgmt import get_available_services
+from services.circuit_breaker import get_circuit_breaker
 from services.acservice.constants import *
+from services.acservice.utils import parse_filter
 from django.conf import settings
 from accounts.models import Account
+import itertools
+import json
+import math
 
 
 request_distributor = get_request_distributor()
 response_aggregator = get_response_aggregator()
+circuit_breaker = get_circuit_breaker()
 
 
 def get_request_context(request):
@@ -53,10 +61,21 @@ def parse_request_distributor_query_params(request):
         exclude = exclude.split(',')
     wait_until_complete = \
         request.GET.get(QUERY_PARAM_WAIT_UNTIL_COMPLETE, False)  # This option is left intentionally undocumented
+    timeout = request.GET.get(QUERY_PARAM_TIMEOUT, None)
+    if timeout is not None:
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            raise ACAPIBadRequest("Invalid '{0}' value".format(QUERY_PARAM_TIMEOUT))
+        # NOTE: 'nan' and 'inf' are valid floats but would make the deadline of the request undefined or unbounded
+        if not math.isfinite(timeout) or timeout <= 0:
+            raise ACAPIBadRequest("Invalid '{0}' value (must be greater than 0)".format(QUERY_PARAM_TIMEOUT))
+        timeout = min(timeout, settings.MAX_REQUEST_TIMEOUT)
     return {
         QUERY_PARAM_INCLUDE: include,
         QUERY_PARAM_EXCLUDE: exclude,
         'wait_until_complete': wait_until_complete,
+        'timeout': timeout,
     }
 
 
@@ -147,8 +166,17 @@ def collect_response(request):
         See the :ref:`aggregated-responses` section for more information.
 
         :query rid: response id to collect
+        :query wait: if provided, wait up to this number of seconds for the response to change before returning it
+        :query received: number of received responses (``n_received_responses``) in the last version of the response collected by the client (only used with ``wait``)
+        :query since: version (``version``) of the response last collected by the client. If provided, only results from services received after that version are returned
+
+        :reqheader If-None-Match: ``ETag`` of the response last collected by the client
+
+        :resheader ETag: identifies the current version of the response
 
         :statuscode 200: no error
+        :statuscode 304: the response did not change within the ``wait`` time, or has not changed since the version given with ``since`` or ``If-None-Match``
+        :statuscode 400: wrong query parameters provided
         :statuscode 401: no authentication details provided
         :statuscode 404: response object with the provided id does not exist
 
@@ -166,12 +194,116 @@ def collect_response(request):
         ``warnings``            Dictionary with a list of warnings from each individual services. Keys in the dictionary correspond to service names.
         ``errors``              Dictionary with error responses from the individual services. Keys in the dictionary correspond to service names.
         ======================  =====================================================
+
+        Instead of repeatedly polling this endpoint, clients can use the ``wait`` parameter so that
+        the request blocks until a new service response is received or the status of the response
+        changes (or until ``wait`` seconds have passed, in which case an empty response with status
+        code 304 is returned). Setting ``received`` to the ``n_received_responses`` value of the last
+        collected response makes the request return immediately if some responses were received
+        since then. Finished responses are always returned immediately.
+
+        Every time the response is updated its ``version`` (in ``meta``) is increased. To avoid downloading
+        the same results several times, clients can set the ``since`` parameter to the ``version`` of
+        the last collected response, in which case ``contents``, ``warnings`` and ``errors`` only
+        include the results of the services received after that version (an empty response with status
+        code 304 is returned if the response did not change). ``since`` can be combined with ``wait``.
+        Alternatively, the ``ETag`` header of the last collected response can be sent in the ``If-None-Match``
+        header so that an empty response with status code 304 is returned if the response did not change (the
+        complete response is returned otherwise).
     """
     context = get_request_context(request)
-    response = response_aggregator.collect_response(request.GET.get('rid'), format=context['format'])
+    response_id = request.GET.get('rid')
+    wait = request.GET.get(QUERY_PARAM_WAIT, None)
+    since = request.GET.get(QUERY_PARAM_SINCE, None)
+    n_received_responses = request.GET.get(QUERY_PARAM_RECEIVED, None)
+    try:
+        if wait is not None:
+            wait = min(float(wait), settings.MAX_REQUEST_TIMEOUT)
+        if since is not None:
+            since = int(since)
+        if n_received_responses is not None:
+            n_received_responses = int(n_received_responses)
+    except ValueError:
+        raise ACAPIBadRequest("Invalid '{0}', '{1}' or '{2}' value".format(
+            QUERY_PARAM_WAIT, QUERY_PARAM_SINCE, QUERY_PARAM_RECEIVED))
+    if wait is not None and wait > 0:
+        if not response_aggregator.wait_until_changed(
+                response_id, wait, n_received_responses=n_received_responses, version=since):
+            return Response(status=304)
+    # NOTE: the response is collected without decoding the (already JSON encoded) contents of each service and it
+    # is returned without using the renderer so that potentially large responses are not decoded and encoded again
+    response = response_aggregator.collect_response(
+        response_id, format=context['format'], since=since, serialized=True)
     if response is None:
         raise ACAPIResponseDoesNotExist
-    return Response(response)
+    # The ETag includes the response id so that ETags of other responses with the same version never match
+    etag = '"{0}-{1}"'.format(response_id, response['meta']['version'])
+    if response['meta']['version'] == since or etag == request.META.get('HTTP_IF_NONE_MATCH', None):
+        return Response(status=304, headers={'ETag': etag})
+    http_response = HttpResponse(response_aggregator.serialize_response(response), content_type='application/json')
+    http_response['ETag'] = etag
+    return http_response
+
+
+def format_server_sent_event(event, data):
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data, cls=JSONEncoder))
+
+
+@api_view(['GET'])
+def stream_response(request):
+    """
+    .. http:get:: /stream/
+
+        Stream the contents of the response designated by the query parameter rid as
+        `Server-Sent Events <https://html.spec.whatwg.org/multipage/server-sent-events.html>`_.
+        Results from each individual service are sent as soon as these are received so that there is no
+        need to poll the :ref:`collect-response-endpoint`. The connection is closed once the response is finished.
+
+        :query rid: response id to stream
+
+        :statuscode 200: no error
+        :statuscode 401: no authentication details provided
+        :statuscode 404: response object with the provided id does not exist
+
+        **Response**
+
+        The following events are sent:
+
+        ======================  =====================================================
+        Event                   Data
+        ======================  =====================================================
+        ``status``              ``meta`` dictionary of the aggregated response (see :ref:`aggregated-responses`). This event is sent when the stream starts and, for the last time, when the response is finished (``status`` = ``FI``).
+        ``service``             Response of an individual service. Includes the service name (``service``), and the ``contents`` or ``errors`` returned by the service (and ``warnings``, if any).
+        ======================  =====================================================
+
+        For example:
+
+        .. code::
+
+            event: status
+            data: {"response_id": "9097e3bb-2cc8-4f99-89ec-2dfbe1739e67", "status": "PR", ...}
+
+            event: service
+            data: {"service": "Freesound", "contents": {...}, "warnings": [...]}
+
+            event: service
+            data: {"service": "Jamendo", "errors": {"status_code": 504, ...}}
+
+            event: status
+            data: {"response_id": "9097e3bb-2cc8-4f99-89ec-2dfbe1739e67", "status": "FI", ...}
+    """
+    context = get_request_context(request)
+    # The format is checked when calling stream_response so that errors are returned before the stream is started
+    events = response_aggregator.stream_response(request.GET.get('rid'), format=context['format'])
+    first_event = next(events, None)
+    if first_event is None:
+        raise ACAPIResponseDoesNotExist
+    response = StreamingHttpResponse(
+        (format_server_sent_event(event, data) for event, data in itertools.chain([first_event], events)),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
+    return response
 
 
 @api_view(['GET'])
@@ -185,6 +317,10 @@ def services(request):
 
         Returned services can be filtered using the ``component`` query parameter.
 
+        The ``circuit_breaker`` property of each service indicates whether requests are currently being forwarded
+        to the service (``closed``), are not being forwarded because the service has been failing (``open``),
+        or whether the mediator is checking if the service has recovered (``half-open``).
+
         :query component: only return services that implement this component
 
         :statuscode 200: no error
@@ -214,7 +350,8 @@ def services(request):
                                 ]
                             }
                         },
-                        "url": "http://www.freesound.org"
+                        "url": "http://www.freesound.org",
+                        "circuit_breaker": "closed"
                     },
                     "Jamendo": {
                         "id": "tya056c0",
@@ -232,7 +369,8 @@ def services(request):
                                 ]
                             }
                         },
-                        "url": "http://www.jamendo.com"
+                        "url": "http://www.jamendo.com",
+                        "circuit_breaker": "closed"
                     }
                 },
                 "count": 2
@@ -247,6 +385,7 @@ def services(request):
             'url': service.url,
             'components': service.implemented_components,
             'description': service.get_service_description(),
+            'circuit_breaker': circuit_breaker.get_state(service.id),
         } for service in services}
     })
 
@@ -284,7 +423,9 @@ def text_search(request):
         allows you to define complex and expressive filters combining different metadata fields. Nevertheless, not all
         third party services support such filters. If a service does not support some of the field names, values or
         filter operators specified with the ``f`` parameter, an error will be raised. A list of filters supported by
-        each third party service is provided via the `services description endpoint <#get--services->`_.
+        each third party service is provided via the `services description endpoint <#get--services->`_. Filters
+        which do not follow the syntax described below are rejected with a 400 error (no request is sent to any
+        service).
 
         Filters are specified with the following syntax:
 
@@ -307,7 +448,8 @@ def text_search(request):
             f=field_name:["value_form","value_to"]
 
         Filters can be combined using ``OR``, ``AND`` or ``NOT`` operators. Precedence can be indicated using
-        parentheses ``()``. Operators are required when adding more than one filter:
+        parentheses ``()`` (up to 32 nested parentheses and ``NOT`` operators). Operators are required when adding more
+        than one filter:
 
         .. code-block:: none
 
@@ -486,16 +628,25 @@ def text_search(request):
     # if q is None or not q.strip():
     #    raise ACAPIBadRequest("Missing or invalid query parameter: '{0}'".format(QUERY_PARAM_QUERY))
     f = request.GET.get(QUERY_PARAM_FILTER, None)
+    if f is not None:
+        # Filters are parsed once here and services get the parsed filter (see parse_filter), so that invalid filters
+        # are rejected before sending any request to the services
+        try:
+            f = parse_filter(f)
+        except ACFilterParsingException as e:
+            raise ACAPIBadRequest("Invalid '{0}' value: {1}".format(QUERY_PARAM_FILTER, e.msg))
     s = request.GET.get(QUERY_PARAM_SORT, None)
     if s is not None and (s not in SORT_OPTIONS and s not in ['-{0}'.format(opt) for opt in SORT_OPTIONS]):
         raise ACAPIBadRequest("Invalid query parameter: '{0}'. Should be one of [{1}].".format(
             QUERY_PARAM_SORT, ', '.join(SORT_OPTIONS)))
+    # Text search requests are made to 3rd party services with API key authentication, therefore results do not depend
+    # on the end user and identical requests can share the same response (see RequestDistributor.process_request)
     response = request_distributor.process_request({
         'context': get_request_context(request),
         'component': SEARCH_TEXT_COMPONENT,
         'method': 'text_search',
         'kwargs': dict(q=q, f=f, s=s, common_search_params=search_qp),
-    }, **parse_request_distributor_query_params(request))
+    }, coalesce=True, **parse_request_distributor_query_params(request))
     return Response(response)
 
 
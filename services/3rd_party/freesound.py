@@ -349,6 +349,9 @@ class FreesoundService(BaseACService, ACServiceAuthMixin, ACServiceTextSearchMix
     DOWNLOAD_ACID_DOMAINS = [NAME]
 
     def get_download_url(self, context, acid, *args, **kwargs):
+        return run_sync(self.get_download_url_async(context, acid, *args, **kwargs))
+
+    async def get_download_url_async(self, context, acid, *args, **kwargs):
 
         # Translate ac resource id to Freesound resource id
         if not acid.startswith(self.id_prefix):
@@ -359,7 +362,7 @@ class FreesoundService(BaseACService, ACServiceAuthMixin, ACServiceTextSearchMix
         except ValueError:
             raise ACAPIInvalidACID
 
-        response = self.send_request(
+        response = await self.send_request_async(
             self.API_BASE_URL + 'sounds/{0}/download/link/'.format(resource_id),
             use_authentication_method=ENDUSER_AUTH_METHOD,
             account=Account.objects.get(id=context['user_account_id']),
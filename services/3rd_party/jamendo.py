@@ -221,10 +221,13 @@ class JamendoService(BaseACService, ACServiceAuthMixin, ACServiceTextSearchMixin
     LICENSING_ACID_DOMAINS = [NAME]
 
     def get_licensing_url(self, context, acid, *args, **kwargs):
+        return run_sync(self.get_licensing_url_async(context, acid, *args, **kwargs))
+
+    async def get_licensing_url_async(self, context, acid, *args, **kwargs):
         if not acid.startswith(self.id_prefix):
             raise ACAPIInvalidACID
         resource_id = acid[len(self.id_prefix):]
-        response = self.send_request(
+        response = await self.send_request_async(
             self.TEXT_SEARCH_ENDPOINT_URL,
             params={'id': resource_id, 'include': 'licenses'},
         )
@@ -236,6 +239,9 @@ class JamendoService(BaseACService, ACServiceAuthMixin, ACServiceTextSearchMixin
     DOWNLOAD_ACID_DOMAINS = [NAME]
 
     def get_download_url(self, context, acid, *args, **kwargs):
+        return run_sync(self.get_download_url_async(context, acid, *args, **kwargs))
+
+    async def get_download_url_async(self, context, acid, *args, **kwargs):
 
         # Translate ac resource id to Jamendo resource id
         if not acid.startswith(self.id_prefix):
@@ -246,7 +252,7 @@ class JamendoService(BaseACService, ACServiceAuthMixin, ACServiceTextSearchMixin
         except ValueError:
             raise ACAPIInvalidACID
 
-        response = self.send_request(
+        response = await self.send_request_async(
             self.API_BASE_URL + 'tracks/',
             params={'id': resource_id}
         )
@@ -1,10 +1,41 @@
-from ac_mediator.exceptions import ImproperlyConfiguredACService, ACException
+from ac_mediator.exceptions import ImproperlyConfiguredACService, ACException, ACAPIServiceTimeout, \
+    ACAPIServiceUnavailable
 from services.acservice.constants import *
+from services.acservice.utils import run_sync, is_service_failure, LatencyTracker, get_service_event_loop
+from services.circuit_breaker import get_circuit_breaker
+from django.conf import settings
+import asyncio
+import aiohttp
 import requests
 import logging
+import threading
+import time
+from collections import Counter
 
 requests_logger = logging.getLogger('requests_sent')
 
+circuit_breaker = get_circuit_breaker()
+
+
+async def read_response(client_response, method):
+    """
+    Read the contents of an aiohttp response and return an equivalent requests.models.Response object. In this
+    way `BaseACService.validate_response_status_code` (and its implementations in individual services) can deal
+    with responses independently of the HTTP client library used to make the request.
+    :param client_response: response object (of type aiohttp.ClientResponse)
+    :param method: request method (either 'get' or 'post')
+    :return: response object (of type requests.models.Response)
+    """
+    response = requests.models.Response()
+    response.status_code = client_response.status
+    response.reason = client_response.reason
+    response.url = str(client_response.url)
+    response.headers = requests.structures.CaseInsensitiveDict(client_response.headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.request = requests.Request(method.upper(), response.url).prepare()
+    response._content = await client_response.read()
+    return response
+
 
 class BaseACService(object):
     """
@@ -19,6 +50,10 @@ class BaseACService(object):
     API_BASE_URL = 'http://example.com/api/'
     service_id = None
     implemented_components = None
+    connect_timeout = None
+    read_timeout = None
+    hedge_requests = False
+    latency_tracker = None
 
     def configure(self, config):
         # Do main configuration
@@ -26,6 +61,15 @@ class BaseACService(object):
             raise ImproperlyConfiguredACService('Missing item \'service_id\'')
         self.set_service_id(config['service_id'])
 
+        # Configure timeouts for the requests made to the service
+        self.set_request_timeouts(config.get('connect_timeout', None), config.get('read_timeout', None))
+
+        # Configure hedging of the requests made to the service
+        self.set_request_hedging(config.get('hedge_requests', 'no') == 'yes', config.get('hedge_budget', None))
+
+        # Init storage for response warnings (see BaseACService.add_response_warning)
+        self._response_warnings_storage = threading.local()
+
         # Init implemented components to empty list
         # Each configuration method from every component is responsible for filling this list
         self.implemented_components = list()
@@ -43,6 +87,35 @@ class BaseACService(object):
         """
         self.service_id = service_id
 
+    def set_request_timeouts(self, connect_timeout=None, read_timeout=None):
+        """
+        Set the timeouts used in requests made to the service (see BaseACService.send_request_async).
+        :param connect_timeout: seconds to wait for a connection to be established (defaults to settings.DEFAULT_SERVICE_CONNECT_TIMEOUT)
+        :param read_timeout: seconds to wait for data to be received (defaults to settings.DEFAULT_SERVICE_READ_TIMEOUT)
+        """
+        try:
+            self.connect_timeout = float(connect_timeout or settings.DEFAULT_SERVICE_CONNECT_TIMEOUT)
+            self.read_timeout = float(read_timeout or settings.DEFAULT_SERVICE_READ_TIMEOUT)
+        except ValueError:
+            raise ImproperlyConfiguredACService('Invalid \'connect_timeout\' or \'read_timeout\' values')
+
+    def set_request_hedging(self, hedge_requests, hedge_budget=None):
+        """
+        Configure hedging of GET requests made to the service (see BaseACService.send_request_async). The latencies
+        of requests made to the service are tracked (even if hedging is not enabled) to decide when to hedge.
+        :param hedge_requests: whether to hedge requests or not
+        :param hedge_budget: maximum ratio of hedged requests (defaults to settings.SERVICE_REQUEST_HEDGING_BUDGET)
+        """
+        try:
+            hedge_budget = float(hedge_budget or settings.SERVICE_REQUEST_HEDGING_BUDGET)
+        except ValueError:
+            raise ImproperlyConfiguredACService('Invalid \'hedge_budget\' value')
+        self.hedge_requests = hedge_requests
+        self.latency_tracker = LatencyTracker(
+            window_size=settings.SERVICE_LATENCY_WINDOW_SIZE,
+            min_samples=settings.SERVICE_REQUEST_HEDGING_MIN_SAMPLES,
+            budget_ratio=hedge_budget)
+
     def get_service_description(self):
         """
         Returns a structured description of the capabilities of each component implemented
@@ -68,6 +141,7 @@ class BaseACService(object):
         """
         Make a request to the service. If not provided, this method automatically chooses
         a suitable authentication method for making the request.
+        This is a synchronous wrapper around `BaseACService.send_request_async`.
         :param method: request method (either 'get' or 'post')
         :param url: endpoint api url
         :param params: request parameters in a dictionary
@@ -76,6 +150,35 @@ class BaseACService(object):
         :param account: user account (for enduser authentication only)
         :return: dictionary of json response (can raise exception if status_code!=200)
         """
+        return run_sync(self.send_request_async(
+            url,
+            method=method,
+            params=params,
+            data=data,
+            supported_auth_methods=supported_auth_methods,
+            account=account,
+            use_authentication_method=use_authentication_method))
+
+    async def send_request_async(self,
+                                 url,
+                                 method='get',
+                                 params=None,
+                                 data=None,
+                                 supported_auth_methods=None,
+                                 account=None,
+                                 use_authentication_method=None):
+        """
+        Asynchronous version of `BaseACService.send_request`. The request is made with a non-blocking HTTP client
+        so that a single event loop can keep many requests to 3rd party services in flight.
+        See `BaseACService.send_request` for the description of the parameters.
+        If the service does not accept the connection or send data within the configured timeouts (see
+        BaseACService.set_request_timeouts), ACAPIServiceTimeout is raised.
+        If hedging is enabled for the service (see BaseACService.set_request_hedging), GET requests are hedged
+        (see BaseACService.perform_hedged_request_async).
+        Requests go through the circuit breaker of the service (see services.circuit_breaker). If the breaker is
+        open, no request is made and ACAPIServiceUnavailable is raised.
+        :return: dictionary of json response (can raise exception if status_code!=200)
+        """
         if method not in ['get', 'post']:
             raise ACException('Request method {0} not in allowed methods'.format(method))
         if params is None:
@@ -118,13 +221,88 @@ class BaseACService(object):
         requests_logger.info(log_line)
 
         # Make the request!
-        r = getattr(requests, method)(
-            url,
-            params=params,
-            data=data,
-            headers=headers)
-        # TODO: log request object somewhere?
-        return self.validate_response_status_code(r)
+        # NOTE: like requests, query parameters with None values are not sent and other values are sent as strings
+        params = {key: str(value) for key, value in params.items() if value is not None}
+        use_circuit_breaker = settings.SERVICE_CIRCUIT_BREAKER_ENABLED
+        if use_circuit_breaker and not circuit_breaker.allow_request(self.id):
+            raise ACAPIServiceUnavailable
+        try:
+            if method == 'get' and self.hedge_requests:
+                # GET requests are idempotent, therefore these can be safely sent twice
+                r = await self.perform_hedged_request_async(method, url, params, data, headers)
+            else:
+                r = await self.perform_request_async(method, url, params, data, headers)
+            # TODO: log request object somewhere?
+            response = self.validate_response_status_code(r)
+        except asyncio.CancelledError:
+            # Request was abandoned (e.g. the request deadline passed), this says nothing about the service
+            raise
+        except Exception as e:
+            if use_circuit_breaker:
+                if is_service_failure(e):
+                    circuit_breaker.record_failure(self.id)
+                else:
+                    circuit_breaker.record_success(self.id)
+            raise
+        if use_circuit_breaker:
+            circuit_breaker.record_success(self.id)
+        return response
+
+    async def perform_request_async(self, method, url, params, data, headers):
+        """
+        Send a single HTTP request to the service and record its latency. Requests are made using the HTTP client
+        session shared by all the requests of the process (see services.acservice.utils.ServiceEventLoop) so that
+        connections to the service are reused.
+        :return: response object (of type requests.models.Response)
+        """
+        if self.latency_tracker is not None:
+            self.latency_tracker.add_request()
+        start_time = time.monotonic()
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        try:
+            session = get_service_event_loop().get_client_session()
+            async with session.request(
+                    method,
+                    url,
+                    params=params,
+                    data=data or None,
+                    headers=headers,
+                    timeout=timeout) as client_response:
+                r = await read_response(client_response, method)
+        except asyncio.TimeoutError:
+            raise ACAPIServiceTimeout
+        if self.latency_tracker is not None:
+            self.latency_tracker.add_latency(time.monotonic() - start_time)
+        return r
+
+    async def perform_hedged_request_async(self, method, url, params, data, headers):
+        """
+        Send an HTTP request to the service and, if no response is received within the observed latency percentile
+        of the service (settings.SERVICE_REQUEST_HEDGING_PERCENTILE), send a second identical request and use the
+        response that arrives first. Second requests are only sent if the hedging budget of the service allows it.
+        :return: response object (of type requests.models.Response)
+        """
+        hedge_delay = self.latency_tracker.get_percentile(settings.SERVICE_REQUEST_HEDGING_PERCENTILE)
+        requests_sent = [asyncio.ensure_future(self.perform_request_async(method, url, params, data, headers))]
+        try:
+            if hedge_delay is not None:  # Otherwise there are not enough latency samples to decide when to hedge
+                done, _ = await asyncio.wait(requests_sent, timeout=hedge_delay)
+                if not done and self.latency_tracker.consume_hedge_token():
+                    requests_sent.append(
+                        asyncio.ensure_future(self.perform_request_async(method, url, params, data, headers)))
+            pending = set(requests_sent)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                successful = [request for request in done if request.exception() is None]
+                if successful:
+                    return successful[0].result()
+                if not pending:
+                    # All requests failed, raise the error
+                    return done.pop().result()
+        finally:
+            for request in requests_sent:
+                if not request.done():
+                    request.cancel()
 
     def validate_response_status_code(self, response):
         """
@@ -158,21 +336,64 @@ class BaseACService(object):
         return self.implemented_components
 
     # Code to handle response warnings
-    # TODO: to be properly documented
+    # Warnings are stored per thread so that the same service instance can be used to perform several requests
+    # concurrently (see api.request_distributor.ThreadPoolDispatchBackend). Warnings are counted by message and
+    # arguments so that repeated warnings (e.g. the same warning for every result of a search response) are only
+    # stored (and returned) once.
 
-    _current_response_warnings = list()
+    _response_warnings_storage = None
 
-    def add_response_warning(self, msg):
-        # TODO: make sure we don't have nested warnings
+    @property
+    def _current_response_warnings(self):
+        if self._response_warnings_storage is None:
+            self._response_warnings_storage = threading.local()
+        if not hasattr(self._response_warnings_storage, 'warnings'):
+            self._response_warnings_storage.warnings = Counter()
+        return self._response_warnings_storage.warnings
+
+    def add_response_warning(self, msg, *args, count=1):
+        """
+        Add a warning to the response being processed.
+        :param msg: warning message (or list of warning messages). If `args` are given, `msg` is a template which
+        is formatted with `args` (and with the number of occurrences of the warning as `count`) when collecting the
+        warnings (see BaseACService.collect_response_warnings)
+        :param args: arguments of the warning (e.g. name of the field a warning refers to)
+        :param count: number of occurrences of the warning
+        """
         if type(msg) == list:
-            self._current_response_warnings += msg
+            for item in msg:
+                self.add_response_warning(item)
         else:
-            self._current_response_warnings.append(msg)
+            self._current_response_warnings[(msg, args)] += count
 
     def collect_response_warnings(self):
-        warnings = self._current_response_warnings
-        warnings = list(set(warnings))  # Remove duplicated warnings
-        return warnings
+        """
+        Return the warnings added to the response being processed (each distinct warning once).
+        :return: list of warning messages
+        """
+        return [msg.format(*args, count=count) if args else msg
+                for (msg, args), count in self._current_response_warnings.items()]
 
     def clear_response_warnings(self):
-        self._current_response_warnings = list()
+        self._current_response_warnings.clear()
+
+    async def run_sync_method_async(self, method, *args, **kwargs):
+        """
+        Run a synchronous method of the service in a thread of the event loop's default executor and return its
+        result. This is used by the default asynchronous implementations of component methods (e.g.
+        `ACLicensingMixin.get_licensing_url_async`) so that services which only implement the synchronous versions
+        keep working. These can't be called directly inside the event loop as they might call
+        `BaseACService.send_request`, which waits for the request to be performed in the loop. Warnings added by the method are added to the
+        response being processed in the current thread.
+        :param method: synchronous method to run
+        :return: result of the method
+        """
+        def run_method():
+            self.clear_response_warnings()
+            result = method(*args, **kwargs)
+            return result, dict(self._current_response_warnings)
+
+        result, warnings = await asyncio.get_event_loop().run_in_executor(None, run_method)
+        for (msg, args), count in warnings.items():
+            self.add_response_warning(msg, *args, count=count)
+        return result
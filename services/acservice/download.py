@@ -1,4 +1,5 @@
 from services.acservice.constants import *
+from services.acservice.utils import run_sync
 
 
 class ACDownloadMixin(object):
@@ -42,14 +43,37 @@ class ACDownloadMixin(object):
         """
         raise NotImplementedError("Service must implement method ACLicensingMixin.get_download_url")
 
+    async def get_download_url_async(self, context, acid, *args, **kwargs):
+        """
+        Asynchronous version of `ACDownloadMixin.get_download_url`. Services should overwrite this method so that
+        requests to the third party service are made with `BaseACService.send_request_async`, and implement
+        `ACDownloadMixin.get_download_url` as a synchronous wrapper around it. The default implementation runs the
+        synchronous method in a thread (see `BaseACService.run_sync_method_async`) so that services which only
+        implement `ACDownloadMixin.get_download_url` keep working.
+        :param context: Dict with context information for the request (see api.views.get_request_context)
+        :param acid: Audio Commons unique resource identifier
+        :return: url to download the input resource (string)
+        """
+        return await self.run_sync_method_async(self.get_download_url, context, acid, *args, **kwargs)
+
     def download(self, context, acid, *args, **kwargs):
         """
         This endpoint returns a download url and raises warnings that might contain relevant
-        information for the application. To get the URL, it uses 'get_download_url' method, therefore
-        'get_download_url' is the main method that should be overwritten by third party services.
+        information for the application. To get the URL, it uses 'get_download_url_async' method, therefore
+        'get_download_url_async' is the main method that should be overwritten by third party services.
         Raise warnings using the BaseACService.add_response_warning method.
+        This is a synchronous wrapper around `ACDownloadMixin.download_async`.
         :param context: Dict with context information for the request (see api.views.get_request_context)
         :param acid: Audio Commons unique resource identifier
         :return: url where to download the resource
         """
-        return {'download_url': self.get_download_url(context, acid, *args, **kwargs)}
+        return run_sync(self.download_async(context, acid, *args, **kwargs))
+
+    async def download_async(self, context, acid, *args, **kwargs):
+        """
+        Asynchronous version of `ACDownloadMixin.download`. The url is obtained with `ACDownloadMixin.get_download_url_async`.
+        :param context: Dict with context information for the request (see api.views.get_request_context)
+        :param acid: Audio Commons unique resource identifier
+        :return: dictionary with the url
+        """
+        return {'download_url': await self.get_download_url_async(context, acid, *args, **kwargs)}
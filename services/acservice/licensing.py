@@ -1,4 +1,5 @@
 from services.acservice.constants import *
+from services.acservice.utils import run_sync
 
 
 class ACLicensingMixin(object):
@@ -37,14 +38,37 @@ class ACLicensingMixin(object):
         """
         raise NotImplementedError("Service must implement method ACLicensingMixin.get_licensing_url")
 
+    async def get_licensing_url_async(self, context, acid, *args, **kwargs):
+        """
+        Asynchronous version of `ACLicensingMixin.get_licensing_url`. Services should overwrite this method so that
+        requests to the third party service are made with `BaseACService.send_request_async`, and implement
+        `ACLicensingMixin.get_licensing_url` as a synchronous wrapper around it. The default implementation runs the
+        synchronous method in a thread (see `BaseACService.run_sync_method_async`) so that services which only
+        implement `ACLicensingMixin.get_licensing_url` keep working.
+        :param context: Dict with context information for the request (see api.views.get_request_context)
+        :param acid: Audio Commons unique resource identifier
+        :return: url to license the input resource (string)
+        """
+        return await self.run_sync_method_async(self.get_licensing_url, context, acid, *args, **kwargs)
+
     def license(self, context, acid, *args, **kwargs):
         """
         This endpoint returns a license url along with a list of warnings that might contain relevant
-        information for the application. To get the URL, it uses 'get_licensing_url' method, therefore
-        'get_licensing_url' is the main method that should be overwritten by third party services.
+        information for the application. To get the URL, it uses 'get_licensing_url_async' method, therefore
+        'get_licensing_url_async' is the main method that should be overwritten by third party services.
         Raise warnings using the BaseACService.add_response_warning method.
+        This is a synchronous wrapper around `ACLicensingMixin.license_async`.
         :param context: Dict with context information for the request (see api.views.get_request_context)
         :param acid: Audio Commons unique resource identifier
         :return: url where to get a license
         """
-        return {'license_url': self.get_licensing_url(context, acid, *args, **kwargs)}
+        return run_sync(self.license_async(context, acid, *args, **kwargs))
+
+    async def license_async(self, context, acid, *args, **kwargs):
+        """
+        Asynchronous version of `ACLicensingMixin.license`. The url is obtained with `ACLicensingMixin.get_licensing_url_async`.
+        :param context: Dict with context information for the request (see api.views.get_request_context)
+        :param acid: Audio Commons unique resource identifier
+        :return: dictionary with the url
+        """
+        return {'license_url': await self.get_licensing_url_async(context, acid, *args, **kwargs)}
@@ -0,0 +1,48 @@
+# Reference implementation of the filter grammar using the Pyparsing library. Filters are parsed in production using
+# the hand-written parser in services.acservice.utils (see parse_filter), this grammar is only kept to check that both
+# parsers produce the same output (see services.tests) and to compare their performance (see the
+# benchmark_filter_parser management command). Relevant documentation for Pyparsing can be found here:
+# http://shop.oreilly.com/product/9780596514235.do
+
+from pyparsing import CaselessLiteral, Word, alphanums, alphas8bit, nums, quotedString, \
+    operatorPrecedence, opAssoc, removeQuotes, Literal, Group, Suppress, Combine
+
+
+def as_number_if_number(x):
+    try:
+        x = float(x[0])  # Cast to float
+        if x.is_integer():
+            x = int(x)  # If is whole number, cast to integer
+    except ValueError as e:
+        pass
+    return x  # If casting fails, return as is
+
+
+alphanums_plus = alphanums + '_'  # Allow underscore character in filter name
+float_nums = nums + '.'  # Allow float numbers
+and_ = CaselessLiteral("and")
+or_ = CaselessLiteral("or")
+not_ = CaselessLiteral("not")
+filterValueText = (Word(alphanums_plus + alphas8bit + float_nums + '-') | quotedString.setParseAction(removeQuotes))\
+    .setParseAction(as_number_if_number)
+number_or_asterisk_or_quotedString = (Literal('*') | Word(float_nums) | quotedString.setParseAction(removeQuotes)).setParseAction(as_number_if_number)
+filterValueRange = Group(Suppress(Literal('[')).suppress() + number_or_asterisk_or_quotedString + Suppress(Literal(',')).suppress() +
+                         number_or_asterisk_or_quotedString + Suppress(Literal(']')).suppress())
+fieldName = Combine(Word(alphanums) + Literal(':') + Word(alphanums_plus))  # ontologyPrefix:givenFieldName
+filterTerm = Group(fieldName + Literal(':') + (filterValueText | filterValueRange))  # ontologyPrefix:givenFieldName:filterValue
+filterExpr = operatorPrecedence(filterTerm,
+                                [
+                                    (not_, 1, opAssoc.RIGHT),
+                                    (and_, 2, opAssoc.LEFT),
+                                    (or_, 2, opAssoc.LEFT),
+                                ])
+
+
+def parse_filter_with_pyparsing(filter_string):
+    """
+    Parse a filter string using the 'filterExpr' grammar defined above.
+    Raises pyparsing.ParseException if the filter can't be parsed.
+    :param filter_string: filter string
+    :return: parsed filter as a nested list (same format as services.acservice.utils.parse_filter)
+    """
+    return filterExpr.parseString(filter_string, parseAll=True).asList()[0]
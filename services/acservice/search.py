@@ -1,7 +1,17 @@
 from ac_mediator.exceptions import ACFieldTranslateException, ACException, ACFilterParsingException
 from services.acservice.constants import *
-from services.acservice.utils import parse_filter
-import pyparsing
+from services.acservice.utils import parse_filter, run_sync, LRUCache
+from django.conf import settings
+import json
+import operator
+
+
+# Cache of filter strings translated by each service (see ACServiceTextSearchMixin.build_filter_string)
+translated_filters_cache = LRUCache(
+    'translated filters', settings.FILTER_CACHE_SIZE, settings.FILTER_CACHE_STATS_LOG_INTERVAL)
+
+# Warning added when a requested field can't be returned for some results (see BaseACService.add_response_warning)
+UNSUPPORTED_FIELD_WARNING = 'Can\'t return unsupported field {0} (number of affected results: {count})'
 
 
 def translates_field(field_name):
@@ -130,7 +140,30 @@ class BaseACServiceSearchMixin(object):
         """
         return list(self.direct_fields_mapping.keys()) + list(self.translate_field_methods_registry.keys())
 
-    def translate_single_result(self, result, target_fields, format):
+    def compile_fields_plan(self, target_fields):
+        """
+        Compile the list of Audio Commons fields to return into a "plan" which can be used to translate all the
+        results of a response (see BaseACServiceSearchMixin.translate_single_result) without having to look up
+        how each field is translated for every result. Fields in self.direct_fields_mapping are translated with an
+        item getter for the corresponding service field, and fields in self.translate_field_methods_registry with
+        the registered method (same precedence as in BaseACServiceSearchMixin.translate_field).
+        :param target_fields: list of Audio Commons fields to return
+        :return: tuple with a list of (Audio Commons field name, function that returns the value of the field for a
+        given result) tuples and the list of Audio Commons fields which are not supported by the service
+        """
+        direct_fields_mapping = self.direct_fields_mapping  # Only build the mapping once
+        fields_plan = list()
+        unsupported_fields = list()
+        for ac_field_name in target_fields or list():
+            if ac_field_name in direct_fields_mapping:
+                fields_plan.append((ac_field_name, operator.itemgetter(direct_fields_mapping[ac_field_name])))
+            elif ac_field_name in self.translate_field_methods_registry:
+                fields_plan.append((ac_field_name, self.translate_field_methods_registry[ac_field_name]))
+            else:
+                unsupported_fields.append(ac_field_name)
+        return fields_plan, unsupported_fields
+
+    def translate_single_result(self, result, target_fields, format, fields_plan=None):
         """
         Take an individual search result from a service response in the form of a dictionary
         and translate its keys and values to an Audio Commons API compatible format.
@@ -139,20 +172,23 @@ class BaseACServiceSearchMixin(object):
         :param result: dictionary representing a single result entry form a service response
         :param target_fields: list of Audio Commons fields to return
         :param format: format with which the response should be returned. Defaults to JSON.
+        :param fields_plan: plan compiled for target_fields with BaseACServiceSearchMixin.compile_fields_plan. When
+        translating several results, the plan should be compiled once and passed here (in that case warnings for
+        unsupported fields are not added here). If not provided, it is compiled for this result.
         :return: dictionary representing the single result with keys and values compatible with Audio Commons API
         """
+        if fields_plan is None:
+            fields_plan, unsupported_fields = self.compile_fields_plan(target_fields)
+            for ac_field_name in unsupported_fields:
+                self.add_response_warning(UNSUPPORTED_FIELD_WARNING, ac_field_name)
         translated_result = dict()
-        if target_fields is None:
-            target_fields = list()  # Avoid non iterable error
-        for ac_field_name in target_fields:
+        for ac_field_name, get_field_value in fields_plan:
             try:
-                trans_field_value = self.translate_field(ac_field_name, result)
-            except ACFieldTranslateException as e:
+                translated_result[ac_field_name] = get_field_value(result)
+            except Exception:  # Use generic catch on purpose (see BaseACServiceSearchMixin.translate_field)
                 # Uncomment following line if we want to set field to None if can't be translated
                 # translated_result[ac_field_name] = None
-                self.add_response_warning("Can't return unsupported field {0}".format(ac_field_name))
-                continue
-            translated_result[ac_field_name] = trans_field_value
+                self.add_response_warning(UNSUPPORTED_FIELD_WARNING, ac_field_name)
         return translated_result
 
     def format_search_response(self, response, common_search_params, format):
@@ -165,12 +201,18 @@ class BaseACServiceSearchMixin(object):
         :param format: format with which the response should be returned. Defaults to JSON.
         :return: dictionary with search results properly formatted
         """
+        target_fields = common_search_params.get('fields', None)
+        fields_plan, unsupported_fields = self.compile_fields_plan(target_fields)
         results = list()
         for result in self.get_results_list_from_response(response):
             translated_result = \
-                self.translate_single_result(result,
-                                             target_fields=common_search_params.get('fields', None), format=format)
+                self.translate_single_result(result, target_fields=target_fields, format=format,
+                                             fields_plan=fields_plan)
             results.append(translated_result)
+        if results:
+            # Unsupported fields are not returned for any of the results
+            for ac_field_name in unsupported_fields:
+                self.add_response_warning(UNSUPPORTED_FIELD_WARNING, ac_field_name, count=len(results))
         return {
             NUM_RESULTS_PROP: self.get_num_results_from_response(response),
             RESULTS_LIST: results,
@@ -382,8 +424,8 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
     def process_filter_element(self, elm, filter_list):
         """
         In the Audio Commons API filters are passed as a string which can represent complex structures. For instance
-        a filter could be defined as "ac:format:wav AND ac:duration:[10,40]". ACServiceTextSearchMixin parses this
-        string (see services.acservice.utils.parse_filter) and transforms it into a nested list of elements. This method
+        a filter could be defined as "ac:format:wav AND ac:duration:[10,40]". This string is parsed (see
+        services.acservice.utils.parse_filter) and transformed into a nested list of elements. This method
         takes one of this elements and processes it accordingly. To "process" a filter element means to first identify
         what kind of element it is. Elements can be:
             - a) a filter term like ("field_name", ":" "filter_value")
@@ -395,7 +437,7 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
         which are supposed to be overwritten by services which support filtering queries. Before rendering the filters,
         this method calls `ACServiceTextSearchMixin.translate_filter` to get the translated field names and values that
         are understood by the third party service.
-        :param elm: filter element as returned by parser (will be of type pyparsing.ParseResults)
+        :param elm: filter element as returned by parser (a nested list, see services.acservice.utils.FilterParser)
         :param filter_list: list of processed filter element that's recursively passed to process_filter_element
         :return: None (output must be read from filter_list, see `ACServiceTextSearchMixin.build_filter_string`)
         """
@@ -417,7 +459,7 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
             # Translate key and value for the ones the 3rd party service understands
             fkey = elm[0]
             fvalue = elm[2]
-            if type(fvalue) == pyparsing.ParseResults and len(fvalue) == 2:
+            if type(fvalue) == list and len(fvalue) == 2:
                 # If filter is of type range, translate the values per separate
                 key, value1 = self.translate_filter(fkey, fvalue[0])
                 _, value2 = self.translate_filter(fkey, fvalue[1])
@@ -438,7 +480,7 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
             # If element is an operator, render and add it to the filter list
             filter_list.append(self.render_operator_term(elm.upper()))
 
-        elif type(elm) == pyparsing.ParseResults:
+        elif type(elm) == list:
             # If element is a more complex structure, walk it recursively and add precedence elements () if needed
 
             if not is_not_structure(elm):
@@ -457,15 +499,36 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
         values of the individual third party service. Raises `ACFilterParsingException` if problems occur during filter
         parsing. For instance, an input filter like "ac:format:wav AND ac:duration:[2,10]" could be translated to
         something like "format=wav+duration=[2 TO 10]".
-        :param filter_input_value: input filter string
+        Filters of text search requests are parsed in the API view (see api.views.text_search) and services get the
+        parsed filter, which is a JSON serializable nested list (see services.acservice.utils.parse_filter).
+        Translated filters (or the errors raised when translating them) are cached per service, therefore the
+        translation of filters must only depend on the parsed filter (and the service).
+        :param filter_input_value: parsed filter (or input filter string)
+        :return: output (translated) filter string
+        """
+        if isinstance(filter_input_value, str):
+            filter_input_value = parse_filter(filter_input_value)
+        cache_key = (self.id, json.dumps(filter_input_value))
+        cached_translation = translated_filters_cache.get(cache_key)
+        if cached_translation is None:
+            try:
+                cached_translation = (self.translate_parsed_filter(filter_input_value), None)
+            except ACFilterParsingException as e:
+                cached_translation = (None, (e.msg, e.status))
+            translated_filters_cache.set(cache_key, cached_translation)
+        filter_string, error = cached_translation
+        if error is not None:
+            raise ACFilterParsingException(*error)  # Raise a new exception for every request
+        return filter_string
+
+    def translate_parsed_filter(self, parsed_filter):
+        """
+        Translate a parsed filter without using the cache (see ACServiceTextSearchMixin.build_filter_string).
+        :param parsed_filter: parsed filter (see services.acservice.utils.parse_filter)
         :return: output (translated) filter string
         """
-        try:
-            parsed_filter = parse_filter(filter_input_value)
-        except pyparsing.ParseException:
-            raise ACFilterParsingException('Could not parse filter: "{0}"'.format(filter_input_value))
         out_filter_list = list()
-        self.process_filter_element(parsed_filter[0], out_filter_list)
+        self.process_filter_element(parsed_filter, out_filter_list)
         if out_filter_list[0] == '(':
             # If out filter list starts with an opening parenthesis, remove first and last positions ad both will
             # correspond to redundant parentheses
@@ -474,6 +537,14 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
         return filter_string
 
     def text_search(self, context, q, f, s, common_search_params):
+        """
+        Synchronous wrapper around `ACServiceTextSearchMixin.text_search_async`. See that method for the
+        description of the parameters.
+        :return: formatted text search response as dictionary
+        """
+        return run_sync(self.text_search_async(context, q, f, s, common_search_params))
+
+    async def text_search_async(self, context, q, f, s, common_search_params):
         """
         This function a search request to the third party service and returns a formatted json
         response as a dictionary if the response status code is 200 or raises an exception otherwise.
@@ -494,7 +565,7 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
 
         :param context: Dict with context information for the request (see api.views.get_request_context)
         :param q: textual input query
-        :param f: query filter
+        :param f: parsed query filter (see services.acservice.utils.parse_filter)
         :param s: sorting criteria
         :param common_search_params: dictionary with other search parameters commons to all kinds of search
         :return: formatted text search response as dictionary
@@ -535,7 +606,7 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
         query_params.update(params_to_add)
 
         # Send request and process response
-        response = self.send_request(self.TEXT_SEARCH_ENDPOINT_URL, params=query_params)
+        response = await self.send_request_async(self.TEXT_SEARCH_ENDPOINT_URL, params=query_params)
         formatted_response = self.format_search_response(response, common_search_params, format=context['format'])
         return formatted_response
 
@@ -562,7 +633,8 @@ class ACServiceTextSearchMixin(BaseACServiceSearchMixin):
         The query parameters are returned as a dictionary where keys and values will be sent as keys and values of
         query parameters in the request to the third party service. Typically the returned query parameters dictionary
         will only contain one key/value pair.
-        :param f: query filter
+        Filters should be translated using `ACServiceTextSearchMixin.build_filter_string`.
+        :param f: parsed query filter (see services.acservice.utils.parse_filter)
         :return: query parameters dict
         """
         raise NotImplementedError("Parameter '{0}' not supported".format(QUERY_PARAM_FILTER))
@@ -1,7 +1,259 @@
+from ac_mediator.exceptions import ACException, ACAPIException, ACAPIServiceTimeout, ACFilterParsingException
 from services.acservice.constants import LICENSE_UNKNOWN, LICENSE_CC0, LICENSE_CC_BY, LICENSE_CC_BY_NC, \
     LICENSE_CC_BY_NC_ND, LICENSE_CC_BY_NC_SA, LICENSE_CC_BY_ND, LICENSE_CC_BY_SA, LICENSE_CC_SAMPLING_PLUS
-from pyparsing import CaselessLiteral, Word, alphanums, alphas8bit, nums, quotedString, \
-    operatorPrecedence, opAssoc, removeQuotes, Literal, Group, Suppress, Combine
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import asyncio
+import atexit
+import collections
+import logging
+import os
+import re
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceEventLoop(object):
+    """
+    Long-lived event loop in which the requests to 3rd party services made by a process are performed. The loop runs
+    in a dedicated (daemon) thread and coroutines are submitted to it from other threads (see `run_sync` and
+    `run_async`), so that a single process can have many requests in flight at the same time. Requests made in the
+    loop share a pool of HTTP connections (see ServiceEventLoop.get_client_session) so that connections to services
+    are kept alive and reused. The loop is created lazily and re-created if the process has been forked after its
+    creation (e.g. by Celery or uwsgi), as threads of the parent process do not exist in the child process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.loop_pid = None
+        self.thread = None
+        self.client_session = None
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None or self.loop_pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                executor = ThreadPoolExecutor(max_workers=settings.SERVICE_EVENT_LOOP_EXECUTOR_SIZE)
+                self.loop.set_default_executor(executor)
+                self.loop_pid = os.getpid()
+                self.client_session = None
+                self.thread = threading.Thread(target=self.run_loop, args=(self.loop, ), name='ServiceEventLoop',
+                                               daemon=True)
+                self.thread.start()
+            return self.loop
+
+    @staticmethod
+    def run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Schedule the given coroutine in the loop.
+        :param coroutine: coroutine to run
+        :return: concurrent.futures.Future object with the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop())
+
+    def is_loop_thread(self):
+        return self.thread is threading.current_thread() and self.loop_pid == os.getpid()
+
+    def get_client_session(self):
+        """
+        Return the HTTP client session shared by all the requests made in the loop. The number of open connections
+        of the session is limited to settings.SERVICE_HTTP_MAX_CONNECTIONS (requests wait for a free connection
+        otherwise). This must be called from a coroutine running in the loop.
+        :return: aiohttp.ClientSession object
+        """
+        if not self.is_loop_thread():
+            raise RuntimeError('The HTTP client session can only be used by coroutines running in the service loop '
+                               '(see run_sync and run_async)')
+        if self.client_session is None:
+            self.client_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=settings.SERVICE_HTTP_MAX_CONNECTIONS))
+        return self.client_session
+
+    def close(self):
+        """
+        Close the HTTP client session (and its connections) and stop the loop.
+        """
+        with self.lock:
+            if self.loop is None or self.loop_pid != os.getpid():
+                return
+            if self.client_session is not None:
+                asyncio.run_coroutine_threadsafe(self.client_session.close(), self.loop).result()
+                self.client_session = None
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+
+
+service_event_loop = ServiceEventLoop()
+atexit.register(service_event_loop.close)
+
+
+def get_service_event_loop():
+    return service_event_loop
+
+
+def run_sync(coroutine):
+    """
+    Run the given coroutine in the event loop of the process (see ServiceEventLoop) and wait for its result. This is
+    used to implement the synchronous versions of service methods (e.g. `BaseACService.send_request`) as thin wrappers
+    around their asynchronous counterparts (e.g. `BaseACService.send_request_async`). It must not be called from
+    coroutines running in the loop (these should await the asynchronous versions instead).
+    """
+    if service_event_loop.is_loop_thread():
+        coroutine.close()
+        raise RuntimeError('run_sync can not be called from a coroutine running in the service loop')
+    return service_event_loop.submit(coroutine).result()
+
+
+def run_async(coroutine):
+    """
+    Run the given coroutine in the event loop of the process (see ServiceEventLoop) without waiting for it to finish.
+    Unexpected exceptions raised by the coroutine are logged.
+    :return: concurrent.futures.Future object with the result of the coroutine
+    """
+    def log_exception(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Unhandled exception in coroutine run in the service loop', exc_info=future.exception())
+
+    future = service_event_loop.submit(coroutine)
+    future.add_done_callback(log_exception)
+    return future
+
+
+def is_service_failure(exception):
+    """
+    Return whether an error returned when making a request to a service indicates that the service is failing or
+    overloaded (e.g. a timeout or a 5xx status code) as opposed to errors caused by the request itself (e.g. a
+    resource which does not exist).
+    :param exception: exception raised when making the request
+    :return: True if the error indicates a failure of the service
+    """
+    if isinstance(exception, ACAPIServiceTimeout):
+        return True
+    if not isinstance(exception, (ACException, ACAPIException)):
+        return True  # Unexpected errors (e.g. connection errors)
+    return isinstance(exception.status, int) and (exception.status >= 500 or exception.status == 429)
+
+
+class LatencyTracker(object):
+    """
+    Keeps track of the latencies of the most recent requests made to a service and of a budget of extra (hedged)
+    requests that can be made to it (see BaseACService.send_request_async). The budget works like a token bucket:
+    every request adds `budget_ratio` tokens (up to `max_tokens`) and every hedged request consumes one token.
+    In this way the number of hedged requests is at most `budget_ratio` times the number of requests.
+    As services are shared by the threads of a process, the tracker is thread safe.
+    """
+
+    def __init__(self, window_size, min_samples, budget_ratio, max_tokens=10):
+        self.latencies = collections.deque(maxlen=window_size)
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+        self.lock = threading.Lock()
+
+    def add_request(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.budget_ratio)
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def get_percentile(self, percentile):
+        """
+        Return the given percentile of the tracked latencies or None if there are not enough samples.
+        :param percentile: percentile to compute (0-100)
+        :return: latency in seconds
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+    def consume_hedge_token(self):
+        """
+        Consume a token from the hedging budget if one is available.
+        :return: True if a hedged request can be made, False otherwise
+        """
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LRUCache(object):
+    """
+    Cache which keeps up to `max_size` items and discards the least recently used ones when full. Hits and misses
+    are counted so that the hit rate of the cache can be monitored (see LRUCache.get_stats), and stats are logged
+    every `stats_log_interval` lookups (if given). As caches are shared by the threads of a process, the cache is
+    thread safe.
+    """
+
+    def __init__(self, name, max_size, stats_log_interval=None):
+        self.name = name
+        self.max_size = max_size
+        self.stats_log_interval = stats_log_interval
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get an item from the cache (and mark it as the most recently used).
+        :param key: key of the item
+        :return: cached item (or None if it is not cached)
+        """
+        with self.lock:
+            value = self.items.get(key, None)
+            if value is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            log_stats = self.stats_log_interval and (self.hits + self.misses) % self.stats_log_interval == 0
+        if log_stats:
+            stats = self.get_stats()
+            logger.info('Cache of {0}: {1} hits, {2} misses (hit rate {3:.2f}), {4} items'.format(
+                self.name, stats['hits'], stats['misses'], stats['hit_rate'], stats['size']))
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def get_stats(self):
+        """
+        Get the number of hits and misses of the cache, its hit rate and the number of cached items.
+        :return: dictionary with 'hits', 'misses', 'hit_rate' (None if the cache has not been used) and 'size'
+        """
+        with self.lock:
+            n_lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / n_lookups if n_lookups else None,
+                'size': len(self.items),
+            }
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
 
 
 def translate_cc_license_url(url):
@@ -21,13 +273,40 @@ def translate_cc_license_url(url):
     return LICENSE_UNKNOWN
 
 
-# Util functions for parsing filters, define grammar and parsing functions
-# Parsing is done using Pyparsing library. Relevant documentation for Pyparsing can be found here:
-# http://shop.oreilly.com/product/9780596514235.do
+# Util functions for parsing filters. Filter strings are split into tokens using a regular expression (see
+# tokenize_filter) and parsed by a precedence parser (see FilterParser). The parser produces the same output as the
+# Pyparsing grammar originally used to parse filters (see services.acservice.pyparsing_filter_grammar), but it is
+# much faster on nested expressions and does not need to build the grammar when the module is imported.
+
+FILTER_WHITESPACE = r'[ \t\n\r]*'
+FILTER_QUOTED_STRING = r'"(?:[^"\n\r\\]|(?:"")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*"' \
+                       r"|'(?:[^'\n\r\\]|(?:'')|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*'"
+FILTER_TOKEN_RE = re.compile(
+    '{ws}(?:'
+    # Filter term: ontologyPrefix:givenFieldName:filterValue where filterValue is a text, a number, a quoted string
+    # or a range like [value,value] (range values can be numbers, quoted strings or *)
+    '(?P<field>[A-Za-z0-9]+:[A-Za-z0-9_]+){ws}:{ws}(?:'
+    '(?P<text>[A-Za-z0-9_.\\-\xc0-\xd6\xd8-\xf6\xf8-\xff]+)|(?P<quoted>{quoted})|'
+    '\\[{ws}(?P<range_start>\\*|[0-9.]+|{quoted}){ws},{ws}(?P<range_end>\\*|[0-9.]+|{quoted}){ws}\\])'
+    # Operators (case insensitive) and parentheses
+    '|(?P<operator>(?i:and|or|not))|(?P<parenthesis>[()]))'.format(ws=FILTER_WHITESPACE, quoted=FILTER_QUOTED_STRING))
+FILTER_END_RE = re.compile('{0}$'.format(FILTER_WHITESPACE))
+
+# Operators in order of precedence (highest first) and their number of operands
+FILTER_OPERATORS = [
+    ('not', 1),
+    ('and', 2),
+    ('or', 2),
+]
+
+# Maximum number of nested parentheses and NOT operators in a filter (deeper filters are rejected so that parsing
+# and translating filters does not exhaust the recursion limit)
+FILTER_MAX_NESTING_DEPTH = 32
+
 
 def as_number_if_number(x):
     try:
-        x = float(x[0])  # Cast to float
+        x = float(x)  # Cast to float
         if x.is_integer():
             x = int(x)  # If is whole number, cast to integer
     except ValueError as e:
@@ -35,30 +314,135 @@ def as_number_if_number(x):
     return x  # If casting fails, return as is
 
 
-alphanums_plus = alphanums + '_'  # Allow underscore character in filter name
-float_nums = nums + '.'  # Allow float numbers
-and_ = CaselessLiteral("and")
-or_ = CaselessLiteral("or")
-not_ = CaselessLiteral("not")
-filterValueText = (Word(alphanums_plus + alphas8bit + float_nums + '-') | quotedString.setParseAction(removeQuotes))\
-    .setParseAction(as_number_if_number)
-number_or_asterisk_or_quotedString = (Literal('*') | Word(float_nums) | quotedString.setParseAction(removeQuotes)).setParseAction(as_number_if_number)
-filterValueRange = Group(Suppress(Literal('[')).suppress() + number_or_asterisk_or_quotedString + Suppress(Literal(',')).suppress() +
-                         number_or_asterisk_or_quotedString + Suppress(Literal(']')).suppress())
-fieldName = Combine(Word(alphanums) + Literal(':') + Word(alphanums_plus))  # ontologyPrefix:givenFieldName
-filterTerm = Group(fieldName + Literal(':') + (filterValueText | filterValueRange))  # ontologyPrefix:givenFieldName:filterValue
-filterExpr = operatorPrecedence(filterTerm,
-                                [
-                                    (not_, 1, opAssoc.RIGHT),
-                                    (and_, 2, opAssoc.LEFT),
-                                    (or_, 2, opAssoc.LEFT),
-                                ])
+def filter_value(text):
+    """
+    Return the value of a filter term (or of one side of a range) as written in a filter string. Quotes are removed
+    from quoted strings and values are cast to numbers when possible.
+    """
+    if text[0] in '"\'':
+        text = text[1:-1]
+    return as_number_if_number(text)
+
+
+def tokenize_filter(filter_string):
+    """
+    Split a filter string into tokens. Tokens are tuples like ('term', [field_name, ':', value]) where value
+    is a number or a string (or a list with two values for ranges), ('operator', 'and'|'or'|'not') or
+    ('parenthesis', '('|')'). Raises `ACFilterParsingException` if the filter contains invalid characters.
+    :param filter_string: filter string
+    :return: list of tokens
+    """
+    expanded_filter_string = filter_string.expandtabs()  # Like Pyparsing does (affects tabs inside quoted values)
+    tokens = list()
+    position = 0
+    while not FILTER_END_RE.match(expanded_filter_string, position):
+        match = FILTER_TOKEN_RE.match(expanded_filter_string, position)
+        if match is None:
+            raise ACFilterParsingException('Could not parse filter: "{0}"'.format(filter_string))
+        if match.group('field') is not None:
+            if match.group('range_start') is not None:
+                value = [filter_value(match.group('range_start')), filter_value(match.group('range_end'))]
+            else:
+                value = filter_value(match.group('text') or match.group('quoted'))
+            tokens.append(('term', [match.group('field'), ':', value]))
+        elif match.group('operator') is not None:
+            tokens.append(('operator', match.group('operator').lower()))
+        else:
+            tokens.append(('parenthesis', match.group('parenthesis')))
+        position = match.end()
+    return tokens
+
+
+class FilterParser(object):
+    """
+    Parser for the tokens of a filter string (see tokenize_filter). Each level of precedence of FILTER_OPERATORS is
+    parsed by a call to FilterParser.parse_expression which parses the operands using the next (higher) level of
+    precedence. Binary operators are left associative and consecutive operators of the same level are grouped
+    together, e.g. "A AND B AND C OR D" is parsed as [[A, 'and', B, 'and', C], 'or', D] where A, B, C and D are
+    filter terms like ['ac:format', ':', 'wav'] or ['ac:duration', ':', [10, 40]]. Filters with more than
+    FILTER_MAX_NESTING_DEPTH nested parentheses and NOT operators are not parsed.
+    """
+
+    def __init__(self, filter_string):
+        self.filter_string = filter_string
+        self.tokens = tokenize_filter(filter_string)
+        self.position = 0
+        self.depth = 0
+
+    def parse(self):
+        """
+        Parse the filter string. Raises `ACFilterParsingException` if the filter can't be parsed.
+        :return: parsed filter as a nested list of filter terms and operators
+        """
+        parsed_filter = self.parse_expression(len(FILTER_OPERATORS) - 1)
+        if self.position != len(self.tokens):
+            self.raise_error()
+        return parsed_filter
+
+    def raise_error(self, reason=None):
+        msg = 'Could not parse filter: "{0}"'.format(self.filter_string)
+        if reason is not None:
+            msg += ' ({0})'.format(reason)
+        raise ACFilterParsingException(msg)
+
+    def enter_nested_expression(self):
+        self.depth += 1
+        if self.depth > FILTER_MAX_NESTING_DEPTH:
+            self.raise_error('more than {0} nested parentheses and NOT operators'.format(FILTER_MAX_NESTING_DEPTH))
+
+    def next_token_is(self, kind, value):
+        return self.position < len(self.tokens) and self.tokens[self.position] == (kind, value)
+
+    def parse_expression(self, level):
+        if level < 0:
+            return self.parse_operand()
+        operator, n_operands = FILTER_OPERATORS[level]
+        if n_operands == 1:
+            if self.next_token_is('operator', operator):
+                self.position += 1
+                self.enter_nested_expression()
+                parsed_filter = [operator, self.parse_expression(level)]
+                self.depth -= 1
+                return parsed_filter
+            return self.parse_expression(level - 1)
+        elements = [self.parse_expression(level - 1)]
+        while self.next_token_is('operator', operator):
+            self.position += 1
+            elements += [operator, self.parse_expression(level - 1)]
+        return elements if len(elements) > 1 else elements[0]
+
+    def parse_operand(self):
+        if self.position == len(self.tokens):
+            self.raise_error()
+        kind, value = self.tokens[self.position]
+        self.position += 1
+        if kind == 'term':
+            return value
+        if (kind, value) != ('parenthesis', '('):
+            self.raise_error()
+        self.enter_nested_expression()
+        parsed_filter = self.parse_expression(len(FILTER_OPERATORS) - 1)
+        if not self.next_token_is('parenthesis', ')'):
+            self.raise_error()
+        self.position += 1
+        self.depth -= 1
+        return parsed_filter
+
+
+# Cache of parsed filter strings (see settings.FILTER_CACHE_SIZE)
+parsed_filters_cache = LRUCache('parsed filters', settings.FILTER_CACHE_SIZE, settings.FILTER_CACHE_STATS_LOG_INTERVAL)
 
 
 def parse_filter(filter_string):
     """
-    Parse a filter string using the 'filterExpr' grammar defined above.
-    This function returns a pyparsing.ParseResults object that should be further
-    processed with the build_filter_string method of a ACServiceTextSearchMixin instance.
+    Parse a filter string using FilterParser. Raises `ACFilterParsingException` if the filter can't be parsed.
+    This function returns a nested list of filter terms and operators that should be further
+    processed with the build_filter_string method of a ACServiceTextSearchMixin instance. The returned list only
+    contains strings, numbers and lists, therefore it can be serialized as JSON and sent to the workers.
+    Parsed filters are cached (the returned object is shared and must not be modified).
     """
-    return filterExpr.parseString(filter_string, parseAll=True)
+    parsed_filter = parsed_filters_cache.get(filter_string)
+    if parsed_filter is None:
+        parsed_filter = FilterParser(filter_string).parse()
+        parsed_filters_cache.set(filter_string, parsed_filter)
+    return parsed_filter
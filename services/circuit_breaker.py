@@ -0,0 +1,107 @@
+from django.conf import settings
+from utils.redis_client import get_redis_client
+import time
+
+
+CIRCUIT_BREAKER_CLOSED = 'closed'
+CIRCUIT_BREAKER_OPEN = 'open'
+CIRCUIT_BREAKER_HALF_OPEN = 'half-open'
+
+# Count a failure and open the breaker if the failure threshold is reached or if the failed request was a probe
+RECORD_FAILURE_SCRIPT = """
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+if failures >= tonumber(ARGV[1]) or redis.call('HGET', KEYS[1], 'state') == 'open' then
+    redis.call('HMSET', KEYS[1], 'state', 'open', 'opened_at', ARGV[2])
+    redis.call('DEL', KEYS[2])
+end
+return failures
+"""
+
+# Reset failures and close the breaker (nothing is written if it is closed and has no failures)
+RECORD_SUCCESS_SCRIPT = """
+local state, failures = unpack(redis.call('HMGET', KEYS[1], 'state', 'failures'))
+if state == 'open' then
+    redis.call('DEL', KEYS[2])
+end
+if state == 'open' or (failures and failures ~= '0') then
+    redis.call('HMSET', KEYS[1], 'state', 'closed', 'failures', 0)
+end
+"""
+
+
+class ServiceCircuitBreaker(object):
+    """
+    Circuit breaker for requests made to 3rd party services. The state of the breaker of each service is stored in
+    Redis so that it is shared by all web server processes and Celery workers:
+     * closed: requests are made normally. After settings.SERVICE_CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive
+       failed requests the breaker opens.
+     * open: no requests are made to the service for settings.SERVICE_CIRCUIT_BREAKER_RESET_TIMEOUT seconds.
+     * half-open: after the reset timeout, a single request (probe) is allowed. If it succeeds the breaker
+       closes, otherwise it opens again.
+    """
+
+    def __init__(self):
+        self.record_failure_script = self.r.register_script(RECORD_FAILURE_SCRIPT)
+        self.record_success_script = self.r.register_script(RECORD_SUCCESS_SCRIPT)
+
+    @property
+    def r(self):
+        # The client is shared by the whole process and re-created after forks (see utils.redis_client)
+        return get_redis_client()
+
+    @staticmethod
+    def get_breaker_key(service_id):
+        return 'breaker:{0}'.format(service_id)
+
+    @staticmethod
+    def get_probe_key(service_id):
+        return 'breaker:{0}:probe'.format(service_id)
+
+    def get_state(self, service_id):
+        """
+        Return the current state of the breaker of the service.
+        :param service_id: id of the service
+        :return: one of CIRCUIT_BREAKER_CLOSED, CIRCUIT_BREAKER_OPEN or CIRCUIT_BREAKER_HALF_OPEN
+        """
+        state, opened_at = self.r.hmget(self.get_breaker_key(service_id), 'state', 'opened_at')
+        if state is None or state.decode('utf-8') != CIRCUIT_BREAKER_OPEN:
+            return CIRCUIT_BREAKER_CLOSED
+        if time.time() - float(opened_at) >= settings.SERVICE_CIRCUIT_BREAKER_RESET_TIMEOUT:
+            return CIRCUIT_BREAKER_HALF_OPEN
+        return CIRCUIT_BREAKER_OPEN
+
+    def is_open(self, service_id):
+        return self.get_state(service_id) == CIRCUIT_BREAKER_OPEN
+
+    def allow_request(self, service_id):
+        """
+        Return whether a request can be made to the service. When the breaker is half-open, only one process
+        is allowed to make a request (probe) until the probe succeeds or fails.
+        :param service_id: id of the service
+        :return: True if the request can be made
+        """
+        state = self.get_state(service_id)
+        if state == CIRCUIT_BREAKER_CLOSED:
+            return True
+        if state == CIRCUIT_BREAKER_HALF_OPEN:
+            # The probe key expires in case the process making the probe dies before reporting the result
+            return bool(self.r.set(self.get_probe_key(service_id), 1, nx=True,
+                                   px=int(settings.SERVICE_CIRCUIT_BREAKER_RESET_TIMEOUT * 1000)))
+        return False
+
+    def record_success(self, service_id):
+        self.record_success_script(
+            keys=[self.get_breaker_key(service_id), self.get_probe_key(service_id)], client=self.r)
+
+    def record_failure(self, service_id):
+        self.record_failure_script(
+            keys=[self.get_breaker_key(service_id), self.get_probe_key(service_id)],
+            args=[settings.SERVICE_CIRCUIT_BREAKER_FAILURE_THRESHOLD, time.time()],
+            client=self.r)
+
+
+circuit_breaker = ServiceCircuitBreaker()
+
+
+def get_circuit_breaker():
+    return circuit_breaker
@@ -0,0 +1,263 @@
+from ac_mediator.exceptions import ACAPIServiceBusy
+from django.conf import settings
+from utils.redis_client import get_redis_client
+import asyncio
+import functools
+import math
+import time
+import uuid
+
+
+# Lua function which removes expired leases (KEYS[1]) and queued requests whose deadline has passed (KEYS[3] and
+# KEYS[4]) and returns the current limit (KEYS[2], or the initial limit `initial_limit` if not set)
+CLEAN_FUNCTION = """
+local function clean(now, initial_limit)
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now)
+    for i = 1, #expired do
+        redis.call('ZREM', KEYS[3], expired[i])
+        redis.call('ZREM', KEYS[4], expired[i])
+    end
+    return tonumber(redis.call('GET', KEYS[2]) or initial_limit)
+end
+"""
+
+# Try to acquire a slot with lease id ARGV[3] (expiring at ARGV[2]). A slot is acquired if it has been handed to the
+# request by RELEASE_SCRIPT or if there are free slots for all queued requests ahead of it (queued requests are
+# served in order of arrival). Otherwise, if ARGV[5] is '1', the request is added to the end of the queue (KEYS[3],
+# with its deadline ARGV[6] stored in KEYS[4]). Returns whether the slot was acquired, the number of requests which
+# need to get a slot before this one (including itself) and the current limit.
+ACQUIRE_SCRIPT = CLEAN_FUNCTION + """
+local limit = clean(ARGV[1], ARGV[4])
+if redis.call('ZSCORE', KEYS[1], ARGV[3]) then
+    return {1, 0, tostring(limit)}
+end
+local n_free = math.max(1, math.floor(limit)) - redis.call('ZCARD', KEYS[1])
+local position = redis.call('ZRANK', KEYS[3], ARGV[3]) or redis.call('ZCARD', KEYS[3])
+if position < n_free then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('ZREM', KEYS[3], ARGV[3])
+    redis.call('ZREM', KEYS[4], ARGV[3])
+    return {1, 0, tostring(limit)}
+end
+if ARGV[5] == '1' and not redis.call('ZSCORE', KEYS[3], ARGV[3]) then
+    redis.call('ZADD', KEYS[3], ARGV[1], ARGV[3])
+    redis.call('ZADD', KEYS[4], ARGV[6], ARGV[3])
+end
+return {0, position - n_free + 1, tostring(limit)}
+"""
+
+# Remove lease ARGV[1] and update limit (additive increase after successful requests, multiplicative decrease
+# otherwise). Then hand the free slots to the requests at the head of the queue: leases are added for them (expiring
+# ARGV[8] seconds after their deadline) and a token is pushed to the list '<queue key>:<lease id>' on which each
+# queued request waits (see ServiceConcurrencyLimiter.acquire). Returns the new limit.
+RELEASE_SCRIPT = CLEAN_FUNCTION + """
+redis.call('ZREM', KEYS[1], ARGV[1])
+local limit = clean(ARGV[7], ARGV[3])
+if ARGV[2] == '1' then
+    limit = math.min(tonumber(ARGV[5]), limit + 1 / limit)
+else
+    limit = math.max(tonumber(ARGV[4]), limit * tonumber(ARGV[6]))
+end
+redis.call('SET', KEYS[2], tostring(limit))
+local n_free = math.max(1, math.floor(limit)) - redis.call('ZCARD', KEYS[1])
+if n_free > 0 then
+    local waiting = redis.call('ZRANGE', KEYS[3], 0, n_free - 1)
+    for i = 1, #waiting do
+        local deadline = tonumber(redis.call('ZSCORE', KEYS[4], waiting[i]))
+        redis.call('ZADD', KEYS[1], deadline + tonumber(ARGV[8]), waiting[i])
+        redis.call('ZREM', KEYS[3], waiting[i])
+        redis.call('ZREM', KEYS[4], waiting[i])
+        local wakeup_key = KEYS[3] .. ':' .. waiting[i]
+        redis.call('RPUSH', wakeup_key, 1)
+        redis.call('EXPIRE', wakeup_key, ARGV[8])
+    end
+end
+return tostring(limit)
+"""
+
+# Remove request ARGV[1] from the queue. Returns 1 if a slot had already been handed to it (see RELEASE_SCRIPT).
+CANCEL_SCRIPT = """
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+redis.call('DEL', KEYS[3] .. ':' .. ARGV[1])
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 1
+end
+return 0
+"""
+
+
+class ServiceConcurrencyLimiter(object):
+    """
+    Limits the number of concurrent requests made to each 3rd party service. The limit and the requests currently
+    being made (leases) are stored in Redis so that they are shared by all web server processes and Celery workers.
+    The limit of each service adapts to the way the service responds (AIMD): it is increased by 1/limit after every
+    successful request (i.e. by 1 once `limit` requests have succeeded) and multiplied by
+    settings.SERVICE_CONCURRENCY_DECREASE_FACTOR after every failed or slow request.
+    Requests exceeding the limit wait in a queue and are served in order of arrival: released slots are handed to
+    the oldest queued request, which is woken up immediately. Leases expire so that slots taken by processes that die
+    while making a request are eventually released (queued requests also check for free slots every
+    settings.SERVICE_CONCURRENCY_QUEUE_RETRY_INTERVAL seconds so these are not missed).
+    Redis is accessed in the default executor of the event loop so that other requests (e.g. to other services in
+    the same fan-out, see api.request_distributor) are not blocked.
+    """
+
+    def __init__(self):
+        self.acquire_script = self.r.register_script(ACQUIRE_SCRIPT)
+        self.release_script = self.r.register_script(RELEASE_SCRIPT)
+        self.cancel_script = self.r.register_script(CANCEL_SCRIPT)
+
+    @property
+    def r(self):
+        # The client is shared by the whole process and re-created after forks (see utils.redis_client)
+        return get_redis_client()
+
+    @staticmethod
+    def get_leases_key(service_id):
+        return 'limiter:{0}:leases'.format(service_id)
+
+    @staticmethod
+    def get_limit_key(service_id):
+        return 'limiter:{0}:limit'.format(service_id)
+
+    @staticmethod
+    def get_queue_key(service_id):
+        return 'limiter:{0}:queue'.format(service_id)
+
+    @staticmethod
+    def get_queue_deadlines_key(service_id):
+        return 'limiter:{0}:queue_deadlines'.format(service_id)
+
+    @staticmethod
+    def get_wakeup_key(service_id, lease_id):
+        # NOTE: the same key is used in the Lua scripts
+        return '{0}:{1}'.format(ServiceConcurrencyLimiter.get_queue_key(service_id), lease_id)
+
+    def get_keys(self, service_id):
+        return [self.get_leases_key(service_id), self.get_limit_key(service_id), self.get_queue_key(service_id),
+                self.get_queue_deadlines_key(service_id)]
+
+    def try_acquire(self, service_id, lease_id, lease_expiry, deadline=None, enqueue=False):
+        """
+        Try to acquire a slot for making a request to the service (see ACQUIRE_SCRIPT).
+        :param service_id: id of the service
+        :param lease_id: id of the lease
+        :param lease_expiry: time (in seconds since the epoch) at which the lease expires
+        :param deadline: deadline of the request (needed if `enqueue` is set)
+        :param enqueue: whether to add the request to the queue of the service if no slot is available
+        :return: tuple with whether the slot was acquired, the number of requests which need to get a slot before
+        this one (including itself) and the current limit
+        """
+        acquired, n_waiting, limit = self.acquire_script(
+            keys=self.get_keys(service_id),
+            args=[time.time(), lease_expiry, lease_id, settings.SERVICE_CONCURRENCY_INITIAL_LIMIT,
+                  1 if enqueue else 0, deadline or 0],
+            client=self.r)
+        return acquired == 1, n_waiting, float(limit)
+
+    def cancel(self, service_id, lease_id):
+        """
+        Remove a request from the queue of the service.
+        :return: True if a slot had already been handed to the request (and must be released)
+        """
+        return self.cancel_script(keys=self.get_keys(service_id), args=[lease_id], client=self.r) == 1
+
+    def wait_for_wakeup(self, service_id, lease_id, timeout):
+        # BLPOP only accepts whole seconds and a timeout of 0 means blocking forever
+        return self.r.blpop(self.get_wakeup_key(service_id, lease_id), timeout=max(1, int(math.ceil(timeout))))
+
+    @staticmethod
+    async def run_in_executor(func, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def acquire(self, service_id, deadline=None, expected_latency=None):
+        """
+        Acquire a slot for making a request to the service. If no slot is available, wait in the queue of the service
+        until a slot is handed to this request or until the deadline passes, in which case ACAPIServiceBusy is raised.
+        If the expected latency of the service is given, ACAPIServiceBusy is raised immediately if the request would
+        not get a slot early enough to be answered before the deadline (assuming every request ahead in the queue
+        takes `expected_latency` seconds).
+        :param service_id: id of the service
+        :param deadline: time (in seconds since the epoch) until which to wait (defaults to settings.DEFAULT_REQUEST_TIMEOUT from now)
+        :param expected_latency: expected duration of requests to the service in seconds (optional)
+        :return: lease id that should be passed to ServiceConcurrencyLimiter.release
+        """
+        if deadline is None:
+            deadline = time.time() + settings.DEFAULT_REQUEST_TIMEOUT
+        lease_id = str(uuid.uuid4())
+        # Leases expire some time after the deadline as requests are abandoned once the deadline passes
+        lease_expiry = deadline + settings.SERVICE_CONCURRENCY_LEASE_MARGIN
+        acquired, n_waiting, limit = await self.run_in_executor(
+            self.try_acquire, service_id, lease_id, lease_expiry, deadline, enqueue=True)
+        if acquired:
+            return lease_id
+
+        try:
+            if expected_latency is not None and \
+                    time.time() + (math.ceil(n_waiting / max(1, math.floor(limit))) + 1) * expected_latency > deadline:
+                raise ACAPIServiceBusy
+            while time.time() < deadline:
+                # Wait until a slot is handed to this request when released (see RELEASE_SCRIPT) or until it is time to
+                # check again for free slots
+                await self.run_in_executor(self.wait_for_wakeup, service_id, lease_id, min(
+                    settings.SERVICE_CONCURRENCY_QUEUE_RETRY_INTERVAL, deadline - time.time()))
+                acquired, _, _ = await self.run_in_executor(self.try_acquire, service_id, lease_id, lease_expiry)
+                if acquired:
+                    return lease_id
+        finally:
+            if not acquired and await self.run_in_executor(self.cancel, service_id, lease_id):
+                # A slot was handed to the request after it stopped waiting, give it to the next request
+                await self.release_async(service_id, lease_id)
+        raise ACAPIServiceBusy
+
+    def release(self, service_id, lease_id, success=True):
+        """
+        Release a slot acquired with ServiceConcurrencyLimiter.acquire, update the limit of the service and hand the
+        free slots to the queued requests.
+        :param service_id: id of the service
+        :param lease_id: lease id returned by ServiceConcurrencyLimiter.acquire
+        :param success: whether the request succeeded (i.e. did not fail because of the service and was not slow)
+        :return: new limit for the service
+        """
+        return float(self.release_script(
+            keys=self.get_keys(service_id),
+            args=[lease_id, 1 if success else 0,
+                  settings.SERVICE_CONCURRENCY_INITIAL_LIMIT,
+                  settings.SERVICE_CONCURRENCY_MIN_LIMIT,
+                  settings.SERVICE_CONCURRENCY_MAX_LIMIT,
+                  settings.SERVICE_CONCURRENCY_DECREASE_FACTOR,
+                  time.time(),
+                  settings.SERVICE_CONCURRENCY_LEASE_MARGIN],
+            client=self.r))
+
+    async def release_async(self, service_id, lease_id, success=True):
+        """
+        Asynchronous version of ServiceConcurrencyLimiter.release (Redis is accessed in the default executor).
+        """
+        return await self.run_in_executor(self.release, service_id, lease_id, success)
+
+    def get_status(self, service_id):
+        """
+        Return the current limit, number of requests being made and number of queued requests for the service.
+        :param service_id: id of the service
+        :return: dictionary with 'limit', 'n_in_flight' and 'n_queued' keys
+        """
+        now = time.time()
+        pipe = self.r.pipeline()
+        pipe.get(self.get_limit_key(service_id))
+        pipe.zcount(self.get_leases_key(service_id), now, '+inf')
+        pipe.zcount(self.get_queue_deadlines_key(service_id), now, '+inf')
+        limit, n_in_flight, n_queued = pipe.execute()
+        return {
+            'limit': float(limit) if limit is not None else float(settings.SERVICE_CONCURRENCY_INITIAL_LIMIT),
+            'n_in_flight': n_in_flight,
+            'n_queued': n_queued,
+        }
+
+
+concurrency_limiter = ServiceConcurrencyLimiter()
+
+
+def get_concurrency_limiter():
+    return concurrency_limiter
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand
+from services.mgmt import get_service_by_name
+from services.acservice.constants import *
+import random
+import time
+
+
+WORDS = ['ambient', 'bird', 'city', 'dog', 'door', 'drum', 'field-recording', 'guitar', 'kick', 'loop', 'noise',
+         'piano', 'rain', 'river', 'snare', 'street', 'synth', 'traffic', 'voice', 'water', 'wind', 'wood']
+
+
+def freesound_result(rand, resource_id):
+    # Result as returned by the Freesound API with all the fields needed by FreesoundService
+    username = 'user{0}'.format(rand.randint(1, 100000))
+    return {
+        'id': resource_id,
+        'url': 'https://freesound.org/people/{0}/sounds/{1}/'.format(username, resource_id),
+        'name': ' '.join(rand.choice(WORDS) for _ in range(rand.randint(2, 6))),
+        'username': username,
+        'tags': [rand.choice(WORDS) for _ in range(rand.randint(3, 15))],
+        'description': ' '.join(rand.choice(WORDS) for _ in range(rand.randint(10, 80))),
+        'duration': round(rand.uniform(0.1, 300), 3),
+        'filesize': rand.randint(10 ** 4, 10 ** 8),
+        'channels': rand.choice([1, 2]),
+        'bitrate': rand.choice([0, 128, 320]),
+        'bitdepth': rand.choice([16, 24]),
+        'samplerate': rand.choice([44100, 48000]),
+        'type': rand.choice(['wav', 'mp3', 'flac']),
+        'pack': 'https://freesound.org/apiv2/packs/{0}/'.format(rand.randint(1, 10 ** 5)),
+        'license': rand.choice(['http://creativecommons.org/licenses/by/3.0/',
+                                'http://creativecommons.org/publicdomain/zero/1.0/']),
+        'previews': {'preview-hq-ogg': 'https://freesound.org/data/previews/{0}-hq.ogg'.format(resource_id)},
+        'images': {'waveform_m': 'https://freesound.org/data/displays/{0}_wave_M.png'.format(resource_id)},
+        'created': '2017-{0:02d}-{1:02d}T10:20:30.123456'.format(rand.randint(1, 12), rand.randint(1, 28)),
+        'ac_analysis': {
+            'ac_brightness': rand.uniform(0, 100), 'ac_roughness': rand.uniform(0, 100),
+            'ac_hardness': rand.uniform(0, 100), 'ac_depth': rand.uniform(0, 100),
+            'ac_sharpness': rand.uniform(0, 100), 'ac_warmth': rand.uniform(0, 100),
+            'ac_booming': rand.uniform(0, 100), 'ac_tempo': rand.randint(60, 180),
+            'ac_tempo_confidence': rand.random(), 'ac_note_name': 'A4', 'ac_note_midi': 69,
+            'ac_note_confidence': rand.random(), 'ac_tonality': 'A minor', 'ac_tonality_confidence': rand.random(),
+            'ac_loudness': rand.uniform(-60, 0), 'ac_single_event': rand.choice([True, False]),
+            'ac_loop': rand.choice([True, False]),
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the translation of search results (fields=*) from the Freesound format to the Audio Commons ' \
+           'format, translating each field of each result individually and using a compiled fields plan.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=150, help='Number of results in the search response')
+        parser.add_argument('--iterations', type=int, default=20, help='Number of times to translate the response')
+
+    def handle(self, *args, **options):
+        """
+        Search results are translated field by field. This command compares the time needed to translate all the
+        results of a search response calling BaseACServiceSearchMixin.translate_field for each (result, field) pair
+        (which looks up how the field is translated every time) with the time needed using a plan compiled once
+        for the whole response (see BaseACServiceSearchMixin.compile_fields_plan).
+        """
+        service = get_service_by_name('Freesound')
+        rand = random.Random(0)
+        results = [freesound_result(rand, rand.randint(1, 10 ** 6)) for _ in range(options['size'])]
+        target_fields = ALL_RESOURCE_DESCRIPTION_FIELDS
+
+        def translate_per_field():
+            translated_results = list()
+            for result in results:
+                translated_result = dict()
+                for ac_field_name in target_fields:
+                    try:
+                        translated_result[ac_field_name] = service.translate_field(ac_field_name, result)
+                    except Exception:
+                        pass
+                translated_results.append(translated_result)
+            return translated_results
+
+        def translate_with_plan():
+            fields_plan, _ = service.compile_fields_plan(target_fields)
+            return [service.translate_single_result(result, target_fields, None, fields_plan=fields_plan)
+                    for result in results]
+
+        if translate_per_field() != translate_with_plan():
+            self.stderr.write('Translated results do not match')
+        service.clear_response_warnings()
+        self.stdout.write('Translating {0} results with {1} fields'.format(len(results), len(target_fields)))
+        for label, translate in [('Per field', translate_per_field), ('Compiled plan', translate_with_plan)]:
+            start = time.time()
+            for _ in range(options['iterations']):
+                translate()
+            self.stdout.write('{0:<16} {1:>10.2f} ms'.format(
+                label, (time.time() - start) / options['iterations'] * 1000))
+        service.clear_response_warnings()
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from services.acservice.utils import FilterParser
+import importlib
+import time
+
+
+FILTERS = [
+    'ac:format:wav',
+    'ac:format:wav AND ac:duration:[10,40]',
+    'ac:license:CC0 AND ac:samplerate:44100 AND ac:channels:2',
+    'ac:tag:"field recording" AND NOT ac:tag:voice',
+    'ac:duration:[*,5] AND (ac:format:wav OR ac:format:flac OR ac:format:aiff)',
+    '(ac:tag:dog OR ac:tag:cat OR ac:tag:bird) AND ac:duration:[1,30] AND NOT (ac:license:BY-NC OR ac:license:BY-ND)',
+    'ac:brightness:[70,*] AND ac:hardness:[*,30] AND (ac:tonality:"A minor" OR ac:tonality:"C major") AND '
+    'ac:tempo:[110,130] AND ac:is_loop:1',
+    '((ac:format:wav AND ac:bitdepth:24) OR (ac:format:flac AND NOT ac:samplerate:[*,44100])) AND '
+    '(ac:tag:ambient OR (ac:tag:drone AND NOT (ac:tag:noise OR ac:tag:glitch)))',
+]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the parsing of realistic filter strings with the hand-written filter parser and with the ' \
+           'Pyparsing grammar that was used before.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help='Number of times to parse each filter')
+
+    def handle(self, *args, **options):
+        """
+        Filters are parsed with services.acservice.utils.FilterParser (parse_filter also caches parsed filters,
+        the cache is not used here). This command reports the time needed to parse each filter with FilterParser
+        and with the reference Pyparsing grammar (see services.acservice.pyparsing_filter_grammar), and the time
+        needed to build the Pyparsing grammar when importing it.
+        """
+        start = time.time()
+        pyparsing_filter_grammar = importlib.import_module('services.acservice.pyparsing_filter_grammar')
+        self.stdout.write('Pyparsing grammar import time: {0:.2f} ms'.format((time.time() - start) * 1000))
+
+        self.stdout.write('{0:>8} {1:>14} {2:>14} {3:>8}'.format('Length', 'Pyparsing ms', 'Parser ms', 'Speedup'))
+        total_times = [0.0, 0.0]
+        for filter_string in FILTERS:
+            if FilterParser(filter_string).parse() != \
+                    pyparsing_filter_grammar.parse_filter_with_pyparsing(filter_string):
+                self.stderr.write('Parsed filters do not match: {0}'.format(filter_string))
+            times = list()
+            for parse in [pyparsing_filter_grammar.parse_filter_with_pyparsing,
+                          lambda filter_string: FilterParser(filter_string).parse()]:
+                start = time.time()
+                for _ in range(options['iterations']):
+                    parse(filter_string)
+                times.append((time.time() - start) / options['iterations'])
+            total_times = [total + t for total, t in zip(total_times, times)]
+            self.stdout.write('{0:>8} {1:>14.3f} {2:>14.3f} {3:>8.1f}'.format(
+                len(filter_string), times[0] * 1000, times[1] * 1000, times[0] / times[1]))
+        self.stdout.write('{0:>8} {1:>14.3f} {2:>14.3f} {3:>8.1f}'.format(
+            'Total', total_times[0] * 1000, total_times[1] * 1000, total_times[0] / total_times[1]))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from services.mgmt import get_available_services
+from services.concurrency import get_concurrency_limiter
+
+
+class Command(BaseCommand):
+    help = 'Show the current limit of concurrent requests, the number of requests being made and the number of ' \
+           'queued requests for each 3rd party service.'
+
+    def handle(self, *args, **options):
+        """
+        The number of concurrent requests made to each 3rd party service is limited and the limit adapts to the
+        way the service responds (see services.concurrency). This command shows the current status of the limiter
+        for every available service.
+        """
+        concurrency_limiter = get_concurrency_limiter()
+        self.stdout.write('{0:<20} {1:>8} {2:>10} {3:>8}'.format('Service', 'Limit', 'In flight', 'Queued'))
+        for service in get_available_services():
+            status = concurrency_limiter.get_status(service.id)
+            self.stdout.write('{0:<20} {1:>8.2f} {2:>10} {3:>8}'.format(
+                service.name, status['limit'], status['n_in_flight'], status['n_queued']))
@@ -1,9 +1,12 @@
 import inspect
 import pkgutil
 import configparser
+import collections
 import os
+from types import MappingProxyType
 from django.conf import settings
 from services.acservice.base import BaseACService
+from services.acservice.constants import ACID_DOMAINS_DESCRIPTION_KEYWORD
 from ac_mediator.exceptions import ImproperlyConfiguredACService, ACException, ACServiceDoesNotExist
 
 SERVICES_CONFIGURATION_FILE = os.path.join(settings.BASE_DIR, 'services/services_conf.cfg')
@@ -60,26 +63,61 @@ def _configure_services(loaded_services):
 
 def _load_and_configure_services():
     loaded_services = _load_services()
-    return _configure_services(loaded_services)
+    return tuple(_configure_services(loaded_services))
+
+
+ServicesIndex = collections.namedtuple(
+    'ServicesIndex', ['by_id', 'by_name', 'by_component', 'by_component_and_acid_domain'])
+
+
+def _build_services_index(services):
+    """
+    Build indexes to look up services by id, name, component and combination of component and ACID domain.
+    Indexes are built once after services are configured so that services don't need to be scanned
+    (nor their descriptions generated) every time a request is processed. Indexes are read-only and keep
+    the order of `services`.
+    :param services: list of configured BaseACService instances
+    :return: ServicesIndex object
+    """
+    by_component = collections.OrderedDict()
+    by_component_and_acid_domain = collections.OrderedDict()
+    for service in services:
+        description = service.get_service_description()
+        for component in service.implemented_components:
+            by_component.setdefault(component, list()).append(service)
+            for acid_domain in description.get(component, dict()).get(ACID_DOMAINS_DESCRIPTION_KEYWORD, list()):
+                by_component_and_acid_domain.setdefault((component, acid_domain), list()).append(service)
+    return ServicesIndex(
+        by_id=MappingProxyType({service.id: service for service in services}),
+        by_name=MappingProxyType({service.name: service for service in services}),
+        by_component=MappingProxyType({key: tuple(value) for key, value in by_component.items()}),
+        by_component_and_acid_domain=MappingProxyType(
+            {key: tuple(value) for key, value in by_component_and_acid_domain.items()}),
+    )
 
 
 available_services = _load_and_configure_services()
+services_index = _build_services_index(available_services)
 
 
-def get_available_services(component=None, exclude=None, include=None):
+def get_available_services(component=None, exclude=None, include=None, acid_domain=None):
     """
     Get all available services which implement a particular component (or all services if
     'component' is None). Allows excluding particular services and restricting those from which to filter.
     :param component: component (mixin) that should be implemented by returned services
     :param exclude: exclude services passed through this parameter (should be a list of service names)
     :param include: consider only services passed through this parameter (should be a list of service names)
+    :param acid_domain: only return services that support this ACID domain for the given component (ignored if 'component' is None)
     :return: list of matching services (can be empty)
     """
+    if component is None:
+        candidate_services = available_services
+    elif acid_domain is None:
+        candidate_services = services_index.by_component.get(component, ())
+    else:
+        candidate_services = services_index.by_component_and_acid_domain.get((component, acid_domain), ())
     out_services = list()
-    for service in available_services:
-        if component is not None:
-            if component not in service.implemented_components:
-                continue
+    for service in candidate_services:
         if exclude is not None:
             if service.name in exclude:
                 continue
@@ -91,14 +129,14 @@ def get_available_services(component=None, exclude=None, include=None):
 
 
 def get_service_by_id(service_id):
-    for service in available_services:
-        if service.id == service_id:
-            return service
-    raise ACServiceDoesNotExist('Service with id {0} does not exist'.format(service_id))
+    try:
+        return services_index.by_id[service_id]
+    except KeyError:
+        raise ACServiceDoesNotExist('Service with id {0} does not exist'.format(service_id))
 
 
 def get_service_by_name(service_name):
-    for service in available_services:
-        if service.name == service_name:
-            return service
-    raise ACServiceDoesNotExist('Service with name {0} does not exist'.format(service_name))
+    try:
+        return services_index.by_name[service_name]
+    except KeyError:
+        raise ACServiceDoesNotExist('Service with name {0} does not exist'.format(service_name))
@@ -1,5 +1,14 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from services.mgmt import get_available_services, available_services
+from services.acservice.base import BaseACService
+from services.acservice.search import ACServiceTextSearchMixin, translates_field, translates_filter_for_field
+from services.acservice.constants import FIELD_ID, FIELD_NAME, FIELD_DURATION, FIELD_TAGS, FIELD_TAG, FIELD_FORMAT, \
+    FIELD_BRIGHTNESS
+from ac_mediator.exceptions import ACAPIServiceBusy, ACServiceDoesNotExist
+import asyncio
+import json
+import time
+import uuid
 
 
 class ServicesManagement(TestCase):
@@ -31,3 +40,570 @@ class ServicesManagement(TestCase):
         component = components[0]
         count = components.count(component)
         self.assertEquals(len(get_available_services(component=component)), count)
+
+    def test_services_index(self):
+        from services.mgmt import services_index, get_service_by_id, get_service_by_name
+        from services.acservice.constants import ACID_DOMAINS_DESCRIPTION_KEYWORD
+
+        # Check that services can be retrieved by id and name
+        for service in available_services:
+            self.assertEquals(get_service_by_id(service.id), service)
+            self.assertEquals(get_service_by_name(service.name), service)
+        with self.assertRaises(ACServiceDoesNotExist):
+            get_service_by_id('nonExistingServiceId')
+
+        # Check filtering by component and ACID domain
+        for service in available_services:
+            for component, description in service.get_service_description().items():
+                for acid_domain in description.get(ACID_DOMAINS_DESCRIPTION_KEYWORD, list()):
+                    self.assertIn(service, get_available_services(component=component, acid_domain=acid_domain))
+        self.assertEquals(len(get_available_services(
+            component=available_services[0].implemented_components[0], acid_domain='nonExistingDomain')), 0)
+
+        # Check that indexes can't be modified
+        with self.assertRaises(TypeError):
+            services_index.by_id['nonExistingServiceId'] = available_services[0]
+
+
+class AsyncServiceAPI(TestCase):
+
+    def setUp(self):
+        from services.acservice.base import BaseACService
+        from services.acservice.licensing import ACLicensingMixin
+
+        class FakeService(BaseACService, ACLicensingMixin):
+            NAME = 'AsyncService'
+            LICENSING_ACID_DOMAINS = [NAME]
+
+            async def get_licensing_url_async(self, context, acid, *args, **kwargs):
+                return 'http://test.url/license/{0}'.format(acid)
+
+        self.service = FakeService()
+        self.service.configure({'service_id': 'asyncserviceid'})
+
+    def test_sync_wrappers_use_async_implementation(self):
+        from services.acservice.utils import run_sync
+
+        # Check that the asynchronous method returns the url provided by the service
+        self.assertEquals(run_sync(self.service.license_async(None, 'AsyncService:123')),
+                          {'license_url': 'http://test.url/license/AsyncService:123'})
+
+        # Check that the synchronous wrapper returns the same response
+        self.assertEquals(self.service.license(None, 'AsyncService:123'),
+                          {'license_url': 'http://test.url/license/AsyncService:123'})
+
+    def test_async_fallback_for_sync_only_service(self):
+        from services.acservice.base import BaseACService
+        from services.acservice.licensing import ACLicensingMixin
+        from services.acservice.utils import run_sync
+
+        class SyncOnlyService(BaseACService, ACLicensingMixin):
+            NAME = 'SyncOnlyService'
+
+            async def send_request_async(self, url, *args, **kwargs):
+                return {'url': url}
+
+            def get_licensing_url(self, context, acid, *args, **kwargs):
+                # Only the synchronous method is implemented and it uses the synchronous send_request
+                self.add_response_warning('Licensing url is not final')
+                return self.send_request('http://test.url/license/{0}'.format(acid))['url']
+
+        service = SyncOnlyService()
+        service.configure({'service_id': 'synconlyserviceid'})
+
+        async def license_async():
+            service.clear_response_warnings()
+            response = await service.license_async(None, 'SyncOnlyService:123')
+            return response, service.collect_response_warnings()
+
+        # The synchronous method can't be called inside the event loop (send_request waits for the loop to run it)
+        self.assertEquals(run_sync(license_async()), ({'license_url': 'http://test.url/license/SyncOnlyService:123'},
+                                                      ['Licensing url is not final']))
+
+    def test_requests_share_event_loop_and_connections(self):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        from services.acservice.base import BaseACService
+        from services.acservice.constants import APIKEY_AUTH_METHOD
+        from services.acservice.utils import run_sync, run_async, get_service_event_loop
+        import threading
+
+        client_addresses = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep connections alive
+
+            def do_GET(self):
+                client_addresses.append(self.client_address)
+                body = json.dumps({'path': self.path}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        class HTTPService(BaseACService):
+            NAME = 'HTTPService'
+            SUPPORTED_AUTH_METHODS = [APIKEY_AUTH_METHOD]
+
+            def get_auth_info_for_request(self, auth_method, account=None):
+                return {}
+
+        server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            service = HTTPService()
+            service.configure({'service_id': 'httpserviceid'})
+            url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+
+            # Consecutive requests (even from different threads) reuse the same connection
+            self.assertEquals(service.send_request(url + 'a'), {'path': '/a'})
+            thread = threading.Thread(target=service.send_request, args=(url + 'b', ))
+            thread.start()
+            thread.join()
+            self.assertEquals(len(client_addresses), 2)
+            self.assertEquals(len(set(client_addresses)), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Coroutines run with run_async do not block the caller and run concurrently in the same loop
+        start_time = time.monotonic()
+        futures = [run_async(asyncio.sleep(0.5)) for _ in range(200)]
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        for future in futures:
+            future.result()
+        self.assertLess(time.monotonic() - start_time, 2)
+
+        # The shared HTTP client session can only be used in the loop
+        with self.assertRaises(RuntimeError):
+            get_service_event_loop().get_client_session()
+
+        async def call_run_sync():
+            return run_sync(asyncio.sleep(0))
+        with self.assertRaises(RuntimeError):
+            run_sync(call_run_sync())
+
+
+class FakeTextSearchService(BaseACService, ACServiceTextSearchMixin):
+    """
+    Text search service used in tests. Results are taken from responses like {'count': 1, 'items': [{'id': 1,
+    'title': 'Dog', 'length_ms': 1500}]} and filters are rendered like 'type:wav && (length_ms:[1000 TO 5000] ||
+    !tag:dog)'. The filters that are directly mapped to the fields of the service can be given when creating the
+    service.
+    """
+
+    NAME = 'SearchService'
+
+    def __init__(self, direct_filters_mapping=None):
+        if direct_filters_mapping is None:
+            direct_filters_mapping = {FIELD_FORMAT: 'type', FIELD_TAG: 'tag', FIELD_BRIGHTNESS: 'brightness'}
+        self._direct_filters_mapping = direct_filters_mapping
+
+    @property
+    def direct_fields_mapping(self):
+        return {FIELD_NAME: 'title'}
+
+    @translates_field(FIELD_DURATION)
+    def translate_field_duration(self, result):
+        return result['length_ms'] / 1000
+
+    def get_results_list_from_response(self, response):
+        return response['items']
+
+    def get_num_results_from_response(self, response):
+        return response['count']
+
+    @property
+    def direct_filters_mapping(self):
+        return self._direct_filters_mapping
+
+    @translates_filter_for_field(FIELD_DURATION)
+    def translate_filter_duration(self, value):
+        return 'length_ms', value * 1000 if value != '*' else value
+
+    def render_filter_term(self, key, value_text=None, value_number=None, value_range=None):
+        if value_range is not None:
+            return '{0}:[{1} TO {2}]'.format(key, *value_range)
+        return '{0}:{1}'.format(key, value_text if value_text is not None else value_number)
+
+    def render_operator_term(self, operator):
+        return {'AND': ' && ', 'OR': ' || ', 'NOT': '!'}[operator]
+
+
+class SearchResultsTranslation(TestCase):
+
+    def setUp(self):
+        self.service = FakeTextSearchService()
+        self.service.configure({'service_id': 'searchserviceid'})
+        self.target_fields = [FIELD_ID, FIELD_NAME, FIELD_DURATION, FIELD_TAGS]
+
+    def test_compile_fields_plan(self):
+
+        # Unsupported fields are identified when compiling the plan
+        fields_plan, unsupported_fields = self.service.compile_fields_plan(self.target_fields)
+        self.assertEquals([ac_field_name for ac_field_name, _ in fields_plan], self.target_fields[:3])
+        self.assertEquals(unsupported_fields, [FIELD_TAGS])
+        self.assertEquals(self.service.compile_fields_plan(None), ([], []))
+
+        # Results are translated as when translating each field individually
+        result = {'id': 5, 'title': 'Dog', 'length_ms': 1500}
+        self.assertEquals(self.service.translate_single_result(result, self.target_fields, None, fields_plan),
+                          {ac_field_name: self.service.translate_field(ac_field_name, result)
+                           for ac_field_name in self.target_fields[:3]})
+
+    def test_format_search_response(self):
+
+        # Fields that can't be translated for a result are skipped and a warning is added
+        response = self.service.format_search_response(
+            {'count': 2, 'items': [{'id': 1, 'title': 'Dog', 'length_ms': 1000}, {'id': 2, 'title': 'Cat'}]},
+            {'fields': self.target_fields}, None)
+        self.assertEquals(response['num_results'], 2)
+        self.assertEquals(response['results'][0][FIELD_DURATION], 1.0)
+        self.assertNotIn(FIELD_DURATION, response['results'][1])
+        self.assertEquals(sorted(self.service.collect_response_warnings()), [
+            "Can't return unsupported field {0} (number of affected results: 1)".format(FIELD_DURATION),
+            "Can't return unsupported field {0} (number of affected results: 2)".format(FIELD_TAGS)])
+
+        # Repeated warnings are only returned once
+        self.service.clear_response_warnings()
+        for _ in range(3):
+            self.service.add_response_warning('Maximum size is 10')
+            self.service.add_response_warning(['Maximum size is 10', 'Sorting not supported'])
+        self.assertEquals(self.service.collect_response_warnings(), ['Maximum size is 10', 'Sorting not supported'])
+
+
+class FilterCache(TestCase):
+
+    def setUp(self):
+        self.service = FakeTextSearchService()
+        self.service.configure({'service_id': 'filterserviceid'})
+        self.service_without_brightness = FakeTextSearchService(direct_filters_mapping={FIELD_FORMAT: 'type'})
+        self.service_without_brightness.configure({'service_id': 'filterservicewithoutbrightnessid'})
+
+    def test_lru_cache(self):
+        from services.acservice.utils import LRUCache
+        cache = LRUCache('test', max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)  # 'b' is the least recently used item
+        self.assertEquals((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEquals(cache.get_stats(), {'hits': 3, 'misses': 1, 'hit_rate': 0.75, 'size': 2})
+
+    def test_translated_filters_cache(self):
+        from services.acservice.search import translated_filters_cache
+        from ac_mediator.exceptions import ACFilterParsingException
+
+        # Translated filters are cached for each service
+        n = uuid.uuid4().int % 10 ** 9 + 2  # Not cached in other tests
+        f = 'ac:brightness:[1,{0}]'.format(n)
+        stats = translated_filters_cache.get_stats()
+        self.assertEquals(self.service.build_filter_string(f), 'brightness:[1 TO {0}]'.format(n))
+        self.assertEquals(self.service.build_filter_string(f), 'brightness:[1 TO {0}]'.format(n))
+        new_stats = translated_filters_cache.get_stats()
+        self.assertEquals((new_stats['hits'] - stats['hits'], new_stats['misses'] - stats['misses']), (1, 1))
+
+        # Errors are also cached, but only for the service which raised them
+        for _ in range(2):
+            with self.assertRaises(ACFilterParsingException):
+                self.service_without_brightness.build_filter_string(f)
+        new_stats = translated_filters_cache.get_stats()
+        self.assertEquals((new_stats['hits'] - stats['hits'], new_stats['misses'] - stats['misses']), (2, 2))
+        self.assertEquals(self.service.build_filter_string(f), 'brightness:[1 TO {0}]'.format(n))
+
+    def test_build_filter_string_from_parsed_filter(self):
+        from services.acservice.utils import parse_filter
+
+        # Parsed filters sent to the workers (as JSON) are translated like filter strings
+        f = 'ac:format:wav AND (ac:duration:[1,5] OR NOT ac:tag:"dog")'
+        parsed_filter = json.loads(json.dumps(parse_filter(f)))
+        self.assertEquals(self.service.build_filter_string(parsed_filter), self.service.build_filter_string(f))
+        self.assertEquals(self.service.build_filter_string(parsed_filter),
+                          'type:wav && (length_ms:[1000 TO 5000] || !tag:dog)')
+
+
+def random_filter_string(rand, depth=0):
+    # Random filter string using all the features of the filter syntax (with random case and spacing)
+    space = lambda: rand.choice(['', ' ', '  ', '\t'])
+    choice = rand.random()
+    if depth >= 3 or choice < 0.4:
+        value = rand.choice([
+            'wav', 'field-recording', '\xc6r\xf8', '-3', '2.5', '1e3', '"a dog\tbarking"', "'it''s'",
+            '[{0}{1}{0},{0}{2}{0}]'.format(space(), rand.choice(['*', '10', '0.5', '"b"']), rand.choice(['*', '40'])),
+        ])
+        return '{0}ac:{1}{2}:{2}{3}'.format(space(), rand.choice(['format', 'duration', 'tag', 'is_loop']), space(),
+                                             value)
+    if choice < 0.55:
+        return '{0} {1}'.format(rand.choice(['NOT', 'not', 'Not']), random_filter_string(rand, depth + 1))
+    if choice < 0.7:
+        return '({0}{1}{0})'.format(space(), random_filter_string(rand, depth + 1))
+    operands = [random_filter_string(rand, depth + 1) for _ in range(rand.randint(2, 4))]
+    return ''.join(operand + ' {0} '.format(rand.choice(['AND', 'and', 'OR', 'or'])) for operand in operands[:-1]) \
+        + operands[-1]
+
+
+class FilterParser(TestCase):
+
+    def assertParsedAsWithPyparsing(self, filter_string):
+        from services.acservice.utils import FilterParser
+        from services.acservice.pyparsing_filter_grammar import parse_filter_with_pyparsing
+        # repr is compared so that the types of numbers are also checked
+        self.assertEquals(repr(FilterParser(filter_string).parse()), repr(parse_filter_with_pyparsing(filter_string)))
+
+    def test_parse_filter(self):
+        from services.acservice.utils import parse_filter
+        self.assertEquals(parse_filter('ac:format:wav AND ac:duration:[10,40]'),
+                          [['ac:format', ':', 'wav'], 'and', ['ac:duration', ':', [10, 40]]])
+        self.assertEquals(parse_filter('NOT ac:tag:"dog" OR ac:duration:[* , 2.5]'),
+                          [['not', ['ac:tag', ':', 'dog']], 'or', ['ac:duration', ':', ['*', 2.5]]])
+
+    def test_same_output_as_pyparsing(self):
+        import random
+        for filter_string in [
+            'ac:format:wav',
+            '  ac:format : wav ',
+            'ac:duration:3 and ac:duration:3.5 AND ac:duration:-2 and ac:tag:inf',
+            'ac:tag:"dog" or ac:tag:\'cat\' Or ac:tag:"\\"quoted\\"" OR ac:tag:"5"',
+            'ac:duration:[*,*] AND ac:duration:[ 1.5 , "2" ] AND ac:duration:[1.2.3,4]',
+            'NOT ac:format:wav AND ac:format:mp3 OR NOT NOT ac:format:flac',
+            'not(ac:format:wav or ac:format:mp3)and(ac:duration:[1,2])',
+            '((ac:format:wav))',
+            'ac:format:wav OR (ac:duration:1 AND (ac:tag:dog OR NOT (ac:tag:cat AND ac:is_loop:1)))',
+        ]:
+            self.assertParsedAsWithPyparsing(filter_string)
+        rand = random.Random(0)
+        for _ in range(200):
+            self.assertParsedAsWithPyparsing(random_filter_string(rand))
+
+    def test_invalid_filters(self):
+        import pyparsing
+        from services.acservice.utils import FilterParser
+        from services.acservice.pyparsing_filter_grammar import parse_filter_with_pyparsing
+        from ac_mediator.exceptions import ACFilterParsingException
+        for filter_string in ['', 'ac:format', 'ac:format:', 'format:wav', 'ac: format:wav', 'ac:format:wav AND',
+                              'ac:format:wav ac:format:mp3', 'NOT', '(ac:format:wav', 'ac:format:wav)',
+                              'ac:format:"wav', 'ac:duration:[1,2', 'ac:duration:[-1,2]', 'ac:duration:[1]',
+                              'ac:format:wav && ac:format:mp3', 'ac:tag:\u65e5\u672c']:
+            with self.assertRaises(ACFilterParsingException):
+                FilterParser(filter_string).parse()
+            with self.assertRaises(pyparsing.ParseException):
+                parse_filter_with_pyparsing(filter_string)
+
+    def test_deeply_nested_filters(self):
+        from services.acservice.utils import FilterParser, FILTER_MAX_NESTING_DEPTH
+        from ac_mediator.exceptions import ACFilterParsingException
+
+        # Filters up to the maximum nesting depth are parsed (pyparsing is only used for shallow filters as it takes
+        # exponential time with the nesting depth)
+        depth = FILTER_MAX_NESTING_DEPTH
+        self.assertParsedAsWithPyparsing('((NOT (ac:format:wav))) AND NOT NOT ((ac:tag:dog OR (ac:tag:cat)))')
+        term = ['ac:format', ':', 'wav']
+        self.assertEquals(FilterParser('(' * depth + 'ac:format:wav' + ')' * depth).parse(), term)
+        self.assertEquals(FilterParser(' AND '.join(['(' * depth + 'ac:format:wav' + ')' * depth] * 3)).parse(),
+                          [term, 'and', term, 'and', term])
+        negated_terms = [term]
+        for _ in range(depth):
+            negated_terms.append(['not', negated_terms[-1]])
+        self.assertEquals(FilterParser('NOT ' * depth + 'ac:format:wav').parse(), negated_terms[depth])
+        self.assertEquals(FilterParser('(NOT ' * (depth // 2) + 'ac:format:wav' + ')' * (depth // 2)).parse(),
+                          negated_terms[depth // 2])
+
+        # Deeper filters raise ACFilterParsingException (instead of exhausting the recursion limit)
+        for filter_string in ['(' * (depth + 1) + 'ac:format:wav' + ')' * (depth + 1),
+                              '(' * 250 + 'ac:format:wav' + ')' * 250,
+                              'NOT ' * 250 + 'ac:format:wav',
+                              '(NOT ' * 250 + 'ac:format:wav' + ')' * 250,
+                              '(' * 10000]:
+            with self.assertRaises(ACFilterParsingException):
+                FilterParser(filter_string).parse()
+
+
+class RequestHedging(TestCase):
+
+    def setUp(self):
+        from services.acservice.base import BaseACService
+        self.service = BaseACService()
+        self.service.configure({'service_id': 'hedgingserviceid', 'hedge_requests': 'yes', 'hedge_budget': '0.5'})
+
+        # Fake requests so that the first one is slow and the following ones fast
+        self.n_requests = 0
+
+        async def perform_request_async(*args):
+            self.n_requests += 1
+            self.service.latency_tracker.add_request()
+            if self.n_requests == 1:
+                await asyncio.sleep(1)
+                return 'slow'
+            return 'fast'
+        self.service.perform_request_async = perform_request_async
+
+    def test_latency_tracker(self):
+        from services.acservice.utils import LatencyTracker
+        tracker = LatencyTracker(window_size=100, min_samples=10, budget_ratio=0.5)
+
+        # Percentiles are only computed once there are enough samples
+        for latency in range(0, 9):
+            tracker.add_latency(latency)
+        self.assertEquals(tracker.get_percentile(95), None)
+        for latency in range(9, 100):
+            tracker.add_latency(latency)
+        self.assertEquals(tracker.get_percentile(95), 95)
+        self.assertEquals(tracker.get_percentile(100), 99)
+
+        # Each request adds half a token to the budget
+        self.assertEquals(tracker.consume_hedge_token(), False)
+        tracker.add_request()
+        self.assertEquals(tracker.consume_hedge_token(), False)
+        tracker.add_request()
+        self.assertEquals(tracker.consume_hedge_token(), True)
+        self.assertEquals(tracker.consume_hedge_token(), False)
+
+    def test_hedged_request(self):
+        from services.acservice.utils import run_sync
+
+        # Without latency samples requests are not hedged
+        self.assertEquals(run_sync(self.service.perform_hedged_request_async('get', None, {}, {}, {})), 'slow')
+
+        # Once latencies are known, a second request is sent if the first one is slower than usual
+        for count in range(0, 20):
+            self.service.latency_tracker.add_latency(0.01)
+        self.n_requests = 0
+        self.assertEquals(run_sync(self.service.perform_hedged_request_async('get', None, {}, {}, {})), 'fast')
+        self.assertEquals(self.n_requests, 2)
+
+        # When the hedging budget is exhausted, no second request is sent
+        self.service.latency_tracker.tokens = 0
+        self.n_requests = 0
+        self.assertEquals(run_sync(self.service.perform_hedged_request_async('get', None, {}, {}, {})), 'slow')
+        self.assertEquals(self.n_requests, 1)
+
+
+class ConcurrencyLimiter(TestCase):
+
+    def setUp(self):
+        from services.concurrency import ServiceConcurrencyLimiter
+        self.limiter = ServiceConcurrencyLimiter()
+        self.service_id = 'limiterserviceid{0}'.format(uuid.uuid4())
+
+    def tearDown(self):
+        self.limiter.r.delete(*self.limiter.get_keys(self.service_id))
+
+    @override_settings(SERVICE_CONCURRENCY_INITIAL_LIMIT=2)
+    def test_acquire_and_release(self):
+        from services.acservice.utils import run_sync
+
+        # Slots can be acquired until the limit is reached, then requests wait until the deadline
+        lease1 = run_sync(self.limiter.acquire(self.service_id, time.time() + 1))
+        run_sync(self.limiter.acquire(self.service_id, time.time() + 1))
+        self.assertEquals(self.limiter.get_status(self.service_id)['n_in_flight'], 2)
+        with self.assertRaises(ACAPIServiceBusy):
+            run_sync(self.limiter.acquire(self.service_id, time.time() + 0.2))
+        self.assertEquals(self.limiter.get_status(self.service_id)['n_queued'], 0)
+
+        # Releasing a slot after a successful request increases the limit (additive increase)
+        self.assertEquals(self.limiter.release(self.service_id, lease1, success=True), 2.5)
+        status = self.limiter.get_status(self.service_id)
+        self.assertEquals(status['n_in_flight'], 1)
+        self.assertEquals(status['limit'], 2.5)
+
+        # Releasing a slot after a failed request decreases the limit (multiplicative decrease)
+        lease3 = run_sync(self.limiter.acquire(self.service_id, time.time() + 1))
+        self.assertEquals(self.limiter.release(self.service_id, lease3, success=False), 1.25)
+
+        # Expired leases do not count as requests in flight
+        self.assertEquals(self.limiter.try_acquire(self.service_id, 'expired', time.time() - 1)[0], False)
+        self.limiter.r.delete(self.limiter.get_leases_key(self.service_id))
+        self.assertEquals(self.limiter.try_acquire(self.service_id, 'expired', time.time() - 1)[0], True)
+        self.assertEquals(self.limiter.try_acquire(self.service_id, 'other', time.time() + 1)[0], True)
+
+    @override_settings(SERVICE_CONCURRENCY_INITIAL_LIMIT=1, SERVICE_CONCURRENCY_MIN_LIMIT=1,
+                       SERVICE_CONCURRENCY_QUEUE_RETRY_INTERVAL=10)
+    def test_queued_requests_woken_up_in_order(self):
+        from services.acservice.utils import run_sync
+
+        async def wait_for_slots():
+            lease = await self.limiter.acquire(self.service_id, time.time() + 5)
+            order = list()
+
+            async def acquire(name):
+                lease = await self.limiter.acquire(self.service_id, time.time() + 5)
+                order.append(name)
+                return lease
+
+            first = asyncio.ensure_future(acquire('first'))
+            await asyncio.sleep(0.2)
+            second = asyncio.ensure_future(acquire('second'))
+            await asyncio.sleep(0.2)
+            self.assertEquals(self.limiter.get_status(self.service_id)['n_queued'], 2)
+
+            # Released slots are handed to the oldest queued request, which does not wait until its next retry
+            start_time = time.time()
+            await self.limiter.release_async(self.service_id, lease, success=False)
+            lease = await first
+            self.assertLess(time.time() - start_time, 1)
+            self.assertFalse(second.done())
+            await self.limiter.release_async(self.service_id, lease, success=False)
+            await second
+            return order
+
+        self.assertEquals(run_sync(wait_for_slots()), ['first', 'second'])
+
+    @override_settings(SERVICE_CONCURRENCY_INITIAL_LIMIT=1)
+    def test_fail_fast_if_deadline_can_not_be_met(self):
+        from services.acservice.utils import run_sync
+        run_sync(self.limiter.acquire(self.service_id, time.time() + 5))
+
+        # With requests taking 1 second, a request waiting for the slot can't be answered in 1.5 seconds
+        start_time = time.time()
+        with self.assertRaises(ACAPIServiceBusy):
+            run_sync(self.limiter.acquire(self.service_id, time.time() + 1.5, expected_latency=1))
+        self.assertLess(time.time() - start_time, 0.5)
+        self.assertEquals(self.limiter.get_status(self.service_id)['n_queued'], 0)
+
+
+class CircuitBreaker(TestCase):
+
+    def setUp(self):
+        from services.circuit_breaker import ServiceCircuitBreaker
+        self.breaker = ServiceCircuitBreaker()
+        self.service_id = 'breakerserviceid{0}'.format(uuid.uuid4())
+
+    def tearDown(self):
+        self.breaker.r.delete(self.breaker.get_breaker_key(self.service_id),
+                              self.breaker.get_probe_key(self.service_id))
+
+    @override_settings(SERVICE_CIRCUIT_BREAKER_FAILURE_THRESHOLD=2, SERVICE_CIRCUIT_BREAKER_RESET_TIMEOUT=0.5)
+    def test_circuit_breaker_states(self):
+        from services.circuit_breaker import CIRCUIT_BREAKER_CLOSED, CIRCUIT_BREAKER_OPEN, CIRCUIT_BREAKER_HALF_OPEN
+
+        # Breaker opens after consecutive failures (successes reset the count)
+        self.breaker.record_failure(self.service_id)
+        self.breaker.record_success(self.service_id)
+        self.breaker.record_failure(self.service_id)
+        self.assertEquals(self.breaker.get_state(self.service_id), CIRCUIT_BREAKER_CLOSED)
+        self.assertEquals(self.breaker.allow_request(self.service_id), True)
+        self.breaker.record_failure(self.service_id)
+        self.assertEquals(self.breaker.get_state(self.service_id), CIRCUIT_BREAKER_OPEN)
+        self.assertEquals(self.breaker.allow_request(self.service_id), False)
+
+        # After the reset timeout, a single probe is allowed and if it fails the breaker opens again
+        time.sleep(0.5)
+        self.assertEquals(self.breaker.get_state(self.service_id), CIRCUIT_BREAKER_HALF_OPEN)
+        self.assertEquals(self.breaker.allow_request(self.service_id), True)
+        self.assertEquals(self.breaker.allow_request(self.service_id), False)
+        self.breaker.record_failure(self.service_id)
+        self.assertEquals(self.breaker.get_state(self.service_id), CIRCUIT_BREAKER_OPEN)
+
+        # If the probe succeeds the breaker closes
+        time.sleep(0.5)
+        self.assertEquals(self.breaker.allow_request(self.service_id), True)
+        self.breaker.record_success(self.service_id)
+        self.assertEquals(self.breaker.get_state(self.service_id), CIRCUIT_BREAKER_CLOSED)
+        self.assertEquals(self.breaker.allow_request(self.service_id), True)
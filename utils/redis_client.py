@@ -0,0 +1,33 @@
+from django.conf import settings
+import threading
+import redis
+import os
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Return the redis client shared by all components of the current process (response store, concurrency
+    limiter, circuit breaker...). The client (and its connection pool) is created lazily and re-created if the
+    process has been forked after its creation (e.g. by uwsgi or Celery workers) so that connections are never
+    shared between processes. Pool size and socket timeouts are configured with the REDIS_* settings. When all
+    connections of the pool are in use, getting a connection blocks until one is available (see
+    settings.REDIS_CONNECTION_POOL_TIMEOUT)."""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            pool = redis.BlockingConnectionPool(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                timeout=settings.REDIS_CONNECTION_POOL_TIMEOUT,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            )
+            _client = redis.StrictRedis(connection_pool=pool)
+            _client_pid = os.getpid()
+        return _client